@@ -4,18 +4,32 @@ from datetime import datetime
 from shutil import copy2
 from shutil import rmtree
 import traceback
+import contextlib
 import signal
 import time
 import optparse
+import hashlib
+import itertools
+import json
 import math
+import multiprocessing
+import operator
 import os
-import pickle
 import sys
+import tempfile
 import subprocess as sub
 import re
+import shlex
+import threading
+import numpy as np
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
 
 """
     Requirements: Python 2.6 or higher or Python 3.x
+                  Numpy
                   Antechamber (from AmberTools preferably)
                   OpenBabel (optional, but strongly recommended)
 
@@ -87,6 +101,16 @@ qDict = {'mopac': 0, 'divcon': 1, 'sqm': 2}
 ionOrSolResNameList = ['Cl-', 'Na+', 'K+', 'CIO', 'Cs+', 'IB', 'Li+', 'MG2',
                        'Rb+', 'WAT', 'MOH', 'NMA']
 
+# (atomic number, mass, mbondi radius, GB screening parameter) of the elements
+# told apart by mass when writing prmtop files; H radius depends on its bond
+elementData = [(1, 1.008, 1.2, 0.85), (3, 6.941, 1.5, 0.8), (6, 12.01, 1.7, 0.72),
+               (7, 14.01, 1.55, 0.79), (8, 16.00, 1.5, 0.85), (9, 19.00, 1.5, 0.88),
+               (11, 22.99, 1.5, 0.8), (12, 24.305, 1.5, 0.8), (14, 28.09, 2.1, 0.8),
+               (15, 30.97, 1.85, 0.86), (16, 32.06, 1.8, 0.96), (17, 35.45, 1.7, 0.8),
+               (19, 39.10, 1.5, 0.8), (20, 40.08, 1.5, 0.8), (26, 55.85, 1.5, 0.8),
+               (29, 63.55, 1.5, 0.8), (30, 65.38, 1.5, 0.8), (35, 79.90, 1.85, 0.8),
+               (37, 85.47, 1.5, 0.8), (53, 126.90, 1.98, 0.8), (55, 132.91, 1.5, 0.8)]
+
 leapGaffFile = 'leaprc.gaff'
 # leapAmberFile = 'leaprc.ff99SB'  # 'leaprc.ff10' and 'leaprc.ff99bsc0' has extra Atom Types not in parm99.dat
 leapAmberFile = 'leaprc.ff12SB'
@@ -103,6 +127,56 @@ minDist = 0.5
 maxDist2 = maxDist ** 2  # squared Ang.
 minDist2 = minDist ** 2  # squared Ang.
 diffTol = 0.01
+parmMergeVersion = 2  # bump when parmMerge output changes, see parmCachePath
+snapshotVersion = 4  # bump when the arrays in a snapshot change, see MolTopol.writeSnapshot
+parmIndexCache = {}  # parm dat file -> readParmIndex
+rssPerMB = 1024.0 ** 2 if sys.platform == 'darwin' else 1024.0  # ru_maxrss in bytes or KB
+# stages of an acpype run that --estimate predicts, with the size each one
+# scales with: atoms or terms (bonds + angles + dihedrals). Their time (s) and
+# peak memory (MB) as a * size ** b are fitted to acpype reports with
+# --fit_estimate (see fitEstimateModel): the model shipped in
+# estimateModelFile, updated by the user's one in acpypeCacheDir.
+estimateSizeOf = {'guessCharge': 'atoms', 'antechamber:gas': 'atoms', 'antechamber:bcc': 'atoms',
+                  'parmchk': 'atoms', 'tleap': 'atoms', 'MolTopol': 'terms', 'CNS': 'terms',
+                  'GROMACS': 'terms', 'CHARMM': 'terms'}
+estimateTools = ['antechamber:gas', 'antechamber:bcc', 'parmchk', 'tleap']  # stages limited by -s
+# shipped: fitted to amb2gmx runs of the example nanotubes (and of copies of
+# them side by side, up to 31360 atoms) on one CPU, so for acpype stages only
+estimateModelFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'acpype_estimate.json')
+gmxChunkSize = 50000  # lines of a topology section formatted at a time
+# GROMACS sections are formatted by a pool for more atoms than that (and
+# more than a CPU): sending a chunk of rows costs about half of formatting it
+gmxPoolAtoms = gmxChunkSize
+
+# gaff atom types tried, in order, for parameters missing for a type, as
+# parmchk does with its corresponding atom types
+parmchkCorr = {'cc': ['c2', 'ca'], 'cd': ['c2', 'ca'], 'ce': ['c2', 'ca'], 'cf': ['c2', 'ca'],
+               'cp': ['ca'], 'cq': ['ca'], 'cg': ['c1'], 'ch': ['c1'], 'cu': ['c2'], 'cv': ['c2'],
+               'cx': ['c3'], 'cy': ['c3'], 'nb': ['n2'], 'nc': ['n2'], 'nd': ['n2'], 'ne': ['n2'],
+               'nf': ['n2'], 'na': ['n3'], 'nh': ['n3'], 'n4': ['n3'], 'pb': ['p2'], 'pc': ['p2'],
+               'pd': ['p2'], 'pe': ['p2'], 'pf': ['p2'], 'px': ['p4'], 'py': ['p5'], 'sx': ['s4'],
+               'sy': ['s6'], 'h4': ['ha'], 'h5': ['ha'], 'hx': ['hc'], 'os': ['oh'], 'sh': ['ss']}
+
+# central atom types of planar impropers, given default values if missing
+parmchkPlanar = ['c', 'c2', 'ca', 'cc', 'cd', 'ce', 'cf', 'cp', 'cq', 'cu', 'cv', 'cz', 'n', 'n2',
+                 'na', 'nb', 'nc', 'nd', 'ne', 'nf', 'nh', 'pb', 'pc', 'pd', 'pe', 'pf',
+                 'C', 'CA', 'CB', 'CC', 'CK', 'CM', 'CN', 'CQ', 'CR', 'CV', 'CW', 'C*',
+                 'N', 'N2', 'N*', 'NA', 'NB', 'NC']
+
+frcmodFormats = {'MASS': '%s %7.3f %10.3f               %s',
+                 'BOND': '%s %8.2f %8.3f       %s',
+                 'ANGL': '%s %8.3f %10.3f   %s',
+                 'DIHE': '%s %4i %8.3f %13.3f %13.3f      %s',
+                 'IMPR': '%s %11.1f %14.1f %10.1f          %s',
+                 'NONB': '  %s %15.4f %7.4f             %s'}
+
+# Ryckaert-Bellemans C0..C5 contributions of a proper dihedral term with
+# V = 2 * kPhi (kJ), indexed by [period][phase == 180]
+rbCoefTable = np.zeros((7, 2, 6))
+rbCoefTable[1] = [[0.5, -0.5, 0, 0, 0, 0], [0.5, 0.5, 0, 0, 0, 0]]
+rbCoefTable[2] = [[0, 0, 1, 0, 0, 0], [1, 0, -1, 0, 0, 0]]
+rbCoefTable[3] = [[0.5, 1.5, 0, -2, 0, 0], [0.5, -1.5, 0, 2, 0, 0]]
+rbCoefTable[4] = [[1, 0, -4, 0, 4, 0], [0, 0, 4, 0, -4, 0]]
 
 dictAmbAtomType2AmbGmxCode = \
     {'BR': '1', 'C': '2', 'CA': '3', 'CB': '4', 'CC': '5', 'CK': '6', 'CM': '7', 'CN': '8', 'CQ': '9',
@@ -248,9 +322,6 @@ a2oD = {'amber99_2': ['opls_235', 'opls_271'],
         'amber99_48': ['opls_200'],
         }
 
-global pid
-pid = 0
-
 head = "%s created by acpype (Rev: " + svnRev + ") on %s\n"
 
 date = datetime.now().ctime()
@@ -281,7 +352,13 @@ epilog = \
     root_CNS.inp      :  run parameters file for CNS/XPLOR
     root_CHARMM.rtf   :  topology file for CHARMM
     root_CHARMM.prm   :  parameter file for CHARMM
-    root_CHARMM.inp   :  run parameters file for CHARMM"""
+    root_CHARMM.str   :  topology and parameter stream file for CHARMM
+    root_CHARMM.pdb   :  pdb file for CHARMM
+    root_CHARMM.inp   :  run parameters file for CHARMM
+    root_AMBER.prmtop :  Amber topology written by acpype (-o amber, or with --hmr)
+    root_AMBER.inpcrd :  Amber coordinates written by acpype
+    root.snapshot     :  parsed topology as numpy arrays + JSON header (see readSnapshot)
+    root_report.json  :  wall time, CPU time and peak memory of each stage"""
 
 SLEAP_TEMPLATE = \
     """
@@ -433,56 +510,198 @@ def parseFrcmod(lista):
             else:
                 dd[key] = [line]
             dict_[head] = dd
-    for k in dict_.keys():
+    for k in list(dict_.keys()):
         if not dict_[k]:
             dict_.pop(k)
     return dict_
 
 
+def parmCachePath(name, files, frcmod=False):
+    """
+        Path for a merged parm file in the per-user cache directory
+        ($XDG_CACHE_HOME or ~/.cache, then acpype), named after the hash of
+        the contents of the files merged and of parmMergeVersion, so that
+        merged files can be reused and different inputs never clash.
+    """
+    sha = hashlib.sha1(('%s %s' % (parmMergeVersion, frcmod)).encode())
+    for fileName in files:
+        with open(fileName, 'rb') as f:
+            sha.update(f.read())
+    return os.path.join(acpypeCacheDir(), '%s_%s.dat' % (name, sha.hexdigest()[:16]))
+
+
+def acpypeCacheDir():
+    """
+        The per-user acpype directory ($XDG_CACHE_HOME or ~/.cache, then
+        acpype), made if missing.
+    """
+    cacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.join(os.path.expanduser('~'), '.cache'), 'acpype')
+    if not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:  # made meanwhile by another job
+            if not os.path.isdir(cacheDir):
+                raise
+    return cacheDir
+
+
+def writeAtomic(fileName, lines):
+    """
+        Writes lines to fileName via a temporary file in the same directory
+        renamed to it, so concurrent jobs never see a partial file.
+    """
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(fileName), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+    try:
+        os.rename(tmpName, fileName)
+    except OSError:  # Windows: it exists already, written by another job
+        os.remove(tmpName)
+
+
+def readSnapshot(snapDir, mmapMode='r'):
+    """
+        Reads a topology snapshot written by MolTopol.writeSnapshot.
+        Returns its header (a dict) and a dict of its numpy arrays, memory
+        mapped by default (mmapMode as in numpy.load, None to read them in).
+    """
+    with open(os.path.join(snapDir, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != 'acpype-snapshot' or header.get('version') != snapshotVersion:
+        raise Exception("'%s' is not an acpype snapshot version %i" % (snapDir, snapshotVersion))
+    arrays = {}
+    for name in header['arrays']:
+        arrays[name] = np.load(os.path.join(snapDir, name + '.npy'), mmap_mode=mmapMode)
+    return header, arrays
+
+
+def snapshotTopol(snapDir, basename=None, debug=False, verbose=True, gmx45=False,
+                  disam=False, direct=False, chiral=False):
+    """
+        Returns a MolTopol rebuilt from a snapshot (see readSnapshot), with
+        the sections parsed from prmtop set, ready for its writers.
+    """
+    header, arrays = readSnapshot(snapDir, None)
+    molTop = arraysTopol(header, arrays, basename, debug, verbose, gmx45, disam, direct, chiral)
+    molTop.printDebug("topology loaded from snapshot '%s'" % snapDir)
+    return molTop
+
+
+def arraysTopol(header, arrays, basename=None, debug=False, verbose=True, gmx45=False,
+                disam=False, direct=False, chiral=False):
+    """
+        Returns a MolTopol made of header and arrays as in a snapshot (see
+        MolTopol.writeSnapshot), with the sections parsed from prmtop set.
+    """
+    molTop = MolTopol.__new__(MolTopol)
+    molTop.__dict__.update({'debug': debug, 'verbose': verbose, 'gmx45': gmx45,
+                            'disam': disam, 'direct': direct, 'chiral': chiral,
+                            'sorted': header['sorted'], 'hmrMass': header['hmrMass'],
+                            'allhdg': False, 'force': True,
+                            'obchiralExe': _getoutput('which obchiral') or '',
+                            'inputFile': header['inputFile'], 'topFileData': [],
+                            'baseName': basename or header['baseName'],
+                            'residueLabel': header['residueLabel'],
+                            'atomTypeSystem': header['atomTypeSystem'],
+                            'totalCharge': header['totalCharge'], 'pbc': header['pbc']})
+    # as in getLJMatrix and getAtoms
+    ljACOEFs = np.array(arrays['ljACOEFs'])
+    ljBCOEFs = np.array(arrays['ljBCOEFs'])
+    atomTypes = [AtomType(name, mass, float(ljACOEFs[ljId, ljId]), float(ljBCOEFs[ljId, ljId]))
+                 for name, mass, ljId in zip(arrays['typeNames'].tolist(), arrays['typeMasses'].tolist(),
+                                             arrays['typeLJIds'].tolist())]
+    numbering = AtomNumbering(len(arrays['atomNames']))
+    numbering.id[:] = arrays['atomIds']
+    numbering.cgnr[:] = arrays['atomCgnrs']
+    atoms = [Atom(name, atomTypes[typeId], i + 1, resid, mass, charge, coord, numbering)
+             for i, (name, typeId, resid, mass, charge, coord)
+             in enumerate(zip(arrays['atomNames'].tolist(), arrays['atomTypeIds'].tolist(),
+                              arrays['atomResids'].tolist(), arrays['atomMasses'].tolist(),
+                              arrays['atomCharges'].tolist(), arrays['atomCoords'].tolist()))]
+
+    def terms(key, cls, fields):
+        return [cls([atoms[i] for i in ids], *values)
+                for ids, values in zip(arrays[key + 'Atoms'].tolist(),
+                                       zip(*[arrays[key + f].tolist() for f in fields]))]
+
+    properDih = terms('proper', Dihedral, ['KPhis', 'Periods', 'Phases'])
+    condProperDih = [[] for _i in range(int(arrays['properGroups'].max()) + 1 if len(properDih) else 0)]
+    for groupId, dihedral in zip(arrays['properGroups'].tolist(), properDih):
+        condProperDih[groupId].append(dihedral)
+    molTop.__dict__.update({'prmtopAtoms': atoms, 'atomNumbering': numbering,
+                            'atomTypeIds': np.array(arrays['atomTypeIds']),
+                            'atomTypeLJIds': np.array(arrays['typeLJIds']),
+                            'ljACOEFs': ljACOEFs, 'ljBCOEFs': ljBCOEFs,
+                            'ljHBondPairs': np.array(arrays['ljHBondPairs']),
+                            'ljTypeIds': np.array(arrays['atomLJIds']),
+                            'atoms': [atoms[i] for i in arrays['atomOrder'].tolist()],
+                            'atomTypes': atomTypes,
+                            'bondIndex': np.array(arrays['bondAtoms']),
+                            'bonds': terms('bond', Bond, ['Ks', 'REqs']),
+                            'angles': terms('angle', Angle, ['Ks', 'ThetaEqs']),
+                            'properDihedrals': properDih,
+                            'improperDihedrals': terms('improper', Dihedral, ['KPhis', 'Periods', 'Phases']),
+                            'condensedProperDihedrals': condProperDih,
+                            'atomPairs': [(atoms[i], atoms[j]) for i, j in arrays['pairAtoms'].tolist()],
+                            'extraExclusions': [(atoms[i], atoms[j])
+                                                for i, j in arrays['exclusionAtoms'].tolist()]})
+    return molTop
+
+
 def parmMerge(fdat1, fdat2, frcmod=False):
-    '''merge two amber parm dat/frcmod files and save in /tmp'''
-    name1 = os.path.basename(fdat1).split('.dat')[0]
+    '''merge two amber parm dat/frcmod files, returning the merged file,
+       kept in the per-user cache (see parmCachePath)'''
+    name1 = os.path.basename(fdat1).split('.dat')[0].split('_')[0]
     if frcmod:
         name2 = os.path.basename(fdat2).split('.')[1]
     else:
         name2 = os.path.basename(fdat2).split('.dat')[0]
-    mname = '/tmp/' + name1 + name2 + '.dat'
-    mdatFile = open(mname, 'w')
+    mname = parmCachePath(name1 + name2, [fdat1, fdat2], frcmod)
+    if os.path.exists(mname):
+        return mname
     mdat = ['merged %s %s' % (name1, name2)]
 
-    # if os.path.exists(mname): return mname
     dat1 = splitBlock(open(fdat1).readlines())
 
     if frcmod:
         dHeads = {'MASS': 0, 'BOND': 1, 'ANGL': 2, 'DIHE': 3, 'IMPR': 4, 'HBON': 5, 'NONB': 7}
         dat2 = parseFrcmod(open(fdat2).readlines())  # dict
         for k in dat2:
+            block = dat1[dHeads[k]]
+            # lines of the block indexed by parameter code
+            index = {}
+            for id_, line in enumerate(block):
+                if line:
+                    index.setdefault(getParCode(line), []).append(id_)
+            # frcmod entries replace all lines of same code, where the first
+            # was, new ones go at the top (after title for MASS, BOND, NONB)
+            first = {}
+            dropped = set()
+            newLines = []
             for parEntry in dat2[k]:
-                idFirst = None
-                for line in dat1[dHeads[k]][:]:
-                    if line:
-                        key = line.replace(' -', '-').replace('- ', '-').split()[0]
-                        if key == parEntry:
-                            if not idFirst:
-                                idFirst = dat1[dHeads[k]].index(line)
-                            dat1[dHeads[k]].remove(line)
-                rev = dat2[k][parEntry][:]
-                rev.reverse()
-                if idFirst is None:
-                    idFirst = 0
-                for ll in rev:
-                    if dHeads[k] in [0, 1, 7]:  # MASS has title in index 0 and so BOND, NONB
-                        dat1[dHeads[k]].insert(idFirst + 1, ll)
-                    else:
-                        dat1[dHeads[k]].insert(idFirst, ll)
+                if parEntry in index:
+                    first[index[parEntry][0]] = parEntry
+                    dropped.update(index[parEntry])
+                else:
+                    newLines += dat2[k][parEntry]
+            top = 0
+            if dHeads[k] in [0, 1, 7]:  # MASS has title in index 0 and so BOND, NONB
+                top = 1
+            merged = block[:top] + newLines
+            for id_ in range(top, len(block)):
+                if id_ in first:
+                    merged += dat2[k][first[id_]]
+                if id_ not in dropped:
+                    merged.append(block[id_])
+            dat1[dHeads[k]] = merged
         dat1[0][0] = mdat[0]
-        for k in dat1:
-            for line in dat1[k]:
-                mdatFile.write(line + '\n')
+        writeAtomic(mname, [line for k in sorted(dat1) for line in dat1[k]])
         return mname
 
     dat2 = splitBlock(open(fdat2).readlines())
-    for k in dat1.keys()[:8]:
+    for k in sorted(dat1)[:8]:
         if k == 0:
             lines = dat1[k][1:-1] + dat2[k][1:-1] + ['']
             for line in lines:
@@ -513,27 +732,1147 @@ def parmMerge(fdat1, fdat2, frcmod=False):
             lines = dat1[k][:-1] + dat2[k][1:-1] + ['']
             for line in lines:
                 mdat.append(line)
-    for k in dat1.keys()[8:]:
+    for k in sorted(dat1)[8:]:
         for line in dat1[k]:
             mdat.append(line)
-    for k in dat2.keys()[9:]:
+    for k in sorted(dat2)[9:]:
         for line in dat2[k]:
             mdat.append(line)
-    for line in mdat:
-        mdatFile.write(line + '\n')
-    mdatFile.close()
+    writeAtomic(mname, mdat)
 
     return mname
 
 
+def readParmIndex(datFile):
+    """
+        Indexes an amber parm dat file by parameter code (see getParCode):
+        returns a dict of 'MASS', 'BOND', 'ANGL', 'DIHE', 'IMPR' and 'NONB'
+        to dicts of code -> parameter lines, the NONB ones also under the
+        types made equivalent to theirs. Parsed once per file and process.
+    """
+    if datFile in parmIndexCache:
+        return parmIndexCache[datFile]
+    dat = splitBlock(open(datFile).readlines())
+    index = dict([(name, {}) for name in ['MASS', 'BOND', 'ANGL', 'DIHE', 'IMPR', 'NONB']])
+    # MASS has title in index 0 and so BOND, NONB
+    for k, name, top in [(0, 'MASS', 1), (1, 'BOND', 1), (2, 'ANGL', 0), (3, 'DIHE', 0),
+                         (4, 'IMPR', 0), (7, 'NONB', 1)]:
+        for line in dat.get(k, [])[top:]:
+            if line.strip():
+                index[name].setdefault(getParCode(line), []).append(line)
+    nonb = index['NONB']
+    for line in dat.get(6, []):
+        equiv = line.split()
+        if equiv and equiv[0] in nonb:
+            for aType in equiv[1:]:
+                nonb.setdefault(aType, nonb[equiv[0]])
+    parmIndexCache[datFile] = index
+    return index
+
+
+def findParm(index, block, types):
+    """
+        Looks up types in a block of a parm index (see readParmIndex),
+        trying them forward and reversed, then for DIHE the general X-b-c-X
+        form and for IMPR the orders of the outer atoms, also with X.
+        Returns (types found, parameter lines) or None.
+    """
+    types = tuple(types)
+    if block == 'IMPR':
+        a, b, c, d = types
+        forms = []
+        for o in itertools.permutations((a, b, d)):
+            forms += [(o[0], o[1], c, o[2]), ('X', o[1], c, o[2]), ('X', 'X', c, o[2])]
+    else:
+        forms = [types, types[::-1]]
+        if block == 'DIHE':
+            forms += [('X', types[1], types[2], 'X'), ('X', types[2], types[1], 'X')]
+    entries = index[block]
+    for form in forms:
+        code = '-'.join(form)
+        if code in entries:
+            return form, entries[code]
+    return None
+
+
+def frcmodLines(block, types, found):
+    """
+        Lines of a frcmod section for types, from found = (types found,
+        parameter lines) as given by findParm, or, when found is None, with
+        default values for impropers and else zero parameters and 'ATTN,
+        need revision', as parmchk.
+    """
+    nPars = {'MASS': 2, 'BOND': 2, 'ANGL': 2, 'DIHE': 4, 'IMPR': 3, 'NONB': 2}[block]
+    code = '-'.join(['%-2s' % t for t in types])
+    if found is None and block == 'IMPR':
+        return [frcmodFormats[block] % (code, 1.1, 180.0, 2.0, 'Using default value')]
+    if found is None:
+        pars = (0,) * nPars
+        if block == 'DIHE':
+            pars = (1,) + pars[1:]
+        return [frcmodFormats[block] % ((code,) + pars + ('ATTN, need revision',))]
+    form, lines = found
+    comment = 'same as %s' % '-'.join(['%-2s' % t for t in form])
+    out = []
+    for line in lines:
+        if block in ['MASS', 'NONB']:
+            fields = line.split()[1:]
+        else:
+            fields = line[3 * len(types) - 1:].split()
+        pars = []
+        for field in fields[:nPars]:
+            try:
+                pars.append(float(field))
+            except ValueError:
+                break
+        pars += [0.0] * (nPars - len(pars))
+        out.append(frcmodFormats[block] % tuple([code] + pars + [comment]))
+    return out
+
+
+def parmchkFrcmod(types, bonds, index, frcmodFile):
+    """
+        In-process parmchk: writes to frcmodFile the parameters missing in
+        parm index (see readParmIndex) for the molecule with atom type names
+        types and bonds, a (n, 2) array of atom indices. Each unique type
+        tuple is looked up once; those not found are tried again with their
+        corresponding types (parmchkCorr), fewest replaced first, and written
+        with zero parameters and 'ATTN, need revision' if still missing.
+        As parmchk, impropers are all written, with default values for the
+        missing ones with planar central atom (parmchkPlanar).
+        Returns the number of parameters not found.
+    """
+    typeNames, typeIds = np.unique(np.asarray(types), return_inverse=True)
+    typeNames = typeNames.tolist()
+    terms = [('MASS', [(t,) for t in typeNames]), ('NONB', [(t,) for t in typeNames])]
+    for block, tuples in zip(['BOND', 'ANGL', 'DIHE', 'IMPR'], uniqueTermTypes(typeIds, bonds)):
+        terms.append((block, [tuple([typeNames[i] for i in row]) for row in tuples.tolist()]))
+    sections = {}
+    missing = 0
+    for block, tuples in terms:
+        lines = sections.setdefault(block, [])
+        for types_ in sorted(tuples):
+            found = findParm(index, block, types_)
+            if found and block != 'IMPR':
+                continue
+            options = [[t] + parmchkCorr.get(t, []) for t in types_]
+            candidates = sorted(itertools.product(*options),
+                                key=lambda c: sum([a != b for a, b in zip(c, types_)]))
+            for candidate in candidates[1:]:
+                if found:
+                    break
+                found = findParm(index, block, candidate)
+            if block == 'IMPR':
+                if found or types_[2] in parmchkPlanar:
+                    lines += frcmodLines(block, types_, found)
+                continue
+            lines += frcmodLines(block, types_, found)
+            missing += found is None
+    with open(frcmodFile, 'w') as f:
+        f.write('remark goes here\n')
+        for block, head in [('MASS', 'MASS'), ('BOND', 'BOND'), ('ANGL', 'ANGLE'), ('DIHE', 'DIHE'),
+                            ('IMPR', 'IMPROPER'), ('NONB', 'NONBON')]:
+            f.write(head + '\n')
+            for line in sections[block]:
+                f.write(line + '\n')
+            f.write('\n')
+    return missing
+
+
+def killProcessGroup(proc, grace=5):
+    """
+        Kills the process group led by proc (see runTool): TERM, then KILL
+        if still running after grace seconds. Returns the (status, rusage)
+        of proc if reaped here by os.wait4, else None: not reaped yet or,
+        without os.wait4, reaped by proc.poll.
+    """
+    def reaped():
+        if hasattr(os, 'wait4'):  # not proc.poll, it would lose the rusage
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            return (status, rusage) if pid else None
+        proc.poll()
+        return None
+
+    if not hasattr(os, 'killpg'):
+        proc.kill()
+        return None
+    for sig, wait in [(signal.SIGTERM, grace), (signal.SIGKILL, 0)]:
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:  # group gone
+            return None
+        t0 = time.time()
+        while True:
+            result = reaped()
+            if result or proc.returncode is not None:
+                return result
+            if time.time() - t0 >= wait:
+                break
+            time.sleep(0.1)
+    return None
+
+
+def resourceUsage():
+    """
+        Returns the CPU time (s) used by this process, the CPU time of its
+        finished children and the peak RSS (MB) of this process.
+    """
+    if not resource:
+        return 0.0, 0.0, 0.0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime, own.ru_maxrss / rssPerMB
+
+
+def runTool(cmd, timeTol=None, maxMem=None, logFile=None, cwd=None, usage=None):
+    """
+        Runs an external tool, cmd being a list of arguments or a string
+        split as a shell would (shlex), without a shell and in a new process
+        group, returning (exit code, output with stderr). The output is read
+        by a thread as it comes and, if logFile, written there line by line.
+        After timeTol seconds the whole process group is killed and exit code
+        is None; maxMem (MB) limits the address space of the tool and of its
+        children, set with prlimit when installed. No signals, globals nor
+        chdir are used, so it can be run from threads and process pools. If
+        usage, a dict, its 'toolsPeakRss' is raised to the peak RSS (MB) of
+        the tool process tree.
+    """
+    if not isinstance(cmd, list):
+        cmd = shlex.split(cmd)
+    kwargs = {}
+    limit = None
+    if maxMem and resource:
+        limit = int(maxMem) * 1024 ** 2
+        # set on the tool by prlimit before it execs it, so its early children get it too
+        prlimitExe = _getoutput('which prlimit')
+        if prlimitExe:
+            cmd = [prlimitExe, '--as=%d' % limit, '--'] + cmd
+            limit = None
+    if hasattr(os, 'setsid'):
+        if limit:
+            # fallback without prlimit: preexec_fn is not thread-safe, the
+            # forked child can deadlock in it if other threads run runTool
+            def preexec():
+                os.setsid()
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            kwargs['preexec_fn'] = preexec
+        elif sys.version_info >= (3, 2):
+            kwargs['start_new_session'] = True
+        else:
+            kwargs['preexec_fn'] = os.setsid
+    try:
+        proc = sub.Popen(cmd, stdout=sub.PIPE, stderr=sub.STDOUT, cwd=cwd, **kwargs)
+    except OSError:  # as a shell would say for a missing tool
+        return 127, "%s: %s\n" % (cmd[0], sys.exc_info()[1])
+    lines = []
+    log = logFile and open(logFile, 'w')
+
+    def reader():
+        try:
+            for line in iter(proc.stdout.readline, b''):
+                line = str(line.decode('utf-8', 'replace'))
+                lines.append(line)
+                if log:
+                    log.write(line)
+                    log.flush()
+        finally:  # here, as it may outlive runTool (see below)
+            proc.stdout.close()
+            if log:
+                log.close()
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeTol)
+    timedOut = thread.is_alive()
+    reaped = None
+    if timedOut:
+        reaped = killProcessGroup(proc)
+        # a child that left the group may still hold the output open: not waited for
+        thread.join(5)
+    if hasattr(os, 'wait4'):  # reaps it with the resources used by its tree
+        status, rusage = reaped or os.wait4(proc.pid, 0)[1:]
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if usage is not None:
+            usage['toolsPeakRss'] = max(usage.get('toolsPeakRss', 0.0), rusage.ru_maxrss / rssPerMB)
+    else:
+        proc.wait()
+    if timedOut:
+        return None, ''.join(lines)
+    return proc.returncode, ''.join(lines)
+
+
 def _getoutput(cmd):
-    '''to simulate commands.getoutput in order to work with python 2.6 up to 3.x'''
-    out = sub.Popen(cmd, shell=True, stderr=sub.STDOUT, stdout=sub.PIPE).communicate()[0][:-1]
+    '''output (stderr included, last newline stripped) of a command run as
+       runTool does, i.e., with NO shell: pipes, redirections, globs and
+       $VARS are not interpreted, cmd being a list or a string split by shlex'''
+    out = runTool(cmd)[1]
+    if out.endswith('\n'):
+        out = out[:-1]
+    return out
+
+
+def readMol2Section(mol2File, section):
+    """
+        Streams a @<TRIPOS> section, e.g. 'ATOM' or 'BOND', of (the first
+        molecule in) a mol2 file, yielding the fields of each line.
+    """
+    inSection = False
+    with open(mol2File, 'r') as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                if inSection:
+                    break
+                inSection = line.strip() == '@<TRIPOS>' + section
+                continue
+            if inSection:
+                fields = line.split()
+                if fields:
+                    yield fields
+
+
+def readMol2Atoms(mol2File):
+    """
+        Streams the @<TRIPOS>ATOM section of (the first molecule in) a mol2
+        file, yielding (atomId, atomName, (x, y, z), resName, charge) per
+        atom; resName is 'MOL' and charge 0.0 when not given.
+    """
+    for fields in readMol2Section(mol2File, 'ATOM'):
+        if len(fields) >= 6:
+            resName = 'MOL'
+            charge = 0.0
+            if len(fields) > 7:
+                resName = fields[7]
+            if len(fields) > 8:
+                charge = float(fields[8])
+            yield (int(fields[0]), fields[1],
+                   (float(fields[2]), float(fields[3]), float(fields[4])), resName, charge)
+
+
+def readMol2Graph(mol2File):
+    """
+        Returns the atom types (list) and the bonds ((n, 2) array of atom
+        indices in file order) of (the first molecule in) a mol2 file.
+    """
+    ids = {}
+    types = []
+    for fields in readMol2Section(mol2File, 'ATOM'):
+        if len(fields) >= 6:
+            ids[fields[0]] = len(types)
+            types.append(fields[5])
+    bonds = [(ids[fields[1]], ids[fields[2]]) for fields in readMol2Section(mol2File, 'BOND')
+             if len(fields) >= 3]
+    return types, np.array(bonds, dtype=int).reshape(-1, 2)
+
+
+def mol2GraphHash(mol2File, key=''):
+    """
+        Returns a hash of all but the charges in the ATOM and BOND sections
+        of a mol2 file (names, coordinates to 4 decimals, types, residues
+        and bonds), and of key, to tell when only charges changed.
+    """
+    sha = hashlib.sha1(key.encode())
+    for fields in readMol2Section(mol2File, 'ATOM'):
+        if len(fields) >= 6:
+            coords = ' '.join(['%.4f' % float(x) for x in fields[2:5]])
+            sha.update(('%s %s %s\n' % (fields[1], coords, ' '.join(fields[5:8]))).encode())
+    for fields in readMol2Section(mol2File, 'BOND'):
+        sha.update(('%s\n' % ' '.join(fields[1:4])).encode())
+    return sha.hexdigest()
+
+
+def patchMol2Charges(mol2File, charges):
+    """
+        Rewrites the charge column of the ATOM section of a mol2 file,
+        keeping its width.
+    """
+    lines = []
+    inSection = False
+    count = 0
+    with open(mol2File, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('@<TRIPOS>'):
+                inSection = line.strip() == '@<TRIPOS>ATOM'
+            elif inSection and len(line.split()) > 8:
+                field = re.search(r'\s*\S+\s*$', line).group()
+                line = line[:-len(field)] + '%*.6f' % (len(field.rstrip()), charges[count])
+                count += 1
+            lines.append(line)
+    if count != len(charges):
+        raise Exception("%i charges for %i atoms in '%s'" % (len(charges), count, mol2File))
+    writeAtomic(mol2File, lines)
+
+
+def patchPrmtopCharges(prmtopFile, charges):
+    """
+        Rewrites the CHARGE section of a prmtop file with charges (in units
+        of electron charge), formatted as tleap does.
+    """
+    with open(prmtopFile, 'r') as f:
+        lines = f.read().splitlines()
+    start = lines.index([l for l in lines if l.startswith('%FLAG CHARGE')][0]) + 2  # after %FORMAT
+    end = start
+    while end < len(lines) and not lines[end].startswith('%'):
+        end += 1
+    values = ['%16.8E' % (q * 18.2223) for q in charges]
+    if len(values) != len(''.join(lines[start:end]).split()):
+        raise Exception("%i charges for %i atoms in '%s'" % (len(values), len(''.join(lines[start:end]).split()),
+                                                             prmtopFile))
+    lines[start:end] = [''.join(values[i:i + 5]) for i in range(0, len(values), 5)]
+    writeAtomic(prmtopFile, lines)
+
+
+def estimateSizes(mol2File, fragment=0):
+    """
+        Returns the sizes of the molecule in a mol2 file that resources
+        scale with: atoms, bonds, angles and dihedrals (counted from the
+        bond graph, rings not excluded) and terms, their sum. With fragment
+        (see ACTopol.execFragment) also fragments, the atoms of each one.
+    """
+    types, bonds = readMol2Graph(mol2File)
+    nAtoms = len(types)
+    degree = np.bincount(bonds.ravel(), minlength=nAtoms)
+    sizes = {'atoms': nAtoms, 'bonds': len(bonds),
+             'angles': int((degree * (degree - 1) // 2).sum()),
+             'dihedrals': int(((degree[bonds[:, 0]] - 1) * (degree[bonds[:, 1]] - 1)).sum())}
+    sizes['terms'] = sizes['bonds'] + sizes['angles'] + sizes['dihedrals']
+    if fragment and nAtoms:
+        atoms = list(readMol2Atoms(mol2File))
+        elements = [mol2Element(t, atom[1]) for t, atom in zip(types, atoms)]
+        fragments = fragmentAtoms(atomClasses(elements, bonds, fragment), bonds, fragment)[0]
+        sizes['fragments'] = [len(f) for f in fragments]
+    return sizes
+
+
+def loadEstimateModel():
+    """
+        Returns the resources model, {stage: {'size': ..., 'time': [a, b],
+        'mem': [a, b]}}: the one shipped in estimateModelFile updated with
+        the stages refitted by the user (see fitEstimateModel). Stages never
+        fitted are missing.
+    """
+    model = {}
+    for modelFile in [estimateModelFile, os.path.join(acpypeCacheDir(), 'acpype_estimate.json')]:
+        if os.path.exists(modelFile):
+            with open(modelFile) as f:
+                model.update(json.load(f))
+    return model
+
+
+def estimateResources(sizes, chargeType='bcc', fragment=0, model=None):
+    """
+        Predicts, from the sizes of a molecule (see estimateSizes), the wall
+        time (s) and peak memory (MB) of each stage of an acpype run as a list
+        of (stage, time, memory, time of its longest tool run), None for the
+        stages the model has no data for. In fragment mode antechamber,
+        parmchk and tleap run on each fragment, in parallel when more than
+        one CPU.
+    """
+    if model is None:
+        model = loadEstimateModel()
+    acStage = 'antechamber:%s' % ('bcc' if chargeType == 'bcc' else 'gas')
+    stages = ['guessCharge', acStage, 'parmchk', 'tleap', 'MolTopol', 'CNS', 'GROMACS', 'CHARMM']
+    out = []
+    for stage in stages:
+        entry = model.get(stage)
+        if not entry:
+            out.append((stage, None, None, None))
+            continue
+        if stage in [acStage, 'parmchk', 'tleap'] and fragment and sizes.get('fragments'):
+            costs = [(entry['time'][0] * n ** entry['time'][1], entry['mem'][0] * n ** entry['mem'][1])
+                     for n in sizes['fragments']]
+            times = sorted([c[0] for c in costs], reverse=True)
+            nCpus = multiprocessing.cpu_count()
+            out.append((stage, max(times[0], sum(times) / nCpus), max([c[1] for c in costs]), times[0]))
+            continue
+        size = max(sizes[entry['size']], 1)
+        time_ = entry['time'][0] * size ** entry['time'][1]
+        out.append((stage, time_, entry['mem'][0] * size ** entry['mem'][1], time_))
+    return out
+
+
+def fitEstimateModel(reportFiles):
+    """
+        Fits the resources model (see estimateSizeOf) to acpype reports (see
+        AbstractTopol.writeReport) of successful runs, by least squares of
+        log(value) on log(size) per stage; with a single size, as linear.
+        Memory is the peak RSS of the tools, or of acpype for its own stages.
+        Returns the stages fitted.
+    """
+    data = {}
+    for reportFile in reportFiles:
+        with open(reportFile) as f:
+            report = json.load(f)
+        sizes = report.get('sizes')
+        if not sizes or report.get('failedStage'):
+            continue
+        for record in report['stages']:
+            stage = record['stage']
+            if stage == 'antechamber':
+                if report.get('fragment'):  # per fragment sizes unknown here
+                    continue
+                stage = 'antechamber:%s' % ('bcc' if report.get('chargeType') == 'bcc' else 'gas')
+            if stage not in estimateSizeOf:
+                continue
+            mem = record['toolsPeakRss'] or record['acpypePeakRss']
+            data.setdefault(stage, []).append((sizes[estimateSizeOf[stage]], record['wallTime'], mem))
+    model = {}
+    for stage, points in data.items():
+        points = np.array([p for p in points if min(p) > 0], dtype=float).reshape(-1, 3)
+        if not len(points):
+            continue
+        entry = {'size': estimateSizeOf[stage], 'points': len(points)}
+        for col, key in [(1, 'time'), (2, 'mem')]:
+            x, y = np.log(points[:, 0]), np.log(points[:, col])
+            if len(np.unique(x)) > 1:
+                b, loga = np.polyfit(x, y, 1)
+            else:
+                b = 1.0
+                loga = np.median(y - x)
+            entry[key] = [float(np.exp(loga)), float(b)]
+        model[stage] = entry
+    return model
+
+
+def mol2Element(atomType, atomName):
+    """
+        Element of a mol2 atom from its sybyl atom type (e.g. 'C.ar') or, for
+        other atom types (e.g. gaff), from its atom name.
+    """
+    element = atomType.split('.')[0]
+    if element[:1].isupper() and element.isalpha():
+        return element
+    match = re.match('[A-Za-z][a-z]?', atomName)
+    if match:
+        return match.group().capitalize()
+    return atomType
+
+
+def writeMol2(fileName, name, atoms, bonds):
+    """
+        Writes a single residue mol2 file, atoms being (atomName, (x, y, z),
+        atomType, resName, charge) and bonds (atom index, atom index, bond
+        type), with atom indices from 0.
+    """
+    out = ['@<TRIPOS>MOLECULE', name, '%5i %5i %5i %5i %5i' % (len(atoms), len(bonds), 1, 0, 0),
+           'SMALL', 'USER_CHARGES', '', '@<TRIPOS>ATOM']
+    for i, (atomName, (x, y, z), atomType, resName, charge) in enumerate(atoms):
+        out.append('%7i %-4s %14.4f %10.4f %10.4f %-6s %4i %-4s %10.6f'
+                   % (i + 1, atomName, x, y, z, atomType, 1, resName, charge))
+    out.append('@<TRIPOS>BOND')
+    for i, (a1, a2, bondType) in enumerate(bonds):
+        out.append('%6i %5i %5i %s' % (i + 1, a1 + 1, a2 + 1, bondType))
+    out += ['@<TRIPOS>SUBSTRUCTURE', '     1 %-4s        1 TEMP' % atoms[0][3] if atoms else '']
+    with open(fileName, 'w') as f:
+        f.write('\n'.join(out) + '\n')
+
+
+def findClosePairs(coords, cutoff):
+    """
+        Returns the pairs (i, j), i < j, of points in the (n, 3) array coords
+        closer than cutoff, as an (m, 2) array, and their squared distances.
+        Points are binned in a cell list with cells of size cutoff, so only
+        points in the same or adjacent cells are compared: linear time.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    n = len(coords)
+    cells = np.floor((coords - coords.min(axis=0)) / cutoff).astype(np.int64) if n else \
+        np.zeros((0, 3), dtype=np.int64)
+    dims = cells.max(axis=0) + 3 if n else np.ones(3, dtype=np.int64)
+    cells += 1  # so that neighbour cells are never negative
+
+    def cellIds(c):
+        return (c[:, 0] * dims[1] + c[:, 1]) * dims[2] + c[:, 2]
+
+    order = np.argsort(cellIds(cells), kind='mergesort')
+    occupied, start = np.unique(cellIds(cells)[order], return_index=True)
+    end = np.append(start[1:], n)
+    pairsList = []
+    dist2List = []
+    # each pair of adjacent cells is visited once: itself plus half of the 26
+    for offset in [(0, 0, 0)] + [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1)
+                                 for z in (-1, 0, 1) if (x, y, z) > (0, 0, 0)]:
+        ids = cellIds(cells + np.array(offset))
+        pos = np.minimum(np.searchsorted(occupied, ids), len(occupied) - 1)
+        found = np.flatnonzero(occupied[pos] == ids) if n else np.zeros(0, dtype=int)
+        counts = end[pos[found]] - start[pos[found]]
+        first = np.repeat(start[pos[found]] - np.cumsum(counts) + counts, counts)
+        ii = np.repeat(found, counts)
+        jj = order[first + np.arange(counts.sum())]
+        if offset == (0, 0, 0):
+            keep = ii < jj
+            ii, jj = ii[keep], jj[keep]
+        dist2 = ((coords[ii] - coords[jj]) ** 2).sum(axis=1)
+        close = dist2 < cutoff ** 2
+        pairsList.append(np.column_stack((np.minimum(ii, jj), np.maximum(ii, jj)))[close])
+        dist2List.append(dist2[close])
+    return np.concatenate(pairsList).astype(int), np.concatenate(dist2List)
+
+
+def packQuartets(quartets, nAtoms):
+    """
+        Returns an int64 key per row of an (n, m) array of atom indices
+        (m <= 4) that sorts like the rows themselves. Rows are packed in base
+        nAtoms when it fits in int64, otherwise ranked with np.unique.
+    """
+    quartets = np.asarray(quartets, dtype=np.int64)
+    nCols = quartets.shape[1]
+    if nAtoms ** nCols < 2 ** 63:
+        keys = np.zeros(len(quartets), dtype=np.int64)
+        for col in range(nCols):
+            keys = keys * nAtoms + quartets[:, col]
+        return keys
+    return np.unique(quartets, axis=0, return_inverse=True)[1].ravel()
+
+
+def bondAdjacency(bonds, nAtoms):
+    """
+        Returns the bond graph of a (n, 2) array of atom indices as a CSR
+        adjacency (indptr, indices): the neighbours of atom i are
+        indices[indptr[i]:indptr[i + 1]], in the order of the bonds list.
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    # each bond seen from both ends, kept in bond order by a stable sort
+    ii = bonds.ravel()
+    jj = bonds[:, ::-1].ravel()
+    order = np.argsort(ii, kind='mergesort')
+    indptr = np.zeros(nAtoms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ii, minlength=nAtoms), out=indptr[1:])
+    return indptr, jj[order]
+
+
+def bondExclusions(adjacency, depth=3):
+    """
+        Returns, as a CSR (indptr, indices, distances), the atoms j > i up to
+        depth bonds away from each atom i of a CSR adjacency (see
+        bondAdjacency), sorted, with the number of bonds of the shortest path
+        between them: the Amber excluded atoms with depth 3, the 1-4 pairs
+        being those at distance 3, whatever the rings. All walks of up to
+        depth bonds are enumerated at once, a bond at a time.
+    """
+    indptr, indices = adjacency
+    nAtoms = len(indptr) - 1
+    starts = ends = np.arange(nAtoms, dtype=np.int64)
+    keys = []
+    dists = []
+    for dist in range(1, depth + 1):
+        counts = indptr[ends + 1] - indptr[ends]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        starts = np.repeat(starts, counts)
+        ends = indices[np.repeat(indptr[ends], counts) + offsets]
+        keys.append(starts[ends > starts] * nAtoms + ends[ends > starts])
+        dists.append(np.full(len(keys[-1]), dist, dtype=np.int8))
+    if keys:
+        # first occurrence is the shortest walk, keys being in walk length order
+        keys, first = np.unique(np.concatenate(keys), return_index=True)
+        dists = np.concatenate(dists)[first]
+    else:
+        keys = np.zeros(0, dtype=np.int64)
+        dists = np.zeros(0, dtype=np.int8)
+    excl = np.zeros(nAtoms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // nAtoms, minlength=nAtoms), out=excl[1:])
+    return excl, keys % nAtoms, dists
+
+
+def atomElement(mass):
+    """
+        Returns the entry of elementData of the element of mass (within 0.1)
+        or (0, mass, 1.5, 0.8) if none.
+    """
+    for entry in elementData:
+        if abs(entry[1] - mass) < 0.1:
+            return entry
+    return (0, mass, 1.5, 0.8)
+
+
+def prmtopSection(flag, fmt, values):
+    """
+        Returns the lines of a prmtop %FLAG section with values formatted as
+        fmt, one of '10I8', '5E16.8', '20a4' or '1a80', all at once and cut
+        in fixed-width lines.
+    """
+    perLine, kind, width = re.match(r'(\d+)([aIE])(\d+)', fmt).groups()
+    perLine, width = int(perLine), int(width)
+    values = list(values)
+    if kind == 'I':
+        text = (('%%%id' % width) * len(values)) % tuple(values)
+    elif kind == 'E':
+        text = ('%16.8E' * len(values)) % tuple(values)
+    else:
+        text = ''.join(['%-*s' % (width, v[:width]) for v in values])
+    size = perLine * width
+    return (['%-80s' % ('%FLAG ' + flag), '%-80s' % ('%FORMAT(' + fmt + ')')] +
+            ([text[i:i + size] for i in range(0, len(text), size)] or ['']))
+
+
+def bondDistances(adjacency, sources, maxDepth=None):
+    """
+        Returns the number of bonds from the nearest of atoms sources to
+        every atom of a CSR adjacency (see bondAdjacency), -1 for those not
+        reached (within maxDepth), by a breadth first search a shell at a time.
+    """
+    indptr, indices = adjacency
+    dist = -np.ones(len(indptr) - 1, dtype=np.int64)
+    front = np.unique(np.asarray(sources, dtype=np.int64))
+    dist[front] = 0
+    depth = 0
+    while len(front) and (maxDepth is None or depth < maxDepth):
+        depth += 1
+        starts, counts = indptr[front], indptr[front + 1] - indptr[front]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        nbrs = indices[np.repeat(starts, counts) + offsets]
+        front = np.unique(nbrs[dist[nbrs] < 0])
+        dist[front] = depth
+    return dist
+
+
+def atomClasses(labels, bonds, radius):
+    """
+        Returns class ids of the atoms with initial labels (e.g. elements) and
+        bonds (a (n, 2) array of atom indices) such that atoms in a class have
+        the same labels up to radius bonds away. Labels are refined radius
+        times with the multiset of the neighbour labels, hashed as sums of
+        random 64-bit weights, in linear time.
+    """
+    labels = np.unique(np.asarray(labels), return_inverse=True)[1].ravel()
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    ii = bonds.ravel()
+    jj = bonds[:, ::-1].ravel()
+    rand = np.random.RandomState(len(labels))
+    for _ in range(radius):
+        nLabels = int(labels.max()) + 1 if len(labels) else 0
+        own = rand.randint(0, 2 ** 52, size=nLabels).astype(np.int64)
+        nbr = rand.randint(0, 2 ** 52, size=nLabels).astype(np.int64)
+        key = own[labels] * 8
+        np.add.at(key, ii, nbr[labels[jj]])
+        labels = np.unique(key, return_inverse=True)[1].ravel()
+    return labels
+
+
+def fragmentAtoms(classes, bonds, radius):
+    """
+        Returns fragments (list of sorted atom index arrays) together holding,
+        for each class of atoms (see atomClasses), one representative with
+        all atoms up to radius bonds away, and the representative of each
+        class. Representatives are the atoms of each class nearest (in bonds)
+        to the first atom, grouped in a fragment with the others up to radius
+        bonds away, so fragments are compact and small, e.g. for a CNT a rim
+        with its functional groups, then interior rings.
+    """
+    classes = np.asarray(classes)
+    nAtoms = len(classes)
+    adjacency = bondAdjacency(bonds, nAtoms)
+    dist = bondDistances(adjacency, [0])
+    dist[dist < 0] = nAtoms  # other molecules last
+    order = np.lexsort((np.arange(nAtoms), dist))
+    reps = order[np.unique(classes[order], return_index=True)[1]]
+    repOrder = reps[np.argsort(dist[reps], kind='mergesort')]
+    grouped = np.zeros(nAtoms, dtype=bool)
+    fragments = []
+    for rep in repOrder.tolist():
+        if grouped[rep]:
+            continue
+        near = bondDistances(adjacency, [rep], radius) >= 0
+        group = repOrder[near[repOrder] & ~grouped[repOrder]]
+        grouped[group] = True
+        fragments.append(np.flatnonzero(bondDistances(adjacency, group, radius) >= 0))
+    return fragments, reps
+
+
+def capFragment(frag, atoms, types, bonds, bondTypes):
+    """
+        Returns the atoms and bonds, as for writeMol2, of the fragment with
+        atoms frag (indices) of a molecule given as read by readMol2Atoms,
+        readMol2Graph and its bond types, with hydrogens capping the bonds cut
+        along them, and the atoms capped (indices, one per cap).
+    """
+    position = -np.ones(len(atoms), dtype=int)
+    position[frag] = np.arange(len(frag))
+    fragAtoms = [(atoms[i][1], atoms[i][2], types[i], atoms[i][3], atoms[i][4]) for i in frag]
+    fragBonds = []
+    capped = []
+    for (i, j), bondType in zip(np.asarray(bonds).tolist(), bondTypes):
+        if position[i] >= 0 and position[j] >= 0:
+            fragBonds.append((position[i], position[j], bondType))
+            continue
+        if position[j] >= 0:
+            i, j = j, i
+        elif position[i] < 0:
+            continue
+        xyz, vec = np.array(atoms[i][2]), np.array(atoms[j][2]) - np.array(atoms[i][2])
+        length = 1.09 if mol2Element(types[i], atoms[i][1]) == 'C' else 1.01
+        fragBonds.append((position[i], len(fragAtoms), '1'))
+        fragAtoms.append(('HX%i' % (len(capped) + 1), tuple((xyz + vec * length / np.sqrt((vec ** 2).sum())).tolist()),
+                          'H', atoms[i][3], 0.0))
+        capped.append(i)
+    return fragAtoms, fragBonds, capped
+
+
+def bondTerms(bonds, nAtoms):
+    """
+        Returns the angles, proper dihedrals and improper candidates of a
+        molecule of nAtoms with bonds, a (n, 2) array of atom indices, as
+        (n, 3), (n, 4) and (n, 4) arrays of atom indices, each term once.
+        Terms are enumerated with numpy over the CSR adjacency, a neighbour
+        offset at a time. Impropers are the atoms with 3 bonds, third, with
+        their neighbours around in bond order.
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    if not len(bonds):
+        return [np.zeros((0, n), dtype=np.int64) for n in [3, 4, 4]]
+    indptr, nbr = bondAdjacency(bonds, nAtoms)
+    degree = np.diff(indptr)
+    src = np.repeat(np.arange(nAtoms), degree)
+    pos = np.arange(len(nbr))
+    maxDegree = int(degree.max())
+
+    angles = []
+    end = indptr[src + 1]
+    for s in range(1, maxDegree):
+        p = pos[pos + s < end]
+        angles.append(np.column_stack((nbr[p], src[p], nbr[p + s])))
+
+    dihedrals = []
+    central = pos[src < nbr]
+    j, k = src[central], nbr[central]
+    for s in range(maxDegree):
+        pi = indptr[j] + s
+        okI = pi < indptr[j + 1]
+        for t in range(maxDegree):
+            pl = indptr[k] + t
+            ok = okI & (pl < indptr[k + 1])
+            i = nbr[np.where(ok, pi, 0)]
+            l = nbr[np.where(ok, pl, 0)]
+            ok &= (i != k) & (l != j) & (i != l)
+            dihedrals.append(np.column_stack((i, j, k, l))[ok])
+
+    centers = np.nonzero(degree == 3)[0]
+    outer = nbr[indptr[centers][:, None] + np.arange(3)]
+    impropers = np.column_stack((outer[:, :2], centers, outer[:, 2]))
+    return [np.concatenate(angles).reshape(-1, 3) if angles else np.zeros((0, 3), dtype=np.int64),
+            np.concatenate(dihedrals).reshape(-1, 4), impropers.reshape(-1, 4)]
+
+
+def classCharges(classes, fragments, capped, fragCharges, adjacency, netCharge=0):
+    """
+        Returns the charges of the atoms of a molecule of CSR adjacency (see
+        bondAdjacency), averaged per class (see atomClasses) over the atoms
+        of fragments (see fragmentAtoms) of charges fragCharges, but those
+        next to the atoms capped in each (see capFragment), and the atoms of
+        the classes only found there, averaged there. Charges are shifted to
+        netCharge and rounded as written in mol2, NaN if a class has none.
+    """
+    classes = np.asarray(classes)
+    nClasses = int(classes.max()) + 1 if len(classes) else 0
+    sums = np.zeros(nClasses)
+    counts = np.zeros(nClasses)
+    nearSums = np.zeros(nClasses)  # atoms next to caps, if a class has no other
+    nearCounts = np.zeros(nClasses)
+    for frag, cap, charges in zip(fragments, capped, fragCharges):
+        deep = bondDistances(adjacency, cap, 1)[frag] < 0
+        charges = np.asarray(charges, dtype=float)
+        np.add.at(sums, classes[frag[deep]], charges[deep])
+        np.add.at(counts, classes[frag[deep]], 1)
+        np.add.at(nearSums, classes[frag[~deep]], charges[~deep])
+        np.add.at(nearCounts, classes[frag[~deep]], 1)
+    near = counts == 0
+    sums[near] = nearSums[near]
+    counts[near] = nearCounts[near]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        charges = (sums / counts)[classes]
+    charges += (netCharge - charges.sum()) / max(len(classes), 1)
+    # as written in mol2, rounding drift on the biggest charge
+    charges = np.round(charges, 6)
+    if len(charges):
+        charges[np.argmax(np.abs(charges))] += netCharge - charges.sum()
+    return charges, near[classes]
+
+
+def uniqueTermTypes(typeIds, bonds):
+    """
+        Returns the unique bond, angle, proper and improper dihedral type
+        tuples, as (n, 2), (n, 3), (n, 4) and (n, 4) arrays of the type ids,
+        of a molecule with atom type ids typeIds and bonds, a (n, 2) array of
+        atom indices, its terms enumerated by bondTerms, so only the unique
+        tuples are left for the caller. Bonds, angles and dihedrals are
+        oriented to their lesser form; impropers (atoms with 3 bonds) have
+        the central atom third and the outer ones sorted.
+    """
+    typeIds = np.asarray(typeIds, dtype=np.int64)
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    nAtoms = len(typeIds)
+    nTypes = int(typeIds.max()) + 1 if nAtoms else 1
+    angles, dihedrals, impropers = bondTerms(bonds, nAtoms)
+
+    def unique(terms):
+        t = typeIds[terms]
+        rev = t[:, ::-1]
+        t = np.where((packQuartets(rev, nTypes) < packQuartets(t, nTypes))[:, None], rev, t)
+        return t[np.unique(packQuartets(t, nTypes), return_index=True)[1]]
+
+    outer = np.sort(typeIds[impropers[:, [0, 1, 3]]], axis=1)
+    impropers = np.column_stack((outer[:, :2], typeIds[impropers[:, 2]], outer[:, 2]))
+    impropers = impropers[np.unique(packQuartets(impropers, nTypes), return_index=True)[1]]
+
+    return [unique(bonds), unique(angles), unique(dihedrals), impropers]
+
+
+def assembleTopol(fragTops, names, types, charges, coords, bonds, resName, baseName):
+    """
+        Returns the header and arrays (see arraysTopol) of the topology of a
+        molecule of atoms names, types, charges (e) and coords with bonds, a
+        (n, 2) array of atom indices, from the parameters of fragTops,
+        MolTopols of fragments of it run through tleap, looked up by atom
+        types as tleap does: bonds, angles and proper dihedrals of all the
+        bonded atoms (see bondTerms), impropers on the atoms with 3 bonds
+        whose types had one in a fragment (outer atoms as there, by type and
+        then index), masses and LJ coefficients of the types, by the
+        Lorentz-Berthelot rule for pairs not seen in a fragment, types of
+        same LJ merged. 1-4 pairs are the atoms 3 bonds apart. Raises if a
+        term or type has no parameters in the fragments.
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    nAtoms = len(names)
+    registry = {}
+    typeIds = np.array([registry.setdefault(t, len(registry)) for t in types], dtype=np.int64)
+    typeNames = sorted(registry, key=registry.get)
+    nTypes = len(typeNames)
+
+    def typeKey(term):
+        key = tuple([a.atomType.atomTypeName for a in term.atoms])
+        return min(key, key[::-1])
+
+    # parameters by type names, terms the lesser way round
+    tables = {'bond': {}, 'angle': {}, 'proper': {}}
+    impropers = {}  # (central type, sorted outer types): (outer types, terms)
+    masses = {}
+    ljPairs = {}  # (type, type): (ACOEF, BCOEF, 10-12)
+    for top in fragTops:
+        for bond in top.bonds:
+            tables['bond'].setdefault(typeKey(bond), [(bond.kBond, bond.rEq)])
+        for angle in top.angles:
+            tables['angle'].setdefault(typeKey(angle), [(angle.kTheta, angle.thetaEq)])
+        for group in top.condensedProperDihedrals:
+            tables['proper'].setdefault(typeKey(group[0]), [(d.kPhi, d.period, d.phase) for d in group])
+        for dih in top.improperDihedrals:
+            key = [a.atomType.atomTypeName for a in dih.atoms]
+            outer = key[:2] + key[3:]
+            impropers.setdefault((key[2], tuple(sorted(outer))), (outer, [(dih.kPhi, dih.period, dih.phase)]))
+        fragTypes = [t.atomTypeName for t in top.atomTypes]
+        for atomType in top.atomTypes:
+            masses.setdefault(atomType.atomTypeName, atomType.mass)
+        ljIds = np.asarray(top.atomTypeLJIds)
+        for (i, t1), (j, t2) in itertools.product(enumerate(fragTypes), repeat=2):
+            ljPairs.setdefault((t1, t2), (float(top.ljACOEFs[ljIds[i], ljIds[j]]),
+                                          float(top.ljBCOEFs[ljIds[i], ljIds[j]]),
+                                          bool(top.ljHBondPairs[ljIds[i], ljIds[j]])))
+    missing = [t for t in typeNames if t not in masses]
+
+    def lookup(kind, terms, width):
+        """atoms and parameters of terms, a row per parameter set, and the term of each row"""
+        _uniq, first, inverse = np.unique(packQuartets(typeIds[terms], max(nTypes, 1)),
+                                          return_index=True, return_inverse=True)
+        entries = []
+        for f in first.tolist():
+            key = tuple([typeNames[i] for i in typeIds[terms[f]].tolist()])
+            key = min(key, key[::-1])
+            if key not in tables[kind]:
+                missing.append('-'.join(key))
+            entries.append(tables[kind].get(key, []))
+        sizes = np.array([len(e) for e in entries], dtype=np.int64)
+        values = np.array([p for e in entries for p in e], dtype=np.float64).reshape(-1, width)
+        inverse = inverse.ravel()
+        counts = sizes[inverse]
+        termIds = np.repeat(np.arange(len(terms)), counts)
+        rows = np.repeat((np.cumsum(sizes) - sizes)[inverse], counts) + \
+            np.arange(len(termIds)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return terms[termIds], values[rows], termIds
+
+    angles, dihedrals, centres = bondTerms(bonds, nAtoms)
+    bondAtoms, bondValues, _ids = lookup('bond', bonds, 2)
+    angleAtoms, angleValues, _ids = lookup('angle', angles, 2)
+    properAtoms, properValues, properGroups = lookup('proper', dihedrals, 3)
+    if missing:
+        raise Exception("no parameters in the fragments for %i types or terms, consider bigger fragments: %s"
+                        % (len(missing), ' '.join(missing[:20])))
+
+    improperAtoms = []
+    improperValues = []
+    for row in centres.tolist():
+        outer = sorted(row[:2] + row[3:])
+        key = (types[row[2]], tuple(sorted([types[i] for i in outer])))
+        if key not in impropers:
+            continue
+        order, terms = impropers[key]
+        quartet = []
+        for t in order:
+            atom = [i for i in outer if types[i] == t][0]
+            outer.remove(atom)
+            quartet.append(atom)
+        for term in terms:
+            improperAtoms.append(quartet[:2] + [row[2]] + quartet[2:])
+            improperValues.append(term)
+    improperValues = np.array(improperValues, dtype=np.float64).reshape(-1, 3)
+
+    # LJ of the types, pairs not seen together by Lorentz-Berthelot (see Atom)
+    diag = np.array([ljPairs[(t, t)][:2] for t in typeNames], dtype=np.float64).reshape(-1, 2)
+    has = (diag > 0).all(axis=1)
+    safe = np.where(has[:, None], diag, 1.0)
+    r0 = np.where(has, 0.5 * (2 * safe[:, 0] / safe[:, 1]) ** (1 / 6.0), 0.0)
+    eps = np.where(has, safe[:, 1] ** 2 / (4 * safe[:, 0]), 0.0)
+    epsIJ = np.sqrt(np.outer(eps, eps))
+    rIJ = np.add.outer(r0, r0)
+    ljA = epsIJ * rIJ ** 12
+    ljB = 2 * epsIJ * rIJ ** 6
+    hBond = np.zeros((nTypes, nTypes), dtype=bool)
+    for (i, t1), (j, t2) in itertools.product(enumerate(typeNames), repeat=2):
+        if (t1, t2) in ljPairs:
+            ljA[i, j], ljB[i, j], hBond[i, j] = ljPairs[(t1, t2)]
+    # as tleap, one LJ type for the types of same coefficients
+    ljRegistry = {}
+    typeLJIds = np.array([ljRegistry.setdefault((tuple(ljA[i]), tuple(ljB[i]), tuple(hBond[i])), len(ljRegistry))
+                          for i in range(nTypes)], dtype=np.int64)
+    _uniq, keep = np.unique(typeLJIds, return_index=True)
+    ljA, ljB, hBond = [m[np.ix_(keep, keep)] for m in (ljA, ljB, hBond)]
+
+    excl, exclIds, dists = bondExclusions(bondAdjacency(bonds, nAtoms))
+    is14 = dists == 3
+    arrays = {'atomNames': np.array(names, dtype=np.str_),
+              'atomTypeIds': typeIds.astype(np.int32),
+              'atomResids': np.zeros(nAtoms, dtype=np.int32),
+              'atomMasses': np.array([masses[t] for t in types], dtype=np.float64),
+              'atomCharges': np.array(charges, dtype=np.float64),
+              'atomCoords': np.array(coords, dtype=np.float64).reshape(-1, 3),
+              'atomIds': np.arange(1, nAtoms + 1, dtype=np.int64),
+              'atomCgnrs': np.arange(1, nAtoms + 1, dtype=np.int64),
+              'atomOrder': np.arange(nAtoms, dtype=np.int64),
+              'typeNames': np.array(typeNames, dtype=np.str_),
+              'typeMasses': np.array([masses[t] for t in typeNames], dtype=np.float64),
+              'typeLJIds': typeLJIds,
+              'atomLJIds': typeLJIds[typeIds],
+              'ljACOEFs': ljA, 'ljBCOEFs': ljB, 'ljHBondPairs': hBond,
+              'bondAtoms': bondAtoms, 'bondKs': bondValues[:, 0], 'bondREqs': bondValues[:, 1],
+              'angleAtoms': angleAtoms, 'angleKs': angleValues[:, 0], 'angleThetaEqs': angleValues[:, 1],
+              'properGroups': properGroups,
+              'pairAtoms': np.column_stack((np.repeat(np.arange(nAtoms), np.diff(excl))[is14], exclIds[is14])),
+              'exclusionAtoms': np.zeros((0, 2), dtype=np.int64)}
+    for key, atoms_, values in [('proper', properAtoms, properValues),
+                                ('improper', np.array(improperAtoms, dtype=np.int64).reshape(-1, 4), improperValues)]:
+        arrays[key + 'Atoms'] = atoms_
+        arrays[key + 'KPhis'] = values[:, 0]
+        arrays[key + 'Periods'] = values[:, 1].astype(np.int32)
+        arrays[key + 'Phases'] = values[:, 2]
+    header = {'baseName': baseName, 'inputFile': baseName + '.mol2', 'sorted': False, 'hmrMass': None,
+              'residueLabel': [resName], 'atomTypeSystem': 'gaff' if types[0][0].islower() else 'amber',
+              'totalCharge': int(round(float(np.sum(charges)))), 'pbc': None}
+    return header, arrays
+
+
+def formatLines(task):
+    """
+        Formats a chunk of rows of a topology section, task being a tuple
+        (format, fields, rows), where fields are the indexes of the row items
+        used by format (all if None).
+    """
+    fmt, fields, rows = task
+    if fields is None:
+        return ''.join([fmt % row for row in rows])
+    get = operator.itemgetter(*fields)
+    return ''.join([fmt % get(row) for row in rows])
+
+
+class TextStream(object):
+
+    """
+        A text file written as it is built, through the append and += of the
+        list of lines it replaces; with no fileName, the text is dropped.
+    """
+
+    def __init__(self, fileName=None):
+        self.file = fileName and open(fileName, 'w')
+
+    def append(self, text):
+        if self.file:
+            self.file.write(text)
+
+    def __iadd__(self, lines):
+        for text in lines:
+            self.append(text)
+        return self
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def writeTasks(tasks, pool=None):
+    """
+        Formats tasks, a list of (TextStream, formatLines task), appending
+        each text to its stream in order as soon as it comes: by pool.imap,
+        concurrently, if a pool is given and there is more than a task.
+    """
+    if pool and len(tasks) > 1:
+        texts = pool.imap(formatLines, [task for stream, task in tasks])
+    else:
+        texts = (formatLines(task) for stream, task in tasks)
+    for stream, task in tasks:
+        stream.append(next(texts))
+
+
+def forkContext():
+    """
+        The multiprocessing context that forks, so writers and subjobs start
+        with the parent's topology objects instead of pickling them (Python
+        3.14 defaults to forkserver on Linux); the module itself before 3.4.
+    """
+    if hasattr(multiprocessing, 'get_context') and 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def runWriter(obj, method, conn=None, name=None):
+    """
+        Runs the writer method of obj as stage name (see AbstractTopol.stage),
+        returning its wall time, the simple attributes (strings and numbers)
+        it set and the stage record. When run in a child process the result
+        is sent through conn, with None as time and the error message if the
+        writer failed.
+    """
+    before = dict(obj.__dict__)
     try:
-        o = str(out.decode())
+        with obj.stage(name or method) as record:
+            getattr(obj, method)()
     except:
-        o = str(out)
-    return o
+        if conn is None:
+            raise
+        conn.send((None, str(sys.exc_info()[1]), None))
+        return
+    attrs = dict([(k, v) for k, v in obj.__dict__.items()
+                  if isinstance(v, (str, int, float)) and before.get(k) is not v])
+    result = (record['wallTime'], attrs, record)
+    if conn is None:
+        return result
+    conn.send(result)
+
+
+class LazyAttribute(object):
+
+    """
+        Topology attribute built on first access by calling the given method,
+        which has to set it (and, often, related attributes) on the instance.
+        Once set, the instance attribute takes precedence over this descriptor.
+    """
+
+    def __init__(self, name, method):
+        self.name = name
+        self.method = method
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        getattr(obj, self.method)()
+        return obj.__dict__[self.name]
 
 
 class AbstractTopol(object):
@@ -568,6 +1907,77 @@ class AbstractTopol(object):
             print(text)
             print(10 * '+' + 'end_quote' + 61 * '+')
 
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+            Records a stage of the job, run in a with statement, into
+            self.stages: its wall time, CPU time (of acpype and of the tools
+            it ran, in s), peak RSS (MB) of the tools process trees (see
+            execTool) and of acpype so far. See writeReport.
+        """
+        if not hasattr(self, 'stages'):
+            self.stages = []
+        record = {'stage': name, 'toolsPeakRss': 0.0}
+        outer = getattr(self, 'currentStage', None)
+        self.currentStage = record
+        t0 = time.time()
+        own0, children0 = resourceUsage()[:2]
+        try:
+            yield record
+        except:
+            record['error'] = str(sys.exc_info()[1])
+            raise
+        finally:
+            own, children, peakRss = resourceUsage()
+            record['wallTime'] = round(time.time() - t0, 3)
+            record['cpuTime'] = round(own - own0 + children - children0, 3)
+            record['toolsPeakRss'] = round(record['toolsPeakRss'], 1)
+            record['acpypePeakRss'] = round(peakRss, 1)
+            self.stages.append(record)
+            self.currentStage = outer
+            if outer:
+                outer['toolsPeakRss'] = max(outer['toolsPeakRss'], record['toolsPeakRss'])
+
+    def writeReport(self):
+        """
+            Writes the stages recorded (see stage) in a JSON report, next to
+            the output files, with the (innermost) stage that failed, if any.
+        """
+        reportFile = os.path.join(getattr(self, 'absHomeDir', ''), self.baseName + '_report.json')
+        stages = getattr(self, 'stages', [])
+        failed = [s['stage'] for s in stages if 'error' in s]
+        report = {'baseName': self.baseName, 'date': datetime.now().ctime(),
+                  'chargeType': getattr(self, 'chargeType', None),
+                  'fragment': getattr(self, 'fragment', 0), 'stages': stages,
+                  'failedStage': failed[0] if failed else None}
+        # sizes for fitEstimateModel
+        mol2File = os.path.join(getattr(self, 'absHomeDir', ''), getattr(self, 'inputFile', ''))
+        if mol2File.endswith('.mol2') and os.path.exists(mol2File):
+            report['sizes'] = estimateSizes(mol2File)
+        elif 'condensedProperDihedrals' in self.__dict__:  # a prmtop parsed, amb2gmx mode
+            sizes = {'atoms': len(self.atoms), 'bonds': len(self.bonds), 'angles': len(self.angles),
+                     'dihedrals': len(self.condensedProperDihedrals)}
+            sizes['terms'] = sizes['bonds'] + sizes['angles'] + sizes['dihedrals']
+            report['sizes'] = sizes
+        with open(reportFile, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        self.printDebug("report written to '%s'" % reportFile)
+
+    def execTool(self, cmd, logFile=None):
+        """
+            Runs an external tool (see runTool) within the time (timeTol) and
+            memory (maxMem) limits of the job, returning its output. Raises an
+            exception if it ran out of time.
+        """
+        code, out = runTool(cmd, self.timeTol, getattr(self, 'maxMem', None), logFile,
+                            usage=getattr(self, 'currentStage', None))
+        if code is None:
+            tool = os.path.basename(shlex.split(cmd)[0])
+            self.printMess("Timed out! Process '%s' killed, max exec time (%ss) exceeded"
+                           % (tool, self.timeTol))
+            raise Exception("%s taking too long to finish... aborting!" % tool)
+        return out
+
     def guessCharge(self):
         """
             Guess the charge of a system based on antechamber
@@ -599,7 +2009,7 @@ class AbstractTopol(object):
                 cmd = '%s -ipdb %s -omol2 %s.mol2' % (self.babelExe, self.inputFile,
                                                       self.baseName)
                 self.printDebug("guessCharge: " + cmd)
-                out = _getoutput(cmd)
+                out = self.execTool(cmd)
                 self.printDebug(out)
                 mol2FileForGuessCharge = os.path.abspath(self.baseName + ".mol2")
                 in_mol = 'mol2'
@@ -616,7 +2026,7 @@ class AbstractTopol(object):
                 cmd = cmd.replace('-pf y', '-pf n')
                 print(cmd)
 
-            log = _getoutput(cmd).strip()
+            log = self.execTool(cmd).strip()
 
             if os.path.exists('tmp'):
                 charge = self.readMol2TotalCharge('tmp')
@@ -658,35 +2068,40 @@ class AbstractTopol(object):
         os.chdir(self.tmpDir)
 
         exten = self.ext[1:]
-        if self.ext == '.pdb':
-            tmpFile = open(self.inputFile, 'r')
+        if self.ext == '.mol2':
+            # read natively, as (residue, atom, coords) like in an ac file
+            atoms = [(resName[:3], "ATOM  %5i  %-4s" % (atomId, atomName),
+                      "%8.3f%8.3f%8.3f" % xyz)
+                     for atomId, atomName, xyz, resName, _charge in readMol2Atoms(self.inputFile)]
         else:
-            if exten == 'mol':
-                exten = 'mdl'
-            cmd = '%s -i %s -fi %s -o tmp -fo ac -pf y' % \
-                (self.acExe, self.inputFile, exten)
-            self.printDebug(cmd)
-            out = _getoutput(cmd)
-            if not out.isspace():
-                self.printDebug(out)
-            try:
-                tmpFile = open('tmp', 'r')
-            except:
-                rmtree(self.tmpDir)
-                raise
+            if self.ext == '.pdb':
+                tmpFile = open(self.inputFile, 'r')
+            else:
+                if exten == 'mol':
+                    exten = 'mdl'
+                cmd = '%s -i %s -fi %s -o tmp -fo ac -pf y' % \
+                    (self.acExe, self.inputFile, exten)
+                self.printDebug(cmd)
+                out = self.execTool(cmd)
+                if not out.isspace():
+                    self.printDebug(out)
+                try:
+                    tmpFile = open('tmp', 'r')
+                except:
+                    rmtree(self.tmpDir)
+                    raise
+            atoms = [(line[17:20], line[0:17], line[30:54]) for line in tmpFile
+                     if 'ATOM  ' in line or 'HETATM' in line]
+            tmpFile.close()
 
-        tmpData = tmpFile.readlines()
         residues = set()
         coords = {}
-        for line in tmpData:
-            if 'ATOM  ' in line or 'HETATM' in line:
-                residues.add(line[17:20])
-                at = line[0:17]
-                cs = line[30:54]
-                if cs in coords:
-                    coords[cs].append(at)
-                else:
-                    coords[cs] = [at]
+        for resName, at, cs in atoms:
+            residues.add(resName)
+            if cs in coords:
+                coords[cs].append(at)
+            else:
+                coords[cs] = [at]
         # self.printDebug(coords)
 
         if len(residues) > 1:
@@ -697,32 +2112,26 @@ class AbstractTopol(object):
         dups = ""
         shortd = ""
         longd = ""
-        longSet = set()
-        id_ = 0
         items = list(coords.items())
         l = len(items)
         for item in items:
-            id_ += 1
             if len(item[1]) > 1:  # if True means atoms with same coordinates
                 for i in item[1]:
                     dups += "%s %s\n" % (i, item[0])
 
-#        for i in xrange(0,len(data),f):
-#            fdata += (data[i:i+f])+' '
-
-            for id2 in range(id_, l):
-                item2 = items[id2]
-                c1 = list(map(float, [item[0][i:i + 8] for i in range(0, 24, 8)]))
-                c2 = list(map(float, [item2[0][i:i + 8] for i in range(0, 24, 8)]))
-                dist2 = self.distance(c1, c2)
-                if dist2 < minDist2:
-                    dist = math.sqrt(dist2)
-                    shortd += "%8.5f       %s %s\n" % (dist, item[1], item2[1])
-                if dist2 < maxDist2:  # and not longOK:
-                    longSet.add(str(item[1]))
-                    longSet.add(str(item2[1]))
-            if str(item[1]) not in longSet and l > 1:
-                longd += "%s\n" % item[1]
+        # neighbours within maxDist from a cell list, reported by item order
+        xyz = [[float(item[0][i:i + 8]) for i in range(0, 24, 8)] for item in items]
+        pairs, dist2s = findClosePairs(xyz, maxDist)
+        order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+        for (id1, id2), dist2 in zip(pairs[order].tolist(), dist2s[order].tolist()):
+            if dist2 < minDist2:
+                dist = math.sqrt(dist2)
+                shortd += "%8.5f       %s %s\n" % (dist, items[id1][1], items[id2][1])
+        if l > 1:
+            alone = np.ones(l, dtype=bool)
+            alone[pairs.ravel()] = False
+            for id_ in np.flatnonzero(alone).tolist():
+                longd += "%s\n" % items[id_][1]
 
         if dups:
             self.printError("Atoms with same coordinates in '%s'!" % self.inputFile)
@@ -796,34 +2205,14 @@ class AbstractTopol(object):
 
     def distance(self, c1, c2):
         # print c1, c2
-        dist2 = (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2 + (c1[0] - c2[0]) ** 2 + \
-                (c1[2] - c2[2]) ** 2
+        dist2 = (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2 + (c1[2] - c2[2]) ** 2
         # dist2 = math.sqrt(dist2)
         return dist2
 
     def readMol2TotalCharge(self, mol2File):
         """Reads the charges in given mol2 file and returns the total
         """
-        charge = 0.0
-        ll = []
-        cmd = '%s -i %s -fi mol2 -o tmp -fo mol2 -c wc -cf tmp.crg -pf y' % \
-            (self.acExe, mol2File)
-        if self.debug:
-            self.printMess("Debugging...")
-            cmd = cmd.replace('-pf y', '-pf n')
-
-        self.printDebug(cmd)
-
-        log = _getoutput(cmd)
-
-        if os.path.exists('tmp.crg'):
-            tmpFile = open('tmp.crg', 'r')
-            tmpData = tmpFile.readlines()
-            for line in tmpData:
-                ll += line.split()
-            charge = sum(map(float, ll))
-        if not log.isspace() and self.debug:
-            self.printQuoted(log)
+        charge = sum([atom[4] for atom in readMol2Atoms(mol2File)])
 
         self.printDebug("readMol2TotalCharge: " + str(charge))
 
@@ -900,8 +2289,6 @@ Usage: antechamber -i  input file name
         Write out charge   wc       9  |  Delete Charge      dc     10
         ----------------------------------------------------------------
 a        """
-        global pid
-
         self.printMess("Executing Antechamber...")
 
         self.makeDir()
@@ -936,13 +2323,7 @@ a        """
                 os.remove(self.acMol2FileName)
             except:
                 pass
-            signal.signal(signal.SIGALRM, self.signal_handler)
-            signal.alarm(self.timeTol)
-            p = sub.Popen(cmd, shell=True, stderr=sub.STDOUT, stdout=sub.PIPE)
-            pid = p.pid
-
-            out = str(p.communicate()[0].decode())  # p.stdout.read()
-            self.acLog = out
+            self.acLog = self.execTool(cmd, logFile='antechamber.log')
 
         if os.path.exists(self.acMol2FileName):
             self.printMess("* Antechamber OK *")
@@ -950,34 +2331,120 @@ a        """
             self.printQuoted(self.acLog)
             return True
 
-    def signal_handler(self, _signum, _frame):  # , pid = 0):
-        global pid
-        pids = self.job_pids_family(pid)
-        self.printDebug("PID: %s, PIDS: %s" % (pid, pids))
-        self.printMess("Timed out! Process %s killed, max exec time (%ss) exceeded"
-                       % (pids, self.timeTol))
-        # os.system('kill -15 %s' % pids)
-        for i in pids.split():
-            os.kill(int(i), 15)
-        raise Exception("Semi-QM taking too long to finish... aborting!")
-
-    def job_pids_family(self, jpid):
-        '''INTERNAL: Return all job processes (PIDs)'''
-        pid = repr(jpid)
-        dict_pids = {}
-        pids = [pid]
-        cmd = "ps -A -o uid,pid,ppid|grep %i" % os.getuid()
-        out = _getoutput(cmd).split('\n')  # getoutput("ps -A -o uid,pid,ppid|grep %i" % os.getuid()).split('\n')
-        for item in out:
-            vec = item.split()
-            dict_pids[vec[2]] = vec[1]
-        while 1:
-            try:
-                pid = dict_pids[pid]
-                pids.append(pid)
-            except KeyError:
-                break
-        return ' '.join(pids)
+    def execFragment(self):
+        """
+            Fragment mode: atoms of the input mol2 are sorted into classes
+            equivalent up to self.fragment bonds away (atomClasses). Small
+            fragments, with one atom of each class and its neighbourhood
+            (fragmentAtoms) and hydrogens capping the bonds cut, go through
+            antechamber, parmchk and tleap, in parallel. Atom types are mapped
+            back by class from the representatives and charges averaged per
+            class over the fragment atoms not next to caps (classCharges) onto
+            the AC mol2 file of the whole input, and its prmtop and inpcrd
+            files assembled from the fragment parameters by atom types
+            (assembleTopol), so the cost of the tools is the same for a long
+            CNT as for a short one.
+        """
+        self.printMess("Executing Antechamber, Parmchk and Tleap on fragments...")
+
+        self.makeDir()
+
+        atoms = list(readMol2Atoms(self.inputFile))
+        types, bonds = readMol2Graph(self.inputFile)
+        bondTypes = [(fields[3:] or ['1'])[0] for fields in readMol2Section(self.inputFile, 'BOND')
+                     if len(fields) >= 3]
+        nAtoms = len(atoms)
+        adjacency = bondAdjacency(bonds, nAtoms)
+        elements = [mol2Element(t, atom[1]) for t, atom in zip(types, atoms)]
+        classes = atomClasses(elements, bonds, self.fragment)
+        nClasses = int(classes.max()) + 1 if nAtoms else 0
+        fragments, reps = fragmentAtoms(classes, bonds, self.fragment)
+
+        chargeType = self.chargeType
+        if chargeType == 'user':  # only atom types are needed
+            chargeType = 'gas'
+        jobs = []
+        caps = []
+        for n, frag in enumerate(fragments):
+            fragAtoms, fragBonds, capped = capFragment(frag, atoms, types, bonds, bondTypes)
+            fragName = '%s_frag%i' % (self.baseName, n + 1)
+            writeMol2(fragName + '.mol2', fragName, fragAtoms, fragBonds)
+            fragCharge = None
+            if self.chargeType == 'user':
+                fragCharge = str(int(round(sum([atom[4] for atom in fragAtoms]))))
+            fragTopol = ACTopol(fragName + '.mol2', chargeType=chargeType, chargeVal=fragCharge,
+                                multiplicity=self.multiplicity, atomType=self.atomType,
+                                force=True, debug=self.debug, engine=self.engine,
+                                timeTol=self.timeTol, verbose=self.verbose, maxMem=self.maxMem)
+            fragTopol.qFlag = self.qFlag
+            fragTopol.ekFlag = self.ekFlag
+            jobs.append(('Fragment %i' % (n + 1), fragTopol, 'execTleap'))
+            caps.append(capped)
+            os.chdir(self.absHomeDir)
+        self.printMess("%i atoms in %i classes, %i fragments of %s atoms"
+                       % (nAtoms, nClasses, len(fragments), '+'.join([str(len(f)) for f in fragments])))
+        try:
+            self.runWriters(jobs, 'tleap done')
+        finally:
+            os.chdir(self.absHomeDir)
+
+        classType = [None] * nClasses
+        fragTops = []
+        fragCharges = []
+        typed = []
+        for frag, capped, (name, fragTopol, _method) in zip(fragments, caps, jobs):
+            acFragMol2 = os.path.join(fragTopol.absHomeDir, fragTopol.acMol2FileName)
+            acFragTop = os.path.join(fragTopol.absHomeDir, fragTopol.acTopFileName)
+            if not os.path.exists(acFragMol2) or not os.path.exists(acFragTop):
+                self.printError("%s: no antechamber or tleap output" % name)
+                return True
+            fragTops.append(MolTopol(acFileXyz=os.path.join(fragTopol.absHomeDir, fragTopol.acXyzFileName),
+                                     acFileTop=acFragTop, debug=self.debug, verbose=self.verbose))
+            fragTypes = readMol2Graph(acFragMol2)[0][:len(frag)]
+            fragCharges.append(np.array([atom[4] for atom in readMol2Atoms(acFragMol2)])[:len(frag)])
+            for i, fragType in zip(frag.tolist(), fragTypes):
+                if reps[classes[i]] == i:
+                    classType[classes[i]] = fragType
+            # types of atoms next to caps are not checked
+            deep = bondDistances(adjacency, capped, 1)[frag] < 0
+            typed.append((frag[deep].tolist(), np.array(fragTypes)[deep].tolist()))
+
+        acTypes = [classType[c] for c in classes.tolist()]
+        differ = [i for frag, fragTypes in typed for i, t in zip(frag, fragTypes) if t != acTypes[i]]
+        if differ:
+            self.printWarn("%i fragment atoms typed unlike their class, consider bigger fragments"
+                           % len(differ))
+            self.printDebug("atoms: %s" % ' '.join([atoms[i][1] for i in differ[:20]]))
+        if self.chargeType == 'user':
+            charges = np.array([atom[4] for atom in atoms])
+        else:
+            charges, near = classCharges(classes, fragments, caps, fragCharges, adjacency,
+                                         float(self.chargeVal or 0))
+            if near.any():
+                nearAtoms = [atoms[i][1] for i in np.flatnonzero(near).tolist()]
+                self.printWarn("%i atoms only found next to caps, their charges averaged there, "
+                               "consider bigger fragments: %s" % (len(nearAtoms), ' '.join(nearAtoms[:20])))
+            if np.isnan(charges).any():
+                self.printError("atom classes with no fragment charge")
+                return True
+            self.printDebug("charges averaged per class over %i fragments" % len(fragments))
+
+        writeMol2(self.acMol2FileName, self.resName,
+                  [(atom[1], atom[2], acTypes[i], self.resName, charges[i]) for i, atom in enumerate(atoms)],
+                  [(i, j, bondType) for (i, j), bondType in zip(bonds.tolist(), bondTypes)])
+        self.printMess("* Antechamber OK *")
+
+        try:
+            header, arrays = assembleTopol(fragTops, [atom[1] for atom in atoms], acTypes, charges,
+                                           [atom[2] for atom in atoms], bonds, self.resName, self.acBaseName)
+        except Exception:
+            self.printError(str(sys.exc_info()[1]))
+            return True
+        molTop = arraysTopol(header, arrays, debug=self.debug, verbose=self.verbose)
+        molTop.writeAmberTopol()
+        os.rename(self.acBaseName + '_AMBER.prmtop', self.acTopFileName)
+        os.rename(self.acBaseName + '_AMBER.inpcrd', self.acXyzFileName)
+        self.printMess("Topology assembled from the fragments parameters")
 
     def delOutputFiles(self):
         delFiles = ['mopac.in', 'tleap.in', 'sleap.in', 'fixbo.log',
@@ -1002,7 +2469,6 @@ a        """
         return False
 
     def execSleap(self):
-        global pid
         self.makeDir()
 
         if self.ext == '.mol2':
@@ -1036,14 +2502,8 @@ a        """
             self.printMess("Executing Sleap...")
             self.printDebug(cmd)
 
-            p = sub.Popen(cmd, shell=True, stderr=sub.STDOUT, stdout=sub.PIPE)
-            pid = p.pid
-            signal.signal(signal.SIGALRM, self.signal_handler)
-            signal.alarm(self.timeTol)
-
-            out = str(p.communicate()[0].decode())  # p.stdout.read()
-
-            self.sleapLog = out
+            with self.stage('sleap'):
+                self.sleapLog = self.execTool(cmd, logFile='sleap.log')
             self.checkLeapLog(self.sleapLog)
 
             if self.checkXyzAndTopFiles():
@@ -1060,51 +2520,106 @@ a        """
 
         if self.ext == ".pdb":
             self.printMess('... converting pdb input file to mol2 input file')
-            if self.convertPdbToMol2():
+            with self.stage('babel'):
+                failed = self.convertPdbToMol2()
+            if failed:
                 self.printError("convertPdbToMol2 failed")
 
         # print self.chargeVal
 
-        if self.execAntechamber():
-            self.printError("Antechamber failed")
-            fail = True
-            # sys.exit(1)
-
-        if self.execParmchk():
-            self.printError("Parmchk failed")
-            fail = True
-            # sys.exit(1)
+        if self.fragment and self.ext != '.mol2':
+            self.printWarn("fragment mode needs a mol2 input file, running antechamber on it all")
+            self.fragment = 0
+
+        if not self.fragment:
+            with self.stage('antechamber'):
+                failed = self.execAntechamber()
+            if failed:
+                self.printError("Antechamber failed")
+                fail = True
+                # sys.exit(1)
+
+            with self.stage('parmchk'):
+                failed = self.execParmchk()
+            if failed:
+                self.printError("Parmchk failed")
+                fail = True
+                # sys.exit(1)
 
         if fail:
             return True
 
-        tleapScpt = TLEAP_TEMPLATE % self.acParDict
-
-        fp = open('tleap.in', 'w')
-        fp.write(tleapScpt)
-        fp.close()
-
         cmd = '%s -f tleap.in' % self.tleapExe
 
+        graphHash = None
         if self.checkXyzAndTopFiles() and not self.force:
             self.printMess("Topologies files already present... doing nothing")
         else:
+            if self.ext == '.mol2':  # see updateCharges
+                graphHash = mol2GraphHash(self.inputFile, '%s %s' % (self.atomType, self.fragment))
             try:
                 os.remove(self.acTopFileName)
                 os.remove(self.acXyzFileName)
             except:
                 pass
-            self.printMess("Executing Tleap...")
-            self.printDebug(cmd)
-            self.tleapLog = _getoutput(cmd)
-            self.checkLeapLog(self.tleapLog)
+            if self.fragment:
+                # parmchk and tleap too, on the fragments
+                with self.stage('fragments'):
+                    failed = self.execFragment()
+                if failed:
+                    self.printError("Fragment mode failed")
+                    return True
+            else:
+                tleapScpt = TLEAP_TEMPLATE % self.acParDict
+
+                fp = open('tleap.in', 'w')
+                fp.write(tleapScpt)
+                fp.close()
+
+                self.printMess("Executing Tleap...")
+                self.printDebug(cmd)
+                with self.stage('tleap'):
+                    self.tleapLog = self.execTool(cmd)
+                self.checkLeapLog(self.tleapLog)
 
         if self.checkXyzAndTopFiles():
             self.printMess("* Tleap OK *")
+            if graphHash:
+                writeAtomic(self.acBaseName + '.hash', [graphHash])
         else:
             self.printQuoted(self.tleapLog)
             return True
 
+    def updateCharges(self):
+        """
+            Charge-only re-parametrization: with user charges in a mol2 input
+            whose atoms, types, coordinates and bonds hash (mol2GraphHash) as
+            for the topology files present, the charges are the only change.
+            They are then patched into the AC mol2 and prmtop files, with no
+            antechamber, parmchk or tleap run, and outputs written from them
+            as usual. Returns True if so.
+        """
+        if self.ext != '.mol2' or self.chargeType != 'user' or self.force:
+            return False
+        self.makeDir()
+        hashFile = self.acBaseName + '.hash'
+        if not (self.checkXyzAndTopFiles() and os.path.exists(self.acMol2FileName)
+                and os.path.exists(hashFile)):
+            return False
+        with open(hashFile) as f:
+            if f.read().strip() != mol2GraphHash(self.inputFile, '%s %s' % (self.atomType, self.fragment)):
+                self.printWarn("input is not the one of the topology files present, use '-f' to redo them")
+                return False
+        self.printMess("Same molecule as the topology files present... updating charges only")
+        with self.stage('updateCharges'):
+            charges = [atom[4] for atom in readMol2Atoms(self.inputFile)]
+            patchMol2Charges(self.acMol2FileName, charges)
+            patchPrmtopCharges(self.acTopFileName, charges)
+            snapDir = self.baseName + '.snapshot'
+            if os.path.exists(snapDir):
+                rmtree(snapDir)
+        return True
+
     def checkLeapLog(self, log):
         log = log.splitlines(True)
         check = ''
@@ -1138,7 +2653,10 @@ a        """
         cmd = '%s -i %s -f mol2 -o %s' % (self.parmchkExe, self.acMol2FileName,
                                           self.acFrcmodFileName)
 
-        if self.atomType == 'amber':
+        datFile = None
+        if self.atomType == 'gaff':
+            datFile = self.locateDat('gaff.dat')
+        elif self.atomType == 'amber':
             gaffFile = self.locateDat('gaff.dat')
             parm99file = self.locateDat('parm99.dat')
             frcmodff99SB = self.locateDat('frcmod.ff99SB')
@@ -1149,10 +2667,16 @@ a        """
             # parm10file = self.locateDat('parm10.dat') # PARM99 + frcmod.ff99SB + frcmod.parmbsc0 in AmberTools 1.4
 
             cmd += ' -p %s' % parm99gaffff99SBFile  # Ignoring parm10.dat and BSC0
+            datFile = parm99gaffff99SBFile
 
-        self.parmchkLog = _getoutput(cmd)
-
-        self.printDebug(cmd)
+        if datFile:  # native, needs no parmchk
+            self.parmchkLog = ''
+            types, bonds = readMol2Graph(self.acMol2FileName)
+            parmchkFrcmod(types, bonds, readParmIndex(datFile), self.acFrcmodFileName)
+            self.printDebug("frcmod from '%s' for %i atoms" % (datFile, len(types)))
+        else:
+            self.parmchkLog = self.execTool(cmd)
+            self.printDebug(cmd)
 
         if os.path.exists(self.acFrcmodFileName):
             check = self.checkFrcmod()
@@ -1186,7 +2710,7 @@ a        """
         cmd = '%s -ipdb %s -omol2 %s.mol2' % (self.babelExe, self.inputFile,
                                               self.baseName)
         self.printDebug(cmd)
-        self.babelLog = _getoutput(cmd)
+        self.babelLog = self.execTool(cmd)
         self.ext = '.mol2'
         self.inputFile = self.baseName + self.ext
         self.acParDict['ext'] = 'mol2'
@@ -1211,6 +2735,8 @@ a        """
         """
             If successful, Amber Top and Xyz files will be generated
         """
+        if self.updateCharges():
+            return
         # sleap = False
         if self.engine == 'sleap':
             if self.execSleap():
@@ -1234,46 +2760,79 @@ a        """
         """
             Create molTop obj
         """
-        self.topFileData = open(self.acTopFileName, 'r').readlines()
-        self.molTopol = MolTopol(self, verbose=self.verbose, debug=self.debug,
-                                 gmx45=self.gmx45, disam=self.disam, direct=self.direct,
-                                 is_sorted=self.sorted, chiral=self.chiral)
-        if self.outTopols:
-            if 'cns' in self.outTopols:
-                self.molTopol.writeCnsTopolFiles()
-            if 'gmx' in self.outTopols:
-                self.molTopol.writeGromacsTopolFiles()
-            if 'charmm' in self.outTopols:
-                self.writeCharmmTopolFiles()
-        self.pickleSave()
-
-    def pickleSave(self):
-        """
-            To restore:
-                from acpype import *
-                #import cPickle as pickle
-                import pickle
-                o = pickle.load(open('DDD.pkl','rb'))
-                NB: It fails to restore with ipython in Mac (Linux OK)
-        """
-        pklFile = self.baseName + ".pkl"
-        dumpFlag = False
-        if not os.path.exists(pklFile):
-            mess = "Writing pickle file %s" % pklFile
-            dumpFlag = True
-        elif self.force:
-            mess = "Overwriting pickle file %s" % pklFile
-            dumpFlag = True
+        with self.stage('MolTopol'):
+            self.topFileData = open(self.acTopFileName, 'r').readlines()
+            self.molTopol = MolTopol(self, verbose=self.verbose, debug=self.debug,
+                                     gmx45=self.gmx45, disam=self.disam, direct=self.direct,
+                                     is_sorted=self.sorted, chiral=self.chiral, hmr=self.hmr)
+            # sections needed are built here, so writers only read the topology
+            writers = []
+            if self.outTopols:
+                if 'cns' in self.outTopols:
+                    self.molTopol.buildSections('cns')
+                    self.molTopol.buildSections('pdb')
+                    writers.append(('CNS', self.molTopol, 'writeCnsTopolFiles'))
+                if 'gmx' in self.outTopols:
+                    self.molTopol.buildSections('gmx')
+                    self.molTopol.buildSections('gro')
+                    writers.append(('GROMACS', self.molTopol, 'writeGromacsTopolFiles'))
+                if 'charmm' in self.outTopols:
+                    self.molTopol.buildSections('charmm')
+                    self.molTopol.buildSections('pdb')
+                    writers.append(('CHARMM', self.molTopol, 'writeCharmmTopolFiles'))
+                if 'amber' in self.outTopols:
+                    self.molTopol.buildSections('amber')
+                    writers.append(('AMBER', self.molTopol, 'writeAmberTopol'))
+            # first, so run serially it still sees the topology as parsed
+            self.molTopol.buildSections('snapshot')
+            writers.insert(0, ('snapshot', self.molTopol, 'writeSnapshot'))
+        self.runWriters(writers)
+
+    def runWriters(self, writers, done='files written'):
+        """
+            Runs writers, a list of (name, obj, method), reporting the time
+            taken by each. If more than one and more than one CPU, each writer
+            runs in its own process, attributes they set copied back after.
+        """
+        results = []
+        parallel = len(writers) > 1 and multiprocessing.cpu_count() > 1
+        if parallel:
+            sys.stdout.flush()
+            context = forkContext()
+            jobs = []
+            for name, obj, method in writers:
+                recvConn, sendConn = context.Pipe(False)
+                proc = context.Process(target=runWriter, args=(obj, method, sendConn, name))
+                proc.start()
+                sendConn.close()  # so recv sees EOF if the child dies
+                jobs.append((name, obj, proc, recvConn))
+            for name, obj, proc, conn in jobs:
+                # received before join: a child blocks on a full pipe until then
+                try:
+                    elapsed, attrs, record = conn.recv()
+                except EOFError:
+                    elapsed, attrs, record = None, None, None
+                proc.join()
+                if attrs is None:
+                    attrs = "exit code %s" % proc.exitcode
+                results.append((name, obj, elapsed, attrs, record))
         else:
-            mess = "Pickle file %s already present... doing nothing" % pklFile
-        self.printMess(mess)
-        if dumpFlag:
-            with open(pklFile, "wb") as f:  # for python 2.6 or higher
-                # f = open(pklFile, "wb")
-                if verList[0] == 3:
-                    pickle.dump(self, f, protocol=2, fix_imports=True)
-                else:
-                    pickle.dump(self, f, protocol=2)
+            for name, obj, method in writers:
+                results.append((name, obj) + runWriter(obj, method, name=name))
+        for name, obj, elapsed, attrs, record in results:
+            if elapsed is None:
+                if parallel:  # else recorded by stage
+                    self.stages = getattr(self, 'stages', []) + [{'stage': name, 'error': attrs}]
+                raise Exception("%s failed: %s" % (name, attrs))
+            obj.__dict__.update(attrs)
+            if parallel or obj is not self:  # else recorded already
+                if not hasattr(self, 'stages'):
+                    self.stages = []
+                self.stages.append(record)
+                current = getattr(self, 'currentStage', None)
+                if current:
+                    current['toolsPeakRss'] = max(current['toolsPeakRss'], record['toolsPeakRss'])
+            self.printMess("%s %s in %.2f s" % (name, done, elapsed))
 
     def getFlagData(self, flag):
         """
@@ -1281,12 +2840,23 @@ a        """
         """
         block = False
         tFlag = '%FLAG ' + flag
-        data = ''
+        lines = []
 
         if len(self.topFileData) == 0:
             raise Exception("PRMTOP file empty?")
 
-        for rawLine in self.topFileData:
+        # index of '%FLAG' lines, to avoid scanning the whole file per flag
+        flagIndex = getattr(self, '_flagIndex', None)
+        if flagIndex is None or flagIndex[0] is not self.topFileData:
+            lineIds = {}
+            for id_, rawLine in enumerate(self.topFileData):
+                if rawLine.startswith('%FLAG '):
+                    lineIds.setdefault(rawLine.split()[1], id_)
+            flagIndex = (self.topFileData, lineIds)
+            self._flagIndex = flagIndex
+        first = flagIndex[1].get(flag, len(self.topFileData))
+
+        for rawLine in self.topFileData[first:]:
             line = rawLine[:-1]
             if tFlag in line:
                 block = True
@@ -1301,7 +2871,8 @@ a        """
                             f = int(line.split(c)[1])
                             break
                     continue
-                data += line
+                lines.append(line)
+        data = ''.join(lines)
         # data need format
         sdata = [data[i:i + f].strip() for i in range(0, len(data), f)]
         if '+' and '.' in data:  # it's a float
@@ -1368,7 +2939,9 @@ a        """
         """
             Set a list with all atoms objects build from dat in acFileTop
             Set also if molTopol atom type system is gaff or amber
-            Set also list atomTypes
+            Set also list atomTypes, one AtomType per name shared by its
+            atoms, and atomTypeIds, the index in atomTypes of each atom type
+            (prmtop order), and atomTypeLJIds, the LJ type of each atom type
             Set also resid
             Set also molTopol total charge
         """
@@ -1390,11 +2963,16 @@ a        """
         # uniqAtomTypeId = self.getFlagData('ATOM_TYPE_INDEX') # for LJ
 #        balanceChargeList = self.balanceCharges(chargeList)
         coords = self.getCoords()
-        ACOEFs, BCOEFs = self.getABCOEFs()
+        ljTypeIds = self.ljTypeIds
+        ljDiagA = np.diag(self.ljACOEFs).tolist()
+        ljDiagB = np.diag(self.ljBCOEFs).tolist()
 
         atoms = []
         atomTypes = []
-        tmpList = []  # a list with unique atom types
+        typeRegistry = {}  # atom type name: index in atomTypes
+        atomTypeLJIds = []
+        atomTypeIds = np.zeros(len(atomNameList), dtype=np.int32)
+        numbering = AtomNumbering(len(atomNameList))
         totalCharge = 0.0
         countRes = 0
         id_ = 0
@@ -1418,13 +2996,14 @@ a        """
             chargeConverted = charge / qConv
             totalCharge += charge
             coord = coords[id_]
-            ACOEF = ACOEFs[id_]
-            BCOEF = BCOEFs[id_]
-            atomType = AtomType(atomTypeName, mass, ACOEF, BCOEF)
-            if atomTypeName not in tmpList:
-                tmpList.append(atomTypeName)
-                atomTypes.append(atomType)
-            atom = Atom(atomName, atomType, id_ + 1, resid, mass, chargeConverted, coord)
+            typeId = typeRegistry.get(atomTypeName)
+            if typeId is None:
+                typeId = typeRegistry[atomTypeName] = len(atomTypes)
+                ljId = int(ljTypeIds[id_])
+                atomTypes.append(AtomType(atomTypeName, mass, ljDiagA[ljId], ljDiagB[ljId]))
+                atomTypeLJIds.append(ljId)
+            atomTypeIds[id_] = typeId
+            atom = Atom(atomName, atomTypes[typeId], id_ + 1, resid, mass, chargeConverted, coord, numbering)
             atoms.append(atom)
             id_ += 1
 
@@ -1443,7 +3022,18 @@ a        """
         self.totalCharge = int(totalCharge)
 
         self.atoms = atoms
+        self.prmtopAtoms = atoms  # self.atoms may be re-sorted for GMX
+        self.atomNumbering = numbering
         self.atomTypes = atomTypes
+        self.atomTypeIds = atomTypeIds
+        self.atomTypeLJIds = np.array(atomTypeLJIds, dtype=np.int64)
+
+        # an atom type is its first atom's, whatever LJ type the others have
+        nLJ = len(ljDiagA)
+        typeLJs = np.unique(atomTypeIds * nLJ + ljTypeIds) // nLJ
+        for typeId in np.flatnonzero(np.bincount(typeLJs, minlength=len(atomTypes)) > 1).tolist():
+            self.printWarn("atom type '%s' has more than one LJ type in prmtop, keeping the first one"
+                           % atomTypes[typeId].atomTypeName)
 
         self.pbc = None
         if len(coords) == len(atoms) + 2:
@@ -1458,12 +3048,13 @@ a        """
         bondCodeNonHList = self.getFlagData('BONDS_WITHOUT_HYDROGEN')
         bondCodeList = bondCodeHList + bondCodeNonHList
         bonds = []
+        self.bondIndex = np.array(bondCodeList, dtype=int).reshape(-1, 3)[:, :2] // 3
         for i in range(0, len(bondCodeList), 3):
             idAtom1 = bondCodeList[i] // 3  # remember python starts with id 0
             idAtom2 = bondCodeList[i + 1] // 3
             bondTypeId = bondCodeList[i + 2] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
+            atom1 = self.prmtopAtoms[idAtom1]
+            atom2 = self.prmtopAtoms[idAtom2]
             kb = uniqKbList[bondTypeId]
             req = uniqReqList[bondTypeId]
             atoms = [atom1, atom2]
@@ -1485,9 +3076,9 @@ a        """
             idAtom2 = angleCodeList[i + 1] // 3
             idAtom3 = angleCodeList[i + 2] // 3
             angleTypeId = angleCodeList[i + 3] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            atom3 = self.atoms[idAtom3]
+            atom1 = self.prmtopAtoms[idAtom1]
+            atom2 = self.prmtopAtoms[idAtom2]
+            atom3 = self.prmtopAtoms[idAtom3]
             kt = uniqKtList[angleTypeId]
             teq = uniqTeqList[angleTypeId]  # angle given in rad in prmtop
             atoms = [atom1, atom2, atom3]
@@ -1507,59 +3098,141 @@ a        """
         # for list below, true atom number = abs(index)/3 + 1
         dihCodeHList = self.getFlagData('DIHEDRALS_INC_HYDROGEN')
         dihCodeNonHList = self.getFlagData('DIHEDRALS_WITHOUT_HYDROGEN')
-        dihCodeList = dihCodeHList + dihCodeNonHList
+        dihCodes = np.array(dihCodeHList + dihCodeNonHList, dtype=np.int64).reshape(-1, 5)
+        quartets = np.abs(dihCodes[:, :4]) // 3  # remember python starts with id 0
+        # 3 and 4 indexes can be negative: if id3 < 0, end group interations
+        # in amber are to be ignored; if id4 < 0, dihedral is improper
+        isProper = dihCodes[:, 3] > 0
+        has14 = dihCodes[:, 2] > 0
         properDih = []
         improperDih = []
-        condProperDih = []  # list of dihedrals condensed by the same quartet
-        # atomPairs = []
-        atomPairs = set()
-        for i in range(0, len(dihCodeList), 5):
-            idAtom1 = dihCodeList[i] // 3  # remember python starts with id 0
-            idAtom2 = dihCodeList[i + 1] // 3
-            # 3 and 4 indexes can be negative: if id3 < 0, end group interations
-            # in amber are to be ignored; if id4 < 0, dihedral is improper
-            idAtom3raw = dihCodeList[i + 2] // 3  # can be negative -> exclude from 1-4vdw
-            idAtom4raw = dihCodeList[i + 3] // 3  # can be negative -> Improper
-            idAtom3 = abs(idAtom3raw)
-            idAtom4 = abs(idAtom4raw)
-            dihTypeId = dihCodeList[i + 4] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            atom3 = self.atoms[idAtom3]
-            atom4 = self.atoms[idAtom4]
+        atoms = self.prmtopAtoms
+        for (id1, id2, id3, id4), dihTypeId, proper in zip(quartets.tolist(),
+                                                          (dihCodes[:, 4] - 1).tolist(),
+                                                          isProper.tolist()):
             kPhi = uniqKpList[dihTypeId]  # already divided by IDIVF
             period = int(uniqPeriodList[dihTypeId])  # integer
             phase = uniqPhaseList[dihTypeId]  # angle given in rad in prmtop
             if phase == kPhi == 0:
                 period = 0  # period is set to 0
-            atoms = [atom1, atom2, atom3, atom4]
-            dihedral = Dihedral(atoms, kPhi, period, phase)
-            if idAtom4raw > 0:
-                try:
-                    atomsPrev = properDih[-1].atoms
-                except:
-                    atomsPrev = []
+            dihedral = Dihedral([atoms[id1], atoms[id2], atoms[id3], atoms[id4]],
+                                kPhi, period, phase)
+            if proper:
                 properDih.append(dihedral)
-                if idAtom3raw < 0 and atomsPrev == atoms:
-                    condProperDih[-1].append(dihedral)
-                else:
-                    condProperDih.append([dihedral])
-                pair = (atom1, atom4)
-                # if atomPairs.count(pair) == 0 and idAtom3raw > 0:
-                if idAtom3raw > 0:
-                    atomPairs.add(pair)
             else:
                 improperDih.append(dihedral)
-        try:
-            atomPairs = sorted(atomPairs)
-        except:
-            pass
+
+        # condensed list: proper dihedrals grouped by quartet (either way
+        # round), in order of first appearance, whatever the prmtop ordering
+        propQuartets = quartets[isProper]
+        nProp = len(propQuartets)
+        keys = packQuartets(np.concatenate((propQuartets, propQuartets[:, ::-1])),
+                            len(atoms))
+        keys = np.minimum(keys[:nProp], keys[nProp:])
+        _uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=int)
+        rank[np.argsort(first, kind='mergesort')] = np.arange(len(first))
+        groupIds = rank[inverse.ravel()]
+        condProperDih = [[] for _i in range(len(first))]  # [[],[],...]
+        for groupId, dihedral in zip(groupIds.tolist(), properDih):
+            condProperDih[groupId].append(dihedral)
+
+        # 1-4 pairs are the atoms 3 bonds apart in the bond graph (see
+        # getExclusions), the ends of the prmtop dihedrals flagged for 1-4
+        # only checked against them
+        excl, exclIds, dists = self.exclusions
+        is14 = dists == 3
+        pairs = np.column_stack((np.repeat(np.arange(len(atoms)), np.diff(excl))[is14], exclIds[is14]))
+        flagged = np.unique(packQuartets(np.sort(quartets[isProper & has14][:, [0, 3]], axis=1),
+                                         len(atoms)))
+        graphKeys = packQuartets(pairs, len(atoms))
+        nMissing = len(np.setdiff1d(graphKeys, flagged))
+        nExtra = len(np.setdiff1d(flagged, graphKeys))
+        if nMissing or nExtra:
+            self.printWarn("1-4 pairs from bonds differ from prmtop dihedrals: %i not flagged there, "
+                           "%i flagged there not 3 bonds apart (rings?)" % (nMissing, nExtra))
+        atomPairs = [(atoms[id1], atoms[id4]) for id1, id4 in pairs.tolist()]
+
         self.properDihedrals = properDih
         self.improperDihedrals = improperDih
         self.condensedProperDihedrals = condProperDih  # [[],[],...]
-        self.atomPairs = atomPairs  # set((atom1, atom2), ...)
+        self.atomPairs = atomPairs  # [(atom1, atom4), ...]
         self.printDebug("getDihedrals done")
 
+    def writeSnapshot(self):
+        """
+            Writes the topology parsed from prmtop as a snapshot: a folder
+            with a numpy .npy file per array (atoms in prmtop order, types,
+            bonds, angles, dihedrals, 1-4 pairs and extra exclusions, as atom
+            indices and parameters) and a JSON header, read with readSnapshot (arrays
+            memory mapped) or snapshotTopol (a MolTopol to write from).
+        """
+        snapDir = self.baseName + '.snapshot'
+        if not os.path.exists(snapDir):
+            self.printMess("Writing snapshot %s" % snapDir)
+        elif getattr(self, 'force', False):
+            self.printMess("Overwriting snapshot %s" % snapDir)
+        else:
+            self.printMess("Snapshot %s already present... doing nothing" % snapDir)
+            return
+        atoms = self.prmtopAtoms
+        properGroups = {}
+        for groupId, group in enumerate(self.condensedProperDihedrals):
+            for dih in group:
+                properGroups[id(dih)] = groupId
+
+        def ids(terms, n):
+            return np.array([[a.index for a in term.atoms] for term in terms], dtype=np.int64).reshape(-1, n)
+
+        arrays = {'atomNames': np.array([a.atomName for a in atoms], dtype=np.str_),
+                  'atomTypeIds': np.asarray(self.atomTypeIds, dtype=np.int32),
+                  'atomResids': np.array([a.resid for a in atoms], dtype=np.int32),
+                  'atomMasses': np.array([a.mass for a in atoms], dtype=np.float64),
+                  'atomCharges': np.array([a.charge for a in atoms], dtype=np.float64),
+                  'atomCoords': np.array([a.coords for a in atoms], dtype=np.float64).reshape(-1, 3),
+                  'atomIds': np.asarray(self.atomNumbering.id, dtype=np.int64),
+                  'atomCgnrs': np.asarray(self.atomNumbering.cgnr, dtype=np.int64),
+                  'atomOrder': np.array([a.index for a in self.atoms], dtype=np.int64),
+                  'typeNames': np.array([t.atomTypeName for t in self.atomTypes], dtype=np.str_),
+                  'typeMasses': np.array([t.mass for t in self.atomTypes], dtype=np.float64),
+                  'typeLJIds': np.asarray(self.atomTypeLJIds, dtype=np.int64),
+                  'atomLJIds': np.asarray(self.ljTypeIds, dtype=np.int64),
+                  'ljACOEFs': np.asarray(self.ljACOEFs, dtype=np.float64),
+                  'ljBCOEFs': np.asarray(self.ljBCOEFs, dtype=np.float64),
+                  'ljHBondPairs': np.asarray(self.ljHBondPairs, dtype=bool),
+                  'bondAtoms': ids(self.bonds, 2),
+                  'bondKs': np.array([b.kBond for b in self.bonds], dtype=np.float64),
+                  'bondREqs': np.array([b.rEq for b in self.bonds], dtype=np.float64),
+                  'angleAtoms': ids(self.angles, 3),
+                  'angleKs': np.array([a.kTheta for a in self.angles], dtype=np.float64),
+                  'angleThetaEqs': np.array([a.thetaEq for a in self.angles], dtype=np.float64),
+                  'properGroups': np.array([properGroups[id(d)] for d in self.properDihedrals], dtype=np.int64),
+                  'pairAtoms': np.array([[a.index for a in pair] for pair in self.atomPairs],
+                                        dtype=np.int64).reshape(-1, 2),
+                  'exclusionAtoms': np.array([[a.index for a in pair] for pair in self.extraExclusions],
+                                             dtype=np.int64).reshape(-1, 2)}
+        for key, dihedrals in [('proper', self.properDihedrals), ('improper', self.improperDihedrals)]:
+            arrays[key + 'Atoms'] = ids(dihedrals, 4)
+            arrays[key + 'KPhis'] = np.array([d.kPhi for d in dihedrals], dtype=np.float64)
+            arrays[key + 'Periods'] = np.array([d.period for d in dihedrals], dtype=np.int32)
+            arrays[key + 'Phases'] = np.array([d.phase for d in dihedrals], dtype=np.float64)
+        header = {'format': 'acpype-snapshot', 'version': snapshotVersion, 'acpypeRev': svnRev,
+                  'date': datetime.now().ctime(), 'baseName': self.baseName,
+                  'inputFile': self.inputFile, 'sorted': bool(self.sorted), 'hmrMass': self.hmrMass,
+                  'residueLabel': self.residueLabel, 'atomTypeSystem': self.atomTypeSystem,
+                  'totalCharge': self.totalCharge,
+                  'pbc': [list(map(float, v)) for v in self.pbc] if self.pbc else None,
+                  'arrays': dict((k, [str(v.dtype), list(v.shape)]) for k, v in arrays.items())}
+        # written aside and renamed, never seen partial
+        tmpDir = tempfile.mkdtemp(dir='.', prefix=snapDir + '.')
+        for name, array in arrays.items():
+            np.save(os.path.join(tmpDir, name + '.npy'), array)
+        with open(os.path.join(tmpDir, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1, sort_keys=True)
+        if os.path.exists(snapDir):
+            rmtree(snapDir)
+        os.rename(tmpDir, snapDir)
+
     def getChirals(self):
         """
             Get chiral atoms, its 4 neighbours and improper dihedral angle
@@ -1567,19 +3240,15 @@ a        """
         self.chiralGroups = []
         if self.obchiralExe:
             # print (self.obchiralExe, os.getcwd())
-            cmd = '%s %s' % (self.obchiralExe, self.inputFile)
+            cmd = [self.obchiralExe, self.inputFile]
             # print(cmd)
             out = map(int, re.findall('Atom (\d+) Is', _getoutput(cmd)))
             # print("*%s*" % out)
             chiralGroups = []
+            indptr, indices = self.adjacency
             for id_ in out:
-                atChi = self.atoms[id_ - 1]
-                quad = []
-                for bb in self.bonds:
-                    bAts = bb.atoms[:]
-                    if atChi in bAts:
-                        bAts.remove(atChi)
-                        quad.append(bAts[0])
+                atChi = self.prmtopAtoms[id_ - 1]
+                quad = [self.prmtopAtoms[i] for i in indices[indptr[id_ - 1]:indptr[id_]]]
                 if len(quad) != 4:
                     if self.chiral:
                         self.printWarn("Atom %s has less than 4 connections to 4 different atoms. It's NOT Chiral!" % atChi)
@@ -1587,6 +3256,20 @@ a        """
                 v1, v2, v3, v4 = [x.coords for x in quad]
                 chiralGroups.append((atChi, quad, imprDihAngle(v1, v2, v3, v4)))
             self.chiralGroups = chiralGroups
+        if not os.path.exists(self.obchiralExe) and self.chiral:
+            self.printError("no 'obchiral' executable, it won't work to store non-planar improper dihedrals!")
+            self.printWarn("Consider installing http://openbabel.org")
+        elif self.chiral and not self.chiralGroups:
+            self.printWarn("No chiral atoms found")
+
+    def getAdjacency(self):
+        """
+            Set the bond graph as a CSR adjacency (indptr, indices) of atom
+            indices in prmtop order: the neighbours of atom i are
+            indices[indptr[i]:indptr[i + 1]], in the order of the bonds list.
+        """
+        self.adjacency = bondAdjacency(self.bondIndex, len(self.prmtopAtoms))
+        self.printDebug("getAdjacency done")
 
     def sortAtomsForGromacs(self):
         """
@@ -1598,58 +3281,101 @@ a        """
             may be changed by modifying the 'is_hydrogen' function within.
 
             JDC 2011-02-03
+
+            Uses the bond graph adjacency (see getAdjacency) and writes the
+            new ids and charge groups into self.atomNumbering arrays.
         """
 
-        # Build dictionary of bonded atoms.
-        bonded_atoms = dict()
-        for atom in self.atoms:
-            bonded_atoms[atom] = list()
-        for bond in self.bonds:
-            [atom1, atom2] = bond.atoms
-            bonded_atoms[atom1].append(atom2)
-            bonded_atoms[atom2].append(atom1)
+        atoms = self.prmtopAtoms
+        nAtoms = len(atoms)
+        indptr, indices = [x.tolist() for x in self.adjacency]
 
         # Define hydrogen and heavy atom classes.
         def is_hydrogen(atom):
             return (atom.mass < 1.2)
 
-        def is_heavy(atom):
-            return not is_hydrogen(atom)
+        hydrogen = [is_hydrogen(atom) for atom in atoms]
 
-        # Build list of sorted atoms, assigning charge groups by heavy atom.
-        sorted_atoms = list()
+        # Build list of sorted atoms (prmtop indices), assigning charge groups by heavy atom.
+        order = []
+        placed = bytearray(nAtoms)
+        cgnrs = np.zeros(nAtoms, dtype=int)
         cgnr = 1  # charge group number: each heavy atoms is assigned its own charge group
         # First pass: add heavy atoms, followed by the hydrogens bonded to them.
-        for atom in self.atoms:
-            if is_heavy(atom):
+        for i in range(nAtoms):
+            if not hydrogen[i]:
                 # Append heavy atom.
-                atom.cgnr = cgnr
-                sorted_atoms.append(atom)
+                cgnrs[i] = cgnr
+                order.append(i)
+                placed[i] = 1
                 # Append all hydrogens.
-                for bonded_atom in bonded_atoms[atom]:
-                    if is_hydrogen(bonded_atom) and not (bonded_atom in sorted_atoms):
+                for j in indices[indptr[i]:indptr[i + 1]]:
+                    if hydrogen[j] and not placed[j]:
                         # Append bonded hydrogen.
-                        bonded_atom.cgnr = cgnr
-                        sorted_atoms.append(bonded_atom)
+                        cgnrs[j] = cgnr
+                        order.append(j)
+                        placed[j] = 1
                 cgnr += 1
 
         # Second pass: Add any remaining atoms.
-        if len(sorted_atoms) < len(self.atoms):
-            for atom in self.atoms:
-                if not (atom in sorted_atoms):
-                    atom.cgnr = cgnr
-                    sorted_atoms.append(atom)
+        if len(order) < nAtoms:
+            for i in range(nAtoms):
+                if not placed[i]:
+                    cgnrs[i] = cgnr
+                    order.append(i)
                     cgnr += 1
 
-        # Replace current list of atoms with sorted list.
-        self.atoms = sorted_atoms
-
-        # Renumber atoms in sorted list, starting from 1.
-        for (index, atom) in enumerate(self.atoms):
-            atom.id = index + 1
+        # Renumber atoms in sorted list, starting from 1, and replace current
+        # list of atoms with sorted list.
+        self.atomNumbering.id[order] = np.arange(1, nAtoms + 1)
+        self.atomNumbering.cgnr[:] = cgnrs
+        self.atoms = [atoms[i] for i in order]
 
         return
 
+    def repartitionHydrogenMass(self):
+        """
+            Hydrogen mass repartitioning, for 4 fs time steps with bonds to
+            hydrogens constrained: every hydrogen (mass < 1.2, as in
+            sortAtomsForGromacs) gets mass self.hmrMass, the difference taken
+            from the heavy atom it is bonded to, so total mass is kept.
+            Water and ions (residues in ionOrSolResNameList) are left alone,
+            rigid water gaining nothing from it.
+            Atom types keep their masses; new atom masses are reported per
+            atom type.
+        """
+        atoms = self.prmtopAtoms
+        masses = np.array([a.mass for a in atoms], dtype=float)
+        solvent = np.array([self.residueLabel[a.resid] in ionOrSolResNameList for a in atoms], dtype=bool)
+        isH = (masses < 1.2) & ~solvent
+        skipped = sorted(set([self.residueLabel[a.resid] for a in atoms if a.mass < 1.2 and
+                              self.residueLabel[a.resid] in ionOrSolResNameList]))
+        bonds = self.bondIndex
+        bonds = bonds[isH[bonds[:, 0]] != isH[bonds[:, 1]]]
+        hydrogens = np.where(isH[bonds[:, 0]], bonds[:, 0], bonds[:, 1])
+        heavies = np.where(isH[bonds[:, 0]], bonds[:, 1], bonds[:, 0])
+        hydrogens, first = np.unique(hydrogens, return_index=True)
+        heavies = heavies[first]
+        newMasses = masses.copy()
+        newMasses[hydrogens] = self.hmrMass
+        np.subtract.at(newMasses, heavies, self.hmrMass - masses[hydrogens])
+        light = [i for i in np.unique(heavies).tolist() if newMasses[i] < self.hmrMass]
+        if light:
+            raise Exception("hydrogen mass %s leaves %s lighter than its hydrogens"
+                            % (self.hmrMass, atoms[light[0]]))
+        changed = {}
+        for atom, old, new in zip(atoms, masses.tolist(), newMasses.tolist()):
+            if new != old:
+                atom.mass = new
+                changed.setdefault(atom.atomType.atomTypeName, (old, set()))[1].add(round(new, 4))
+        for name in sorted(changed):
+            old, news = changed[name]
+            self.printMess("HMR: atom type %-4s mass %8.4f -> %s" % (name, old, ', '.join(['%.4f' % m for m in sorted(news)])))
+        self.printMess("HMR: %i hydrogens set to %.4f, total mass %.4f kept" % (len(hydrogens), self.hmrMass,
+                                                                              newMasses.sum()))
+        if skipped:
+            self.printMess("HMR: hydrogens of solvent residues %s left alone" % ', '.join(skipped))
+
     def setAtomPairs(self):
         """
             Set a list of pair of atoms pertinent to interaction 1-4 for vdw.
@@ -1666,28 +3392,163 @@ a        """
         self.atomPairs = atomPairs  # [[atom1, atom2], ...]
         self.printDebug("atomPairs done")
 
-    def getExcludedAtoms(self):
+    def getExclusions(self):
+        """
+            Set the excluded atoms (1-2, 1-3 and 1-4) from the bond graph as a
+            CSR (indptr, indices, distances) of atoms j > i in prmtop order,
+            see bondExclusions.
+        """
+        self.exclusions = bondExclusions(self.adjacency)
+        self.printDebug("getExclusions done")
+
+    def checkExclusions(self):
+        """
+            Checks the exclusions from the bond graph against prmtop
+            EXCLUDED_ATOMS_LIST and set extraExclusions, the pairs of atoms
+            [(atom1, atom2), ...] prmtop excludes beyond them, written as
+            GROMACS [ exclusions ] (nrexcl 3 does the rest). Pairs excluded by
+            the graph but not in prmtop cannot be undone and are warned.
+        """
+        excl, exclIds, _dists = self.exclusions
+        atoms = self.prmtopAtoms
+        nAtoms = len(atoms)
+        graphKeys = np.repeat(np.arange(nAtoms, dtype=np.int64), np.diff(excl)) * nAtoms + exclIds
+        # 0 stands for no excluded atom, prmtop lists are 1-based
+        numbers = np.array(self.getFlagData('NUMBER_EXCLUDED_ATOMS'), dtype=np.int64)
+        ids = np.array(self.getFlagData('EXCLUDED_ATOMS_LIST'), dtype=np.int64) - 1
+        owners = np.repeat(np.arange(nAtoms, dtype=np.int64), numbers)
+        valid = (ids >= 0) & (ids != owners)
+        ids, owners = ids[valid], owners[valid]
+        prmtopKeys = np.unique(np.minimum(owners, ids) * nAtoms + np.maximum(owners, ids))
+        extra = np.setdiff1d(prmtopKeys, graphKeys)
+        nMissing = len(np.setdiff1d(graphKeys, prmtopKeys))
+        if nMissing:
+            self.printWarn("%i excluded atom pairs from bonds not in prmtop EXCLUDED_ATOMS_LIST" % nMissing)
+        if len(extra):
+            self.printMess("%i excluded atom pairs in prmtop beyond the bonds, written as [ exclusions ]\n"
+                           % len(extra))
+        self.extraExclusions = [(atoms[i], atoms[j]) for i, j in zip((extra // nAtoms).tolist(),
+                                                                     (extra % nAtoms).tolist())]
+        self.printDebug("checkExclusions done")
+
+    def getMolecules(self, nAtoms=None):
         """
-            Returns a list of atoms with a list of its excluded atoms up to 3rd
-            neighbour.
-            It's implicitly indexed, i.e., a sequence of atoms in position n in
-            the excludedAtomsList corresponds to atom n (self.atoms) and so on.
-            NOT USED
+            Returns the molecules among the first nAtoms atoms (all by default)
+            as a sorted list of (start, end) atom index ranges, i.e. the
+            connected components of the bond graph.
+            Components interleaved in the atom order are merged, since for
+            GROMACS a molecule must be a contiguous block of atoms.
         """
-        excludedAtomsIdList = self.getFlagData('EXCLUDED_ATOMS_LIST')
-        numberExcludedAtoms = self.getFlagData('NUMBER_EXCLUDED_ATOMS')
+        if nAtoms is None:
+            nAtoms = len(self.atoms)
+        parent = list(range(nAtoms))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]  # path halving
+                i = parent[i]
+            return i
+
+        # bonds in current atom numbering (it may have been re-sorted)
+        bondIds = (self.atomNumbering.id[self.bondIndex] - 1).tolist()
+        for id1, id2 in bondIds:
+            if id1 < nAtoms and id2 < nAtoms:
+                r1 = root(id1)
+                r2 = root(id2)
+                if r1 != r2:
+                    parent[max(r1, r2)] = min(r1, r2)
+        last = {}
+        for id_ in range(nAtoms):
+            last[root(id_)] = id_
+        blocks = []
+        for start in sorted(last):  # a root is the lowest atom index of its component
+            end = last[start] + 1
+            if blocks and start < blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], end)
+            else:
+                blocks.append([start, end])
+        self.printDebug("getMolecules done")
+        return [tuple(b) for b in blocks]
+
+    def getUniqueMolecules(self, nAtoms=None):
+        """
+            Groups the molecules found by getMolecules by their signature:
+            atoms (name, type, residue, charge group, charge, mass) and all
+            bonded terms with their parameters, in numbering local to the
+            molecule.
+            Returns the moleculetypes as a list of (name, terms), where terms
+            is a dict of atoms and bonded terms of the first molecule of that
+            type, and the '[ molecules ]' entries as a list of (name, count),
+            consecutive molecules of same type counted together.
+            If there is only one molecule, terms is None, i.e., everything.
+        """
+        blocks = self.getMolecules(nAtoms)
+        if len(blocks) < 2:
+            return [(self.baseName, None)], [(self.baseName, 1)]
+
         atoms = self.atoms
-        interval = 0
-        excludedAtomsList = []
-        for number in numberExcludedAtoms:
-            temp = excludedAtomsIdList[interval:interval + number]
-            if temp == [0]:
-                excludedAtomsList.append([])
+        typeOf = [self.atomTypesGromacs[i].atomTypeName for i in self.atomTypeIdsGromacs.tolist()]
+        blockOf = len(atoms) * [-1]
+        termsList = []
+        for b, (start, end) in enumerate(blocks):
+            blockOf[start:end] = (end - start) * [b]
+            termsList.append({'atoms': atoms[start:end], 'bonds': [], 'pairs': [],
+                              'angles': [], 'dihRB': [], 'dihGmx45': [],
+                              'dihAlphaGamma': [], 'improper': [], 'exclusions': []})
+
+        def distribute(key, items, getAtoms):
+            for item in items:
+                b = blockOf[getAtoms(item)[0].id - 1]
+                if b >= 0:
+                    termsList[b][key].append(item)
+
+        distribute('bonds', self.bonds, lambda x: x.atoms)
+        distribute('pairs', self.atomPairs, lambda x: x)
+        distribute('angles', self.angles, lambda x: x.atoms)
+        distribute('dihRB', self.properDihedralsCoefRB, lambda x: x[0])
+        distribute('dihGmx45', self.properDihedralsGmx45, lambda x: x[0])
+        distribute('dihAlphaGamma', self.properDihedralsAlphaGamma, lambda x: x[0])
+        distribute('improper', self.improperDihedrals, lambda x: x.atoms)
+        distribute('exclusions', self.extraExclusions, lambda x: x)
+
+        molTypes = []
+        molecules = []
+        sigDict = {}  # signature: name
+        names = set()
+        for (start, _end), terms in zip(blocks, termsList):
+            a0 = terms['atoms'][0]
+
+            def local(ats):
+                return tuple([a.id - 1 - start for a in ats])
+
+            sig = (tuple([(a.atomName, typeOf[a.index], self.residueLabel[a.resid],
+                           a.resid - a0.resid, a.cgnr - a0.cgnr, a.charge, a.mass)
+                          for a in terms['atoms']]),
+                   tuple(sorted([local(x.atoms) + (x.kBond, x.rEq) for x in terms['bonds']])),
+                   tuple(sorted([local(x) for x in terms['pairs']])),
+                   tuple(sorted([local(x.atoms) + (x.kTheta, x.thetaEq) for x in terms['angles']])),
+                   tuple(sorted([local(x[0]) + tuple(x[1]) for x in terms['dihRB']])),
+                   tuple(sorted([local(x[0]) + tuple(x[1:]) for x in terms['dihGmx45']])),
+                   tuple(sorted([local(x[0]) + tuple(x[1:]) for x in terms['dihAlphaGamma']])),
+                   tuple(sorted([local(x.atoms) + (x.kPhi, x.period, x.phase)
+                                 for x in terms['improper']])),
+                   tuple(sorted([local(x) for x in terms['exclusions']])))
+            name = sigDict.get(sig)
+            if name is None:
+                name = self.residueLabel[a0.resid]
+                count = 1
+                while name in names:
+                    count += 1
+                    name = '%s_%i' % (self.residueLabel[a0.resid], count)
+                names.add(name)
+                sigDict[sig] = name
+                molTypes.append((name, terms))
+            if molecules and molecules[-1][0] == name:
+                molecules[-1][1] += 1
             else:
-                excludedAtomsList.append([atoms[a - 1] for a in temp])
-            interval += number
-        self.excludedAtoms = excludedAtomsList
-        self.printDebug("getExcludedAtoms")
+                molecules.append([name, 1])
+        self.printDebug("getUniqueMolecules done")
+        return molTypes, [tuple(m) for m in molecules]
 
     def balanceCharges(self, chargeList, FirstNonSoluteId=None):
         """
@@ -1722,29 +3583,64 @@ a        """
         self.printDebug("balanceCharges done")
         return chargeList, fix, limIds
 
-    def getABCOEFs(self):
-        uniqAtomTypeIdList = self.getFlagData('ATOM_TYPE_INDEX')
-        nonBonIdList = self.getFlagData('NONBONDED_PARM_INDEX')
-        rawACOEFs = self.getFlagData('LENNARD_JONES_ACOEF')
-        rawBCOEFs = self.getFlagData('LENNARD_JONES_BCOEF')
-        # print nonBonIdList, len(nonBonIdList), rawACOEFs, len(rawACOEFs)
-        ACOEFs = []
-        BCOEFs = []
-        ntypes = max(uniqAtomTypeIdList)
-        # id_ = 0
-        # for atName in self._atomTypeNameList:
-        for id_ in range(len(self._atomTypeNameList)):
-            # id_ = self._atomTypeNameList.index(atName)
-            atomTypeId = uniqAtomTypeIdList[id_]
-            index = ntypes * (atomTypeId - 1) + atomTypeId
-            nonBondId = nonBonIdList[index - 1]
-            # print "*****", index, ntypes, atName, id_, atomTypeId, nonBondId
-            ACOEFs.append(rawACOEFs[nonBondId - 1])
-            BCOEFs.append(rawBCOEFs[nonBondId - 1])
-            # id_ += 1
-        # print ACOEFs
-        self.printDebug("getABCOEFs done")
-        return ACOEFs, BCOEFs
+    def getLJMatrix(self):
+        """
+            Set ljACOEFs and ljBCOEFs, the Lennard-Jones A and B coefficients
+            for every pair of prmtop LJ types (NTYPES x NTYPES, pair-specific
+            NBFIX terms included), decoded from NONBONDED_PARM_INDEX at once,
+            and ljTypeIds, the LJ type of each atom (0-based, prmtop order).
+            A negative index is a 10-12 (H-bond) term, not converted: A = B = 0
+            and ljHBondPairs is True for it.
+        """
+        nTypes = self.getFlagData('POINTERS')[1]
+        index = np.array(self.getFlagData('NONBONDED_PARM_INDEX'), dtype=np.int64).reshape(nTypes, nTypes)
+        rawACOEFs = np.append(np.array(self.getFlagData('LENNARD_JONES_ACOEF'), dtype=float), 0.0)
+        rawBCOEFs = np.append(np.array(self.getFlagData('LENNARD_JONES_BCOEF'), dtype=float), 0.0)
+        self.ljHBondPairs = index <= 0
+        if self.ljHBondPairs.any():
+            self.printWarn("%i 10-12 (H-bond) LJ type pairs in prmtop, not converted"
+                           % np.triu(self.ljHBondPairs).sum())
+        index = np.where(index > 0, index - 1, len(rawACOEFs) - 1)
+        self.ljACOEFs = rawACOEFs[index]
+        self.ljBCOEFs = rawBCOEFs[index]
+        self.ljTypeIds = np.array(self.getFlagData('ATOM_TYPE_INDEX'), dtype=np.int64) - 1
+        self.printDebug("getLJMatrix done")
+
+    def getNonbondParams(self):
+        """
+            Returns the pairs (i, j), i < j, of atomTypesGromacs whose LJ A or
+            B coefficients are not what the Lorentz-Berthelot rule gives from
+            their own (diagonal) ones, i.e., NBFIX terms, with their sigma and
+            epsilon as GROMACS would write them:
+            [(i, j, sigma (nm), epsilon (kJ/mol)), ...]. 10-12 pairs are
+            left out (see getLJMatrix).
+            It only depends on the number of types, not of atoms.
+        """
+        typeLJIds = np.zeros(len(self.atomTypesGromacs), dtype=np.int64)
+        typeLJIds[self.atomTypeIdsGromacs] = self.atomTypeLJIds[self.atomTypeIds]
+        A = self.ljACOEFs[np.ix_(typeLJIds, typeLJIds)]
+        B = self.ljBCOEFs[np.ix_(typeLJIds, typeLJIds)]
+        diagA = np.diag(A)
+        diagB = np.diag(B)
+        rMin = np.zeros(len(diagA))  # Rmin/2
+        eps = np.zeros(len(diagA))
+        nonZero = (diagA > 0) & (diagB > 0)
+        rMin[nonZero] = 0.5 * (2 * diagA[nonZero] / diagB[nonZero]) ** (1.0 / 6)
+        eps[nonZero] = diagB[nonZero] ** 2 / (4 * diagA[nonZero])
+        epsIJ = np.sqrt(np.outer(eps, eps))
+        rIJ = np.add.outer(rMin, rMin)
+        # prmtop has 8 significant digits
+        fixed = ~(np.isclose(A, epsIJ * rIJ ** 12, rtol=1e-6, atol=0) &
+                  np.isclose(B, 2 * epsIJ * rIJ ** 6, rtol=1e-6, atol=0))
+        fixed &= ~self.ljHBondPairs[np.ix_(typeLJIds, typeLJIds)]
+        ii, jj = np.nonzero(np.triu(fixed, 1))
+        sigma = np.zeros(len(ii))
+        epsilon = np.zeros(len(ii))
+        # one cannot infer sigma or epsilon for B = 0, assuming 0 for them
+        valid = (B[ii, jj] > 0) & (A[ii, jj] > 0)
+        sigma[valid] = 0.1 * (A[ii, jj][valid] / B[ii, jj][valid]) ** (1.0 / 6)
+        epsilon[valid] = cal * 0.25 * B[ii, jj][valid] ** 2 / A[ii, jj][valid]
+        return list(zip(ii.tolist(), jj.tolist(), sigma.tolist(), epsilon.tolist()))
 
     def setProperDihedralsCoef(self):
         """
@@ -1761,59 +3657,46 @@ a        """
             the ones calculated by amb2gmx.pl because python is taken full float
             number from prmtop and not rounded numbers from rdparm.out as
             amb2gmx.pl does.
+
+            The coefs of all terms are summed per quartet in one go with
+            numpy, using rbCoefTable for each (period, phase).
         """
-        properDihedralsCoefRB = []
+        items = self.condensedProperDihedrals
+        dihs = [dih for item in items for dih in item]
+        nTerms = np.array([len(item) for item in items], dtype=int)
+        group = np.repeat(np.arange(len(items)), nTerms)  # quartet of each term
+        period = np.array([dih.period for dih in dihs], dtype=int)  # Pn
+        kPhi = np.array([dih.kPhi for dih in dihs], dtype=float)  # in rad
+        phaseRaw = np.array([dih.phase for dih in dihs], dtype=float) * radPi  # in degree
+        phase = phaseRaw.astype(int)  # in degree
+        if not self.gmx45 and (period > 4).any():
+            self.printError("Likely trying to convert ILDN to RB, use option '-r' for GMX45")
+            sys.exit(1)
+        isRB = (phase == 0) | (phase == 180)
+
+        quartets = [item[0].atoms for item in items]
+        groupList = group.tolist()
+        phaseList = phaseRaw.tolist()
         properDihedralsAlphaGamma = []
         properDihedralsGmx45 = []
-        for item in self.condensedProperDihedrals:
-            V = 6 * [0.0]
-            C = 6 * [0.0]
-            for dih in item:
-                period = dih.period  # Pn
-                kPhi = dih.kPhi  # in rad
-                phaseRaw = dih.phase * radPi  # in degree
-                phase = int(phaseRaw)  # in degree
-                if period > 4 and not self.gmx45:
-                    self.printError("Likely trying to convert ILDN to RB, use option '-r' for GMX45")
-                    sys.exit(1)
-                if phase in [0, 180]:
-                    properDihedralsGmx45.append([item[0].atoms, phaseRaw, kPhi, period])
-                    if not self.gmx45:
-                        if kPhi > 0:
-                            V[period] = 2 * kPhi * cal
-                        if period == 1:
-                            C[0] += 0.5 * V[period]
-                            if phase == 0:
-                                C[1] -= 0.5 * V[period]
-                            else:
-                                C[1] += 0.5 * V[period]
-                        elif period == 2:
-                            if phase == 180:
-                                C[0] += V[period]
-                                C[2] -= V[period]
-                            else:
-                                C[2] += V[period]
-                        elif period == 3:
-                            C[0] += 0.5 * V[period]
-                            if phase == 0:
-                                C[1] += 1.5 * V[period]
-                                C[3] -= 2 * V[period]
-                            else:
-                                C[1] -= 1.5 * V[period]
-                                C[3] += 2 * V[period]
-                        elif period == 4:
-                            if phase == 180:
-                                C[2] += 4 * V[period]
-                                C[4] -= 4 * V[period]
-                            else:
-                                C[0] += V[period]
-                                C[2] -= 4 * V[period]
-                                C[4] += 4 * V[period]
-                else:
-                    properDihedralsAlphaGamma.append([item[0].atoms, phaseRaw, kPhi, period])
-                    # print phaseRaw, kPhi, period
-            if phase in [0, 180]:
-                properDihedralsCoefRB.append([item[0].atoms, C])
+        for t, rb in enumerate(isRB.tolist()):
+            dih = dihs[t]
+            term = [quartets[groupList[t]], phaseList[t], dih.kPhi, dih.period]
+            if rb:
+                properDihedralsGmx45.append(term)
+            else:
+                properDihedralsAlphaGamma.append(term)
+
+        C = np.zeros((len(items), 6))
+        if not self.gmx45:
+            V = np.where(kPhi > 0, 2 * kPhi * cal, 0.0)
+            coef = rbCoefTable[period[isRB], (phase[isRB] == 180).astype(int)]
+            np.add.at(C, group[isRB], V[isRB, None] * coef)
+        # a quartet is kept as RB if its last term has phase 0 or 180
+        lastRB = isRB[np.cumsum(nTerms) - 1] if len(items) else isRB
+        C = C.tolist()
+        properDihedralsCoefRB = [[quartets[g], C[g]]
+                                 for g in np.flatnonzero(lastRB).tolist()]
 
         # print properDihedralsCoefRB
         # print properDihedralsAlphaGamma
@@ -1825,24 +3708,195 @@ a        """
         self.properDihedralsGmx45 = properDihedralsGmx45
 
     def writeCharmmTopolFiles(self):
+        """
+            Writes CHARMM topology (RTF), parameter (PRM), stream (STR, both of
+            them, for appending to other force fields like the CHARMM-GUI
+            toppar files) and input files from the parsed topology.
+            AMBER and CHARMM have the same functional forms and units (kcal/mol,
+            Ang.), so parameters are taken as they are, angles in degree:
+                bonds: Kb(b - b0)**2; angles: Ktheta(theta - theta0)**2
+                dihedrals and impropers: Kchi(1 + cos(n*chi - delta)), i.e.
+                    impropers with n > 0, in the same atom order as prmtop
+                nonbonded: epsilon = -B**2/(4*A), Rmin/2 = 0.5*(2*A/B)**(1/6)
+                    and for 1-4, epsilon/2 with e14fac = 1/1.2 as in AMBER
+            As CHARMM is not case sensitive, atom types are those
+            disambiguated for GROMACS (see setAtomType4Gromacs).
+        """
+        self.buildSections('charmm')
+        charmmDir = os.path.abspath('.')
+
+        pdb = self.baseName + '_CHARMM.pdb'
+        rtf = self.baseName + '_CHARMM.rtf'
+        prm = self.baseName + '_CHARMM.prm'
+        stream = self.baseName + '_CHARMM.str'
+        inp = self.baseName + '_CHARMM.inp'
 
         self.printMess("Writing CHARMM files\n")
+        if self.hmrMass:
+            self.printWarn("RTF has no atom masses, CHARMM files keep atom types masses (no HMR)")
+        self.writePdb(os.path.join(charmmDir, pdb))
+
+        # GMX atom type name by atom index, see setAtomType4Gromacs
+        typeOf = [self.atomTypesGromacs[i].atomTypeName for i in self.atomTypeIdsGromacs.tolist()]
+        resName = self.residueLabel[0]
+
+        massText = []
+        for at in self.atomTypesGromacs:
+            massText.append("MASS  -1  %-6s %10.5f\n" % (at.atomTypeName, at.mass))
+
+        rtfText = massText + ["\n"]
+        charge = round(sum([atom.charge for atom in self.atoms]), 4) + 0.0  # not -0.0
+        rtfText.append("RESI %-6s %8.4f\n" % (resName, charge))
+        rtfText.append("GROUP\n")
+        for atom in self.atoms:
+            rtfText.append("ATOM %-5s %-6s %10.6f\n" % (atom.atomName, typeOf[atom.index],
+                                                        atom.charge))
+        rtfText.append("\n")
+        for bond in self.bonds:
+            rtfText.append("BOND %-5s %-5s\n" % tuple([a.atomName for a in bond.atoms]))
+        for angle in self.angles:
+            rtfText.append("ANGL %-5s %-5s %-5s\n" % tuple([a.atomName for a in angle.atoms]))
+        for item in self.condensedProperDihedrals:
+            rtfText.append("DIHE %-5s %-5s %-5s %-5s\n" % tuple([a.atomName for a in item[0].atoms]))
+        for dih in self.improperDihedrals:
+            rtfText.append("IMPR %-5s %-5s %-5s %-5s\n" % tuple([a.atomName for a in dih.atoms]))
+        rtfText.append("PATCHING FIRST NONE LAST NONE\n")
 
-        # self.makeDir()
+        # parameters keyed by types plus the parameters rounded as printed,
+        # as for the CNS writer, bond and angle types either way round
+        prmText = ["ATOMS\n"] + massText
 
-        at = self.atomType
-        self.getResidueLabel()
-        res = self.resName  # self.residueLabel[0]
-        # print res, self.residueLabel, type(self.residueLabel)
+        prmText.append("\nBONDS\n")
+        paramDict = {}
+        for bond in self.bonds:
+            types = tuple([typeOf[a.index] for a in bond.atoms])
+            key = (min(types, types[::-1]), "%.3f" % bond.kBond, "%.4f" % bond.rEq)
+            if key not in paramDict:
+                paramDict[key] = True
+                prmText.append("%-6s %-6s %10.3f %10.4f\n" % (types + (bond.kBond, bond.rEq)))
+
+        prmText.append("\nANGLES\n")
+        paramDict = {}
+        for angle in self.angles:
+            types = tuple([typeOf[a.index] for a in angle.atoms])
+            t0 = angle.thetaEq * radPi
+            key = (min(types, types[::-1]), "%.3f" % angle.kTheta, "%.2f" % t0)
+            if key not in paramDict:
+                paramDict[key] = True
+                prmText.append("%-6s %-6s %-6s %10.3f %8.2f\n" % (types + (angle.kTheta, t0)))
+
+        # CHARMM takes all lines of a type quartet as the terms of one
+        # dihedral: a quartet is written once, with its full term list, and
+        # other term lists for it (e.g. types merged for GMX) warned about
+        def conflict(kind, types):
+            conflicts.setdefault(kind, set()).add('-'.join(types))
+
+        conflicts = {}
+        prmText.append("\nDIHEDRALS\n")
+        paramDict = {}
+        for item in self.condensedProperDihedrals:
+            types = tuple([typeOf[a.index] for a in item[0].atoms])
+            # period 0 means no term (kPhi = phase = 0), kept only if alone
+            terms = [(dih.kPhi, dih.period, dih.phase * radPi) for dih in item if dih.period]
+            if not terms:
+                terms = [(0.0, 1, 0.0)]
+            key = min(types, types[::-1])
+            termsKey = tuple(sorted([("%.4f" % kp, p, "%.2f" % ph) for kp, p, ph in terms]))
+            if key not in paramDict:
+                paramDict[key] = termsKey
+                for kp, p, ph in terms:
+                    prmText.append("%-6s %-6s %-6s %-6s %10.4f %2i %8.2f\n" % (types + (kp, p, ph)))
+            elif paramDict[key] != termsKey:
+                conflict('dihedral', key)
+
+        prmText.append("\nIMPROPER\n")
+        paramDict = {}
+        for dih in self.improperDihedrals:
+            types = tuple([typeOf[a.index] for a in dih.atoms])
+            ph = dih.phase * radPi
+            termsKey = ("%.4f" % dih.kPhi, dih.period, "%.2f" % ph)
+            if types not in paramDict:
+                paramDict[types] = termsKey
+                prmText.append("%-6s %-6s %-6s %-6s %10.4f %2i %8.2f\n" % (types + (dih.kPhi,
+                                                                                  dih.period, ph)))
+            elif paramDict[types] != termsKey:
+                conflict('improper', types)
+        for kind in sorted(conflicts):
+            self.printWarn("CHARMM %s types %s have more than one set of parameters, only the first written"
+                           % (kind, ', '.join(sorted(conflicts[kind]))))
+
+        prmText.append("\nNONBONDED nbxmod  5 atom cdiel fshift vatom vdistance vfswitch -\n")
+        prmText.append("cutnb 14.0 ctofnb 12.0 ctonnb 10.0 eps 1.0 e14fac 0.83333333 wmin 1.5\n\n")
+        for at in self.atomTypesGromacs:
+            A = at.ACOEF
+            B = at.BCOEF
+            if B == 0.0:
+                epsilon = rMin2 = 0.0
+            else:
+                epsilon = -0.25 * B * B / A
+                rMin2 = 0.5 * math.pow((2 * A / B), (1.0 / 6))
+            prmText.append("%-6s %4.1f %11.6f %11.6f %4.1f %11.6f %11.6f\n" %
+                           (at.atomTypeName, 0.0, epsilon, rMin2, 0.0, epsilon / 2.0, rMin2))
+        nbfix = self.getNonbondParams()
+        if nbfix:
+            prmText.append("\nNBFIX\n")
+            for i, j, sigma, epsilon in nbfix:
+                emin = -epsilon / cal
+                rMin = 10 * sigma * math.pow(2, 1.0 / 6)
+                prmText.append("%-6s %-6s %11.6f %11.6f %11.6f %11.6f\n" %
+                               (self.atomTypesGromacs[i].atomTypeName, self.atomTypesGromacs[j].atomTypeName,
+                                emin, rMin, emin / 2.0, rMin))
+
+        rtfFile = open(os.path.join(charmmDir, rtf), 'w')
+        rtfFile.write("* " + head % (rtf, date) + "*\n36  1\n\n")
+        rtfFile.writelines(rtfText)
+        rtfFile.write("\nEND\n")
+        rtfFile.close()
+
+        prmFile = open(os.path.join(charmmDir, prm), 'w')
+        prmFile.write("* " + head % (prm, date) + "*\n\n")
+        prmFile.writelines(prmText)
+        prmFile.write("\nEND\n")
+        prmFile.close()
+
+        strFile = open(os.path.join(charmmDir, stream), 'w')
+        strFile.write("* " + head % (stream, date) + "*\n\n")
+        strFile.write("read rtf card append\n* Topology for %s\n*\n36  1\n\n" % resName)
+        strFile.writelines(rtfText)
+        strFile.write("\nEND\n\nread para card flex append\n* Parameters for %s\n*\n\n" % resName)
+        strFile.writelines(prmText)
+        strFile.write("\nEND\n\nreturn\n")
+        strFile.close()
 
-        cmd = '%s -i %s -fi mol2 -o %s -fo charmm -s 2 -at %s \
-        -pf y -rn %s' % (self.acExe, self.acMol2FileName, self.charmmBase,
-                         at, res)
+        inpData = \
+            """*
+bomlev -1
 
-        if self.debug:
-            cmd = cmd.replace('-pf y', '-pf n')
-            self.printDebug(cmd)
-        _log = _getoutput(cmd)
+read rtf card name "%(rtf)s"
+read para card flex name "%(prm)s"
+
+read sequence %(res)s 1
+generate %(res)s first none last none setup
+
+read coor pdb name "%(pdb)s" resid
+
+! Remarks Do steepest descent and ABNR energy minimisation
+energy
+mini sd nstep 100
+mini abnr nstep 250
+
+write psf card name "%(psf)s"
+write coor pdb name "%(min)s"
+
+stop
+"""
+        dictInp = {'rtf': rtf, 'prm': prm, 'res': resName, 'pdb': pdb,
+                   'psf': self.baseName + '_CHARMM.psf',
+                   'min': self.baseName + '_CHARMM_min.pdb'}
+        inpFile = open(os.path.join(charmmDir, inp), 'w')
+        inpFile.write("* " + head % (inp, date))
+        inpFile.write(inpData % dictInp)
+        inpFile.close()
 
     def writePdb(self, file_):
         """
@@ -1853,6 +3907,7 @@ a        """
             atom name
         """
         # TODO: assuming only one residue ('1')
+        self.buildSections('pdb')
         pdbFile = open(file_, 'w')
         fbase = os.path.basename(file_)
         pdbFile.write("REMARK " + head % (fbase, date))
@@ -1980,11 +4035,19 @@ a        """
 
         self.printMess("Writing GROMACS files\n")
 
-        self.setAtomType4Gromacs()
+        self.buildSections('gmx')
 
         self.writeGroFile()
 
-        self.writeGromacsTop(amb2gmx=amb2gmx)
+        pool = None
+        if multiprocessing.cpu_count() > 1 and len(self.atoms) > gmxPoolAtoms:
+            pool = forkContext().Pool()
+        try:
+            self.writeGromacsTop(amb2gmx=amb2gmx, pool=pool)
+        finally:
+            if pool:  # results all taken, or failed
+                pool.terminate()
+                pool.join()
 
         self.writeMdpFiles()
 
@@ -1992,74 +4055,57 @@ a        """
         """Atom types names in Gromacs TOP file are not case sensitive;
            this routine will append a '_' to lower case atom type.
            E.g.: CA and ca -> CA and ca_
+           A lower case type of same LJ type as its upper case one is merged
+           into it instead. Only the type table is remapped: atomTypesGromacs
+           and atomTypeIdsGromacs, the index in it of each atom type (prmtop
+           order, as atomTypeIds).
         """
         if self.disam:
             self.printMess("Disambiguating lower and uppercase atomtypes in GMX top file.\n")
             self.atomTypesGromacs = self.atomTypes
-            self.atomsGromacs = self.atoms
+            self.atomTypeIdsGromacs = self.atomTypeIds
             return
 
-        atNames = [at.atomTypeName for at in self.atomTypes]
-        # print atNames
-        delAtomTypes = []
-        modAtomTypes = []
+        typeIds = dict((at.atomTypeName, i) for i, at in enumerate(self.atomTypes))
         atomTypesGromacs = []
-        dictAtomTypes = {}
-        for at in self.atomTypes:
+        remap = np.zeros(len(self.atomTypes), dtype=np.int32)
+        merged = []
+        for typeId, at in enumerate(self.atomTypes):
             atName = at.atomTypeName
-            dictAtomTypes[atName] = at
-            if atName.islower() and atName.upper() in atNames:
-                # print atName, atName.upper()
-                atUpper = self.atomTypes[atNames.index(atName.upper())]
-                # print at.atomTypeName,at.mass, at.ACOEF, at.BCOEF
-                # print atUpper.atomTypeName, atUpper.mass, atUpper.ACOEF, atUpper.BCOEF
-                if at.ACOEF is atUpper.ACOEF and at.BCOEF is at.BCOEF:
-                    delAtomTypes.append(atName)
-                else:
-                    newAtName = atName + '_'
-                    modAtomTypes.append(atName)
-                    atomType = AtomType(newAtName, at.mass, at.ACOEF, at.BCOEF)
-                    atomTypesGromacs.append(atomType)
-                    dictAtomTypes[newAtName] = atomType
-            else:
+            upperId = typeIds.get(atName.upper()) if atName.islower() else None
+            if upperId is None:
+                remap[typeId] = len(atomTypesGromacs)
                 atomTypesGromacs.append(at)
-
-        atomsGromacs = []
-        for a in self.atoms:
-            atName = a.atomType.atomTypeName
-            if atName in delAtomTypes:
-                atom = Atom(a.atomName, dictAtomTypes[atName.upper()], a.id,
-                            a.resid, a.mass, a.charge, a.coords)
-                atom.cgnr = a.cgnr
-                atomsGromacs.append(atom)
-            elif atName in modAtomTypes:
-                atom = Atom(a.atomName, dictAtomTypes[atName + '_'], a.id,
-                            a.resid, a.mass, a.charge, a.coords)
-                atom.cgnr = a.cgnr
-                atomsGromacs.append(atom)
+            elif self.atomTypeLJIds[typeId] == self.atomTypeLJIds[upperId]:
+                merged.append((typeId, upperId))
             else:
-                atomsGromacs.append(a)
+                remap[typeId] = len(atomTypesGromacs)
+                atomTypesGromacs.append(AtomType(atName + '_', at.mass, at.ACOEF, at.BCOEF))
+        for typeId, upperId in merged:
+            remap[typeId] = remap[upperId]
 
         self.atomTypesGromacs = atomTypesGromacs
-        self.atomsGromacs = atomsGromacs
-        # print [i.atomTypeName for i in atomTypesGromacs]
-        # print modAtomTypes
-        # print delAtomTypes
+        self.atomTypeIdsGromacs = remap[self.atomTypeIds]
 
-    def writeGromacsTop(self, amb2gmx=False):
+    def writeGromacsTop(self, amb2gmx=False, pool=None):
         if self.atomTypeSystem == 'amber':
             d2opls = dictAtomTypeAmb2OplsGmxCode
         else:
             d2opls = dictAtomTypeGaff2OplsGmxCode
 
-        topText = []
-        itpText = []
-        oitpText = []
-        otopText = []
         top = self.baseName + '_GMX.top'
         itp = self.baseName + '_GMX.itp'
         otop = self.baseName + '_GMX_OPLS.top'
         oitp = self.baseName + '_GMX_OPLS.itp'
+        # files written as their text is built, section by section
+        gmxDir = os.path.abspath('.')
+        topText = TextStream(os.path.join(gmxDir, top))
+        if amb2gmx:
+            itpText, oitpText, otopText = TextStream(), TextStream(), TextStream()
+        else:
+            itpText = TextStream(os.path.join(gmxDir, itp))
+            oitpText = TextStream(os.path.join(gmxDir, oitp))
+            otopText = TextStream(os.path.join(gmxDir, otop))
 
         headDefault = \
             """
@@ -2091,6 +4137,16 @@ a        """
             """
 [ atomtypes ]
 ;name   bond_type     mass     charge   ptype   sigma         epsilon       Amb
+"""
+        headNonbondParams = \
+            """
+[ nonbond_params ]
+;name1    name2    func  sigma         epsilon
+"""
+        headPairtypes = \
+            """
+[ pairtypes ]
+;name1    name2    func  sigma         epsilon ; fudgeLJ 0.5 applied
 """
         headAtomtypesOpls = \
             """
@@ -2117,6 +4173,11 @@ a        """
             """
 [ pairs ]
 ;   ai     aj    funct
+"""
+        headExclusions = \
+            """
+[ exclusions ]
+;   ai     aj
 """
         headAngles = \
             """
@@ -2325,6 +4386,20 @@ a        """
             # tmpFile.write(line)
             temp.append(line)
             otemp.append(oline)
+
+        # pair-specific LJ terms (NBFIX) the combination rule misses; as
+        # pairtypes too, or gen-pairs would use the rule for 1-4 pairs
+        nbfix = self.getNonbondParams()
+        if nbfix:
+            self.printMess("%i pair-specific LJ terms (NBFIX) written as [ nonbond_params ], not in OPLS files\n"
+                           % len(nbfix))
+            names = [t.atomTypeName for t in self.atomTypesGromacs]
+            temp.append(headNonbondParams)
+            for i, j, sigma, epsilon in nbfix:
+                temp.append(" %-8s %-8s  1   %13.5e %13.5e\n" % (names[i], names[j], sigma, epsilon))
+            temp.append(headPairtypes)
+            for i, j, sigma, epsilon in nbfix:
+                temp.append(" %-8s %-8s  1   %13.5e %13.5e\n" % (names[i], names[j], sigma, 0.5 * epsilon))
         if amb2gmx:
             topText.append(headAtomtypes)
             topText += temp
@@ -2349,300 +4424,225 @@ a        """
             # topText.append(headTopWater)
             self.printDebug("type of water '%s'" % headWater[43:48].strip())
 
-        if nSolute:
-            if amb2gmx:
-                topText.append(headMoleculetype % self.baseName)
-            else:
-                itpText.append(headMoleculetype % self.baseName)
-                oitpText.append(headMoleculetype % self.baseName)
-
-        self.printDebug("atoms %i" % len(self.atoms))
-        qtot = 0.0
-        count = 1
-        temp = []
-        otemp = []
-        id2oplsATDict = {}
-        for atom in self.atomsGromacs:
-            resid = atom.resid
-            resname = self.residueLabel[resid]
-            if not self.direct:
-                if resname in list(ionsDict.keys()) + ['WAT']:
-                    break
-            aName = atom.atomName
-            aType = atom.atomType.atomTypeName
-            oItem = d2opls.get(aType, ['x', 0])
-            oplsAtName = oplsCode2AtomTypeDict.get(oItem[0], 'x')
-            id_ = atom.id
-            id2oplsATDict[id_] = oplsAtName
-            oaCode = 'opls_' + oItem[0]
-            cgnr = id_
-            if self.sorted:
-                cgnr = atom.cgnr  # JDC
-            charge = atom.charge
-            mass = atom.mass
-            omass = float(oItem[-1])
-            qtot += charge
-            resnr = resid + 1
-            line = "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot %1.3f\n" % \
-                (id_, aType, resnr, resname, aName, cgnr, charge, mass, qtot)  # JDC
-            oline = "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot % 3.3f  %-4s\n" % \
-                (id_, oaCode, resnr, resname, aName, cgnr, charge, omass, qtot, oplsAtName)  # JDC
-            count += 1
-            temp.append(line)
-            otemp.append(oline)
-        if temp:
-            if amb2gmx:
-                topText.append(headAtoms)
-                topText += temp
-            else:
-                itpText.append(headAtoms)
-                itpText += temp
-                oitpText.append(headAtoms)
-                oitpText += otemp
-        self.printDebug("GMX atoms done")
-
-        # remove bond of water
-        self.printDebug("bonds %i" % len(self.bonds))
-        temp = []
-        otemp = []
-        for bond in self.bonds:
-            res1 = self.residueLabel[bond.atoms[0].resid]
-            res2 = self.residueLabel[bond.atoms[0].resid]
-            if 'WAT' in [res1, res2]:
-                continue
-            a1Name = bond.atoms[0].atomName
-            a2Name = bond.atoms[1].atomName
-            id1 = bond.atoms[0].id
-            id2 = bond.atoms[1].id
-            oat1 = id2oplsATDict.get(id1)
-            oat2 = id2oplsATDict.get(id2)
-            line = "%6i %6i %3i %13.4e %13.4e ; %6s - %-6s\n" % (id1, id2, 1,
-                                                                 bond.rEq * 0.1, bond.kBond * 200 * cal, a1Name, a2Name)
-            oline = "%6i %6i %3i ; %13.4e %13.4e ; %6s - %-6s %6s - %-6s\n" % \
-                (id1, id2, 1, bond.rEq * 0.1, bond.kBond * 200 * cal, a1Name,
-                 a2Name, oat1, oat2)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headBonds)
-                topText += temp
-            else:
-                itpText.append(headBonds)
-                itpText += temp
-                oitpText.append(headBonds)
-                oitpText += otemp
-        self.printDebug("GMX bonds done")
-
-        self.printDebug("atomPairs %i" % len(self.atomPairs))
-        temp = []
-        for pair in self.atomPairs:
-            # if not printed:
-            #    tmpFile.write(headPairs)
-            #    printed = True
-            a1Name = pair[0].atomName
-            a2Name = pair[1].atomName
-            id1 = pair[0].id
-            id2 = pair[1].id
-            # id1 = self.atoms.index(pair[0]) + 1
-            # id2 = self.atoms.index(pair[1]) + 1
-            line = "%6i %6i %6i ; %6s - %-6s\n" % (id1, id2, 1, a1Name,
-                                                   a2Name)
-            temp.append(line)
-        temp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headPairs)
-                topText += temp
-            else:
-                itpText.append(headPairs)
-                itpText += temp
-                oitpText.append(headPairs)
-                oitpText += temp
-        self.printDebug("GMX pairs done")
-
-        self.printDebug("angles %i" % len(self.angles))
-        temp = []
-        otemp = []
-        for angle in self.angles:
-            a1 = angle.atoms[0].atomName
-            a2 = angle.atoms[1].atomName
-            a3 = angle.atoms[2].atomName
-            id1 = angle.atoms[0].id
-            id2 = angle.atoms[1].id
-            id3 = angle.atoms[2].id
-            oat1 = id2oplsATDict.get(id1)
-            oat2 = id2oplsATDict.get(id2)
-            oat3 = id2oplsATDict.get(id3)
-            line = "%6i %6i %6i %6i %13.4e %13.4e ; %6s - %-6s - %-6s\n" % (id1, id2,
-                                                                            id3, 1, angle.thetaEq * radPi, 2 * cal * angle.kTheta, a1, a2, a3)
-            oline = "%6i %6i %6i %6i ; %13.4e %13.4e ; %6s - %-4s - %-6s %4s - %+4s - %-4s\n" % \
-                (id1, id2, id3, 1, angle.thetaEq * radPi, 2 * cal * angle.kTheta,
-                 a1, a2, a3, oat1, oat2, oat3)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headAngles)
-                topText += temp
-            else:
-                itpText.append(headAngles)
-                itpText += temp
-                oitpText.append(headAngles)
-                oitpText += otemp
-        self.printDebug("GMX angles done")
-
-        self.setProperDihedralsCoef()
         self.printDebug("properDihedralsCoefRB %i" % len(self.properDihedralsCoefRB))
         self.printDebug("properDihedralsAlphaGamma %i" % len(self.properDihedralsAlphaGamma))
         self.printDebug("properDihedralsGmx45 %i" % len(self.properDihedralsGmx45))
-        temp = []
-        otemp = []
-        if not self.gmx45:
-            for dih in self.properDihedralsCoefRB:
-                a1 = dih[0][0].atomName
-                a2 = dih[0][1].atomName
-                a3 = dih[0][2].atomName
-                a4 = dih[0][3].atomName
-                id1 = dih[0][0].id
-                id2 = dih[0][1].id
-                id3 = dih[0][2].id
-                id4 = dih[0][3].id
-                oat1 = id2oplsATDict.get(id1)
-                oat2 = id2oplsATDict.get(id2)
-                oat3 = id2oplsATDict.get(id3)
-                oat4 = id2oplsATDict.get(id4)
-                c0, c1, c2, c3, c4, c5 = dih[1]
-                line = \
-                    "%6i %6i %6i %6i %6i %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
-                    (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
-                    + " ; %6s-%6s-%6s-%6s\n" % (a1, a2, a3, a4)
-                oline = \
-                    "%6i %6i %6i %6i %6i ; %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
-                    (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
-                    + " ; %6s-%6s-%6s-%6s    %4s-%4s-%4s-%4s\n" % (a1, a2, a3, a4, oat1, oat2, oat3, oat4)
-                temp.append(line)
-                otemp.append(oline)
-            temp.sort()
-            otemp.sort()
-            if temp:
-                if amb2gmx:
-                    topText.append(headProDih)
-                    topText += temp
-                else:
-                    itpText.append(headProDih)
-                    itpText += temp
-                    oitpText.append(headProDih)
-                    oitpText += otemp
-            self.printDebug("GMX proper dihedrals done")
-        else:
-            self.printMess("Writing GMX dihedrals for GMX 4.5.\n")
-            funct = 9  # 9
-            for dih in self.properDihedralsGmx45:
-                a1 = dih[0][0].atomName
-                a2 = dih[0][1].atomName
-                a3 = dih[0][2].atomName
-                a4 = dih[0][3].atomName
-                id1 = dih[0][0].id
-                id2 = dih[0][1].id
-                id3 = dih[0][2].id
-                id4 = dih[0][3].id
-                ph = dih[1]  # phase already in degree
-                kd = dih[2] * cal  # kPhi PK
-                pn = dih[3]  # .period
-                line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                    (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-                oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                    (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-                temp.append(line)
-                otemp.append(oline)
-            temp.sort()
-            otemp.sort()
-            if temp:
-                if amb2gmx:
-                    topText.append(headProDihGmx45)
-                    topText += temp
-                else:
-                    itpText.append(headProDihGmx45)
-                    itpText += temp
-                    oitpText.append(headProDihGmx45)
-                    oitpText += otemp
 
-        # for properDihedralsAlphaGamma
+        # in amb2gmx mode, every unique molecule of the solute (e.g. CNT, lipids)
+        # gets its own moleculetype, written once and counted in [ molecules ]
+        molTypes = [(self.baseName, None)]
+        molecules = [(self.baseName, nSolute)]
+        if amb2gmx and nSolute:
+            nSoluteAtoms = len(self.atoms)
+            if not self.direct:
+                for atom in self.atoms:
+                    if self.residueLabel[atom.resid] in list(ionsDict.keys()) + ['WAT']:
+                        nSoluteAtoms = atom.id - 1
+                        break
+            molTypes, molecules = self.getUniqueMolecules(nSoluteAtoms)
+            self.printDebug("moleculetypes %i, molecules %i" % (len(molTypes), sum([x[1] for x in molecules])))
+
+        # for properDihedralsAlphaGamma and improperDihedrals
         if self.gmx45:
+            self.printMess("Writing GMX dihedrals for GMX 4.5.\n")
             funct = 4  # 4
         else:
             funct = 1
-        temp = []
-        otemp = []
-        for dih in self.properDihedralsAlphaGamma:
-            a1 = dih[0][0].atomName
-            a2 = dih[0][1].atomName
-            a3 = dih[0][2].atomName
-            a4 = dih[0][3].atomName
-            id1 = dih[0][0].id
-            id2 = dih[0][1].id
-            id3 = dih[0][2].id
-            id4 = dih[0][3].id
-            ph = dih[1]  # phase already in degree
-            kd = dih[2] * cal  # kPhi PK
-            pn = dih[3]  # .period
-            line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headProDihAlphaGamma)
-                topText += temp
+
+        # GMX atom type name by atom index, see setAtomType4Gromacs
+        typeOf = [self.atomTypesGromacs[i].atomTypeName for i in self.atomTypeIdsGromacs.tolist()]
+
+        for molName, terms in molTypes:
+            if terms is None:
+                terms = {'atoms': self.atoms, 'bonds': self.bonds,
+                         'pairs': self.atomPairs, 'angles': self.angles,
+                         'dihRB': self.properDihedralsCoefRB,
+                         'dihGmx45': self.properDihedralsGmx45,
+                         'dihAlphaGamma': self.properDihedralsAlphaGamma,
+                         'improper': self.improperDihedrals,
+                         'exclusions': self.extraExclusions}
+                off = cgOff = resOff = 0
             else:
-                itpText.append(headProDihAlphaGamma)
-                itpText += temp
-                oitpText.append(headProDihAlphaGamma)
-                oitpText += otemp
-        self.printDebug("GMX special proper dihedrals done")
+                firstAtom = terms['atoms'][0]
+                off = firstAtom.id - 1
+                cgOff = firstAtom.cgnr - 1
+                resOff = firstAtom.resid
 
-        self.printDebug("improperDihedrals %i" % len(self.improperDihedrals))
-        temp = []
-        otemp = []
-        for dih in self.improperDihedrals:
-            a1 = dih.atoms[0].atomName
-            a2 = dih.atoms[1].atomName
-            a3 = dih.atoms[2].atomName
-            a4 = dih.atoms[3].atomName
-            id1 = dih.atoms[0].id
-            id2 = dih.atoms[1].id
-            id3 = dih.atoms[2].id
-            id4 = dih.atoms[3].id
-            kd = dih.kPhi * cal
-            pn = dih.period
-            ph = dih.phase * radPi
-            line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headImpDih)
-                topText += temp
+            if nSolute:
+                if amb2gmx:
+                    topText.append(headMoleculetype % molName)
+                else:
+                    itpText.append(headMoleculetype % molName)
+                    oitpText.append(headMoleculetype % molName)
+
+            # sections are built as rows (ids from the numbering arrays) sorted
+            # numerically, then formatted in chunks and written at once
+            def addSection(head, rows, fmt, ofmt, fields=None, ofields=None):
+                if not rows:
+                    return
+                tasks = []
+                for i in range(0, len(rows), gmxChunkSize):
+                    chunk = rows[i:i + gmxChunkSize]
+                    if amb2gmx:
+                        tasks.append((topText, (fmt, fields, chunk)))
+                    else:
+                        tasks.append((itpText, (fmt, fields, chunk)))
+                        tasks.append((oitpText, (ofmt, ofields, chunk)))
+                if amb2gmx:
+                    topText.append(head)
+                else:
+                    itpText.append(head)
+                    oitpText.append(head)
+                writeTasks(tasks, pool)
+
+            def termIds(atomLists, nIds):
+                idx = np.array([[a.index for a in atoms] for atoms in atomLists], dtype=int)
+                return (self.atomNumbering.id[idx.reshape(-1, nIds)] - off).tolist()
+
+            self.printDebug("atoms %i" % len(terms['atoms']))
+            qtot = 0.0
+            rows = []
+            id2oplsATDict = {}
+            for atom in terms['atoms']:
+                resid = atom.resid
+                resname = self.residueLabel[resid]
+                if not self.direct:
+                    if resname in list(ionsDict.keys()) + ['WAT']:
+                        break
+                aName = atom.atomName
+                aType = typeOf[atom.index]
+                oItem = d2opls.get(aType, ['x', 0])
+                oplsAtName = oplsCode2AtomTypeDict.get(oItem[0], 'x')
+                id_ = atom.id - off
+                id2oplsATDict[id_] = oplsAtName
+                oaCode = 'opls_' + oItem[0]
+                cgnr = id_
+                if self.sorted:
+                    cgnr = atom.cgnr - cgOff  # JDC
+                charge = atom.charge
+                mass = atom.mass
+                omass = float(oItem[-1])
+                qtot += charge
+                resnr = resid - resOff + 1
+                rows.append((id_, aType, resnr, resname, aName, cgnr, charge, mass,
+                             qtot, oaCode, omass, oplsAtName))
+            addSection(headAtoms, rows,
+                       "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot %1.3f\n",
+                       "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot % 3.3f  %-4s\n",
+                       (0, 1, 2, 3, 4, 5, 6, 7, 8), (0, 9, 2, 3, 4, 5, 6, 10, 8, 11))  # JDC
+            self.printDebug("GMX atoms done")
+
+            # remove bond of water
+            self.printDebug("bonds %i" % len(terms['bonds']))
+            bonds = []
+            for bond in terms['bonds']:
+                res1 = self.residueLabel[bond.atoms[0].resid]
+                res2 = self.residueLabel[bond.atoms[0].resid]
+                if 'WAT' in [res1, res2]:
+                    continue
+                bonds.append(bond)
+            rows = []
+            for (id1, id2), bond in zip(termIds([b.atoms for b in bonds], 2), bonds):
+                rows.append((id1, id2, 1, bond.rEq * 0.1, bond.kBond * 200 * cal,
+                             bond.atoms[0].atomName, bond.atoms[1].atomName,
+                             id2oplsATDict.get(id1), id2oplsATDict.get(id2)))
+            rows.sort()
+            addSection(headBonds, rows,
+                       "%6i %6i %3i %13.4e %13.4e ; %6s - %-6s\n",
+                       "%6i %6i %3i ; %13.4e %13.4e ; %6s - %-6s %6s - %-6s\n",
+                       (0, 1, 2, 3, 4, 5, 6))
+            self.printDebug("GMX bonds done")
+
+            self.printDebug("atomPairs %i" % len(terms['pairs']))
+            pairs = terms['pairs']
+            rows = [(id1, id2, 1, pair[0].atomName, pair[1].atomName)
+                    for (id1, id2), pair in zip(termIds(pairs, 2), pairs)]
+            rows.sort()
+            fmt = "%6i %6i %6i ; %6s - %-6s\n"
+            addSection(headPairs, rows, fmt, fmt)
+            self.printDebug("GMX pairs done")
+
+            self.printDebug("angles %i" % len(terms['angles']))
+            angles = terms['angles']
+            rows = []
+            for (id1, id2, id3), angle in zip(termIds([a.atoms for a in angles], 3), angles):
+                rows.append((id1, id2, id3, 1, angle.thetaEq * radPi, 2 * cal * angle.kTheta,
+                             angle.atoms[0].atomName, angle.atoms[1].atomName,
+                             angle.atoms[2].atomName, id2oplsATDict.get(id1),
+                             id2oplsATDict.get(id2), id2oplsATDict.get(id3)))
+            rows.sort()
+            addSection(headAngles, rows,
+                       "%6i %6i %6i %6i %13.4e %13.4e ; %6s - %-6s - %-6s\n",
+                       "%6i %6i %6i %6i ; %13.4e %13.4e ; %6s - %-4s - %-6s %4s - %+4s - %-4s\n",
+                       (0, 1, 2, 3, 4, 5, 6, 7, 8))
+            self.printDebug("GMX angles done")
+
+            if not self.gmx45:
+                dihs = terms['dihRB']
+                rows = []
+                for ids, dih in zip(termIds([d[0] for d in dihs], 4), dihs):
+                    names = tuple([a.atomName for a in dih[0]])
+                    oats = tuple([id2oplsATDict.get(i) for i in ids])
+                    rows.append(tuple(ids) + (3,) + tuple(dih[1]) + names + oats)
+                rows.sort()
+                addSection(headProDih, rows,
+                           "%6i %6i %6i %6i %6i %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f"
+                           " ; %6s-%6s-%6s-%6s\n",
+                           "%6i %6i %6i %6i %6i ; %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f"
+                           " ; %6s-%6s-%6s-%6s    %4s-%4s-%4s-%4s\n",
+                           tuple(range(15)))
+                self.printDebug("GMX proper dihedrals done")
             else:
-                itpText.append(headImpDih)
-                itpText += temp
-                oitpText.append(headImpDih)
-                oitpText += otemp
-        self.printDebug("GMX improper dihedrals done")
+                dihs = terms['dihGmx45']
+                rows = []
+                for ids, dih in zip(termIds([d[0] for d in dihs], 4), dihs):
+                    # phase already in degree, kPhi PK, period
+                    rows.append(tuple(ids) + (9, dih[1], dih[2] * cal, dih[3]) +
+                                tuple([a.atomName for a in dih[0]]))
+                rows.sort()
+                addSection(headProDihGmx45, rows,
+                           "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                           "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n")
+
+            # for properDihedralsAlphaGamma
+            dihs = terms['dihAlphaGamma']
+            rows = []
+            for ids, dih in zip(termIds([d[0] for d in dihs], 4), dihs):
+                rows.append(tuple(ids) + (funct, dih[1], dih[2] * cal, dih[3]) +
+                            tuple([a.atomName for a in dih[0]]))
+            rows.sort()
+            addSection(headProDihAlphaGamma, rows,
+                       "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                       "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n")
+            self.printDebug("GMX special proper dihedrals done")
+
+            self.printDebug("improperDihedrals %i" % len(terms['improper']))
+            dihs = terms['improper']
+            rows = []
+            for ids, dih in zip(termIds([d.atoms for d in dihs], 4), dihs):
+                rows.append(tuple(ids) + (funct, dih.phase * radPi, dih.kPhi * cal, dih.period) +
+                            tuple([a.atomName for a in dih.atoms]))
+            rows.sort()
+            addSection(headImpDih, rows,
+                       "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                       "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n")
+            self.printDebug("GMX improper dihedrals done")
+
+            # only what nrexcl 3 does not already exclude, see checkExclusions
+            exclusions = terms['exclusions']
+            if not self.direct:
+                solvent = list(ionsDict.keys()) + ['WAT']
+                exclusions = [x for x in exclusions if self.residueLabel[x[0].resid] not in solvent and
+                              self.residueLabel[x[1].resid] not in solvent]
+            rows = []
+            for (id1, id2), pair in zip(termIds(exclusions, 2), exclusions):
+                if id1 > id2:  # sorted atoms
+                    id1, id2, pair = id2, id1, pair[::-1]
+                rows.append((id1, id2, pair[0].atomName, pair[1].atomName))
+            rows.sort()
+            fmt = "%6i %6i ; %6s - %-6s\n"
+            addSection(headExclusions, rows, fmt, fmt)
+            self.printDebug("GMX exclusions done")
 
         if not self.direct:
             for ion in ionsSorted:
@@ -2656,9 +4656,10 @@ a        """
         otopText.append(headSystem % (self.baseName))
         otopText.append(headMols)
 
-        if nSolute > 0:
-            topText.append(" %-16s %-6i\n" % (self.baseName, nSolute))
-            otopText.append(" %-16s %-6i\n" % (self.baseName, nSolute))
+        for molName, nMols in molecules:
+            if nMols > 0:
+                topText.append(" %-16s %-6i\n" % (molName, nMols))
+                otopText.append(" %-16s %-6i\n" % (molName, nMols))
 
         if not self.direct:
             for ion in ionsSorted:
@@ -2667,25 +4668,215 @@ a        """
             if nWat:
                 topText.append(" %-16s %-6i\n" % ('WAT', nWat))
 
-        gmxDir = os.path.abspath('.')
-        topFileName = os.path.join(gmxDir, top)
-        topFile = open(topFileName, 'w')
-        topFile.writelines(topText)
+        for stream in [topText, itpText, oitpText, otopText]:
+            stream.close()
 
-        if not amb2gmx:
-            itpFileName = os.path.join(gmxDir, itp)
-            itpFile = open(itpFileName, 'w')
-            itpFile.writelines(itpText)
-            oitpFileName = os.path.join(gmxDir, oitp)
-            oitpFile = open(oitpFileName, 'w')
-            oitpFile.writelines(oitpText)
-            otopFileName = os.path.join(gmxDir, otop)
-            otopFile = open(otopFileName, 'w')
-            otopFile.writelines(otopText)
+    def writeAmberTopol(self):
+        """
+            Writes the topology as Amber prmtop and inpcrd files, with no
+            tleap run, atoms in prmtop order. Parameter tables are made of
+            the unique parameters of the terms, in order of use; LJ
+            coefficients are those of prmtop, NBFIX included, but 10-12 ones
+            (see getLJMatrix) are lost, with a warning; exclusions are the
+            atoms up to 3 bonds away (bondExclusions) and 1-4 interactions
+            those of atomPairs. Elements (atomic numbers, GB radii) are told by mass,
+            with any HMR undone.
+        """
+        self.buildSections('amber')
+        self.printMess("Writing AMBER files\n")
+        atoms = self.prmtopAtoms
+        nAtoms = len(atoms)
+        # elements by mass, once hydrogens (< 4.1) are back to 1.008 and the
+        # heavy atoms bonded to them given back any mass taken by HMR
+        masses = np.array([a.mass for a in atoms], dtype=float)
+        hydrogen = masses < 4.1
+        hBonds = self.bondIndex[hydrogen[self.bondIndex[:, 0]] != hydrogen[self.bondIndex[:, 1]]]
+        hydrogens, first = np.unique(np.where(hydrogen[hBonds[:, 0]], hBonds[:, 0], hBonds[:, 1]),
+                                     return_index=True)
+        heavies = np.where(hydrogen[hBonds[:, 0]], hBonds[:, 1], hBonds[:, 0])[first]
+        elementMasses = masses.copy()
+        elementMasses[hydrogen] = 1.008
+        np.add.at(elementMasses, heavies, masses[hydrogens] - 1.008)
+        elements = [atomElement(m) for m in elementMasses.tolist()]
+        isH = np.array([e[0] == 1 for e in elements], dtype=bool)
+        indptr, indices = self.adjacency
+
+        def table(terms, nIds, params):
+            """codes (3 * atom index, ..., parameter index), with H ones first, and parameters
+            numbered in order of use by the terms without H and then with H"""
+            ids = np.array([[a.index for a in t.atoms] for t in terms], dtype=np.int64).reshape(-1, nIds)
+            withH = isH[ids].any(axis=1)
+            uniq = {}
+            for i in np.argsort(withH, kind='mergesort').tolist():
+                uniq.setdefault(params[i], len(uniq))
+            typeIds = np.array([uniq[p] + 1 for p in params], dtype=np.int64)
+            codes = np.column_stack((3 * ids, typeIds))
+            return codes[withH], codes[~withH], sorted(uniq, key=uniq.get)
+
+        bondsH, bonds, bondParams = table(self.bonds, 2, [(b.kBond, b.rEq) for b in self.bonds])
+        anglesH, angles, angleParams = table(self.angles, 3, [(a.kTheta, a.thetaEq) for a in self.angles])
+        dihsH, dihs, dihParams = table(self.properDihedrals + self.improperDihedrals, 4,
+                                       [(d.kPhi, d.period, d.phase, False) for d in self.properDihedrals] +
+                                       [(d.kPhi, d.period, d.phase, True) for d in self.improperDihedrals])
+        # 1-4 interactions once per pair, by the first proper dihedral with it;
+        # negative 3rd index to skip them, negative 4th for impropers, so
+        # quartets with atom 0 there are reversed
+        pairs = set([(min(a1.index, a4.index), max(a1.index, a4.index)) for a1, a4 in self.atomPairs])
+        for codes in [dihsH, dihs]:
+            for row in codes:
+                improper = dihParams[row[4] - 1][3]
+                key = (min(row[0], row[3]) // 3, max(row[0], row[3]) // 3)
+                skip14 = improper or key not in pairs
+                pairs.discard(key)
+                if row[2] == 0 or row[3] == 0:
+                    row[:4] = row[3::-1].copy()
+                if skip14:
+                    row[2] = -row[2]
+                if improper:
+                    row[3] = -row[3]
+
+        # LJ types used, in order of first atom, with all their pair
+        # coefficients (see getLJMatrix), NBFIX ones as they are
+        used, first = np.unique(self.ljTypeIds, return_index=True)
+        used = used[np.argsort(first)]
+        nTypes = len(used)
+        hBondPairs = np.triu(self.ljHBondPairs[np.ix_(used, used)]).sum()
+        if hBondPairs:
+            self.printWarn("%i 10-12 (H-bond) LJ type pairs written as 6-12 ones with A = B = 0:"
+                           " their HBOND_ACOEF/HBOND_BCOEF terms are lost" % hBondPairs)
+        ljTypeIds = np.zeros(len(self.ljACOEFs), dtype=np.int64)
+        ljTypeIds[used] = np.arange(nTypes)
+        ljTypeIds = ljTypeIds[self.ljTypeIds]
+        ii, jj = np.tril_indices(nTypes)  # row by row, as in prmtop
+        pairA = self.ljACOEFs[used[ii], used[jj]]
+        pairB = self.ljBCOEFs[used[ii], used[jj]]
+        tri = np.arange(1, nTypes + 1)
+        tri = np.maximum.outer(tri, tri) * (np.maximum.outer(tri, tri) - 1) // 2 + np.minimum.outer(tri, tri)
+
+        excl, exclIds, _dists = self.exclusions
+        nExcl = np.diff(excl)
+        exclList = []
+        for i, n in enumerate(nExcl.tolist()):
+            exclList.extend((exclIds[excl[i]:excl[i + 1]] + 1).tolist() if n else [0])
+        nExcl = np.maximum(nExcl, 1)
+
+        resids = np.array([a.resid for a in atoms], dtype=np.int64)
+        _uniq, resStarts = np.unique(resids, return_index=True)
+        resSizes = np.diff(np.append(resStarts, nAtoms))
+        typeNames = [a.atomType.atomTypeName for a in atoms]
+        nAmberTypes = len(set(typeNames))
+        radii = []
+        for i, e in enumerate(elements):
+            radius = e[2]
+            if e[0] == 1 and indptr[i + 1] > indptr[i]:  # mbondi: by the bonded atom
+                bonded = elements[indices[indptr[i]]][0]
+                radius = {6: 1.3, 7: 1.3, 8: 0.8, 16: 0.8}.get(bonded, 1.2)
+            radii.append(radius)
+
+        box = []
+        ifBox = 0
+        if self.pbc:
+            (a, b, c), (_alpha, beta, _gamma) = self.pbc
+            ifBox = 2 if abs(beta - 109.4712206) < 1e-3 else 1
+            # molecules: connected components merged into contiguous blocks
+            labels = np.arange(nAtoms)
+            bondIds = self.bondIndex
+            while len(bondIds):
+                low = np.minimum(labels[bondIds[:, 0]], labels[bondIds[:, 1]])
+                new = labels.copy()
+                np.minimum.at(new, bondIds[:, 0], low)
+                np.minimum.at(new, bondIds[:, 1], low)
+                new = new[new]
+                if (new == labels).all():
+                    break
+                labels = new
+            last = np.zeros(nAtoms, dtype=np.int64)
+            np.maximum.at(last, labels, np.arange(nAtoms))
+            molStarts = []
+            molEnd = 0
+            for start in np.unique(labels).tolist():
+                if molStarts and start < molEnd:
+                    molEnd = max(molEnd, last[start] + 1)
+                else:
+                    molStarts.append(start)
+                    molEnd = last[start] + 1
+            molSizes = np.diff(np.append(molStarts, nAtoms))
+            solute = [i for i, r in enumerate(self.residueLabel) if r not in ionOrSolResNameList]
+            lastSolute = solute[-1] + 1 if solute else 0
+            firstSolvent = len(molStarts) + 1
+            if lastSolute < len(self.residueLabel):
+                firstSolvent = int(np.searchsorted(molStarts, resStarts[lastSolute], side='right'))
+            box = (prmtopSection('SOLVENT_POINTERS', '3I8', [lastSolute, len(molStarts), firstSolvent]) +
+                   prmtopSection('ATOMS_PER_MOLECULE', '10I8', molSizes.tolist()) +
+                   prmtopSection('BOX_DIMENSIONS', '5E16.8', [beta, a, b, c]))
+
+        pointers = [nAtoms, nTypes, len(bondsH), len(bonds), len(anglesH), len(angles),
+                    len(dihsH), len(dihs), 0, 0,
+                    len(exclList), len(self.residueLabel), len(bonds), len(angles), len(dihs),
+                    len(bondParams), len(angleParams), len(dihParams), nAmberTypes, 0,
+                    0, 0, 0, 0, 0, 0, 0, ifBox, int(resSizes.max()) if nAtoms else 0, 0,
+                    0]
+        lines = ['%-80s' % ('%%VERSION  VERSION_STAMP = V0001.000  DATE = %s'
+                            % datetime.now().strftime('%m/%d/%y  %H:%M:%S'))]
+        sections = [('TITLE', '20a4', [self.baseName[:80]]),
+                    ('POINTERS', '10I8', pointers),
+                    ('ATOM_NAME', '20a4', [a.atomName for a in atoms]),
+                    ('CHARGE', '5E16.8', [a.charge * qConv for a in atoms]),
+                    ('ATOMIC_NUMBER', '10I8', [e[0] for e in elements]),
+                    ('MASS', '5E16.8', [a.mass for a in atoms]),
+                    ('ATOM_TYPE_INDEX', '10I8', (ljTypeIds + 1).tolist()),
+                    ('NUMBER_EXCLUDED_ATOMS', '10I8', nExcl.tolist()),
+                    ('NONBONDED_PARM_INDEX', '10I8', tri.ravel().tolist()),
+                    ('RESIDUE_LABEL', '20a4', self.residueLabel),
+                    ('RESIDUE_POINTER', '10I8', (resStarts + 1).tolist()),
+                    ('BOND_FORCE_CONSTANT', '5E16.8', [p[0] for p in bondParams]),
+                    ('BOND_EQUIL_VALUE', '5E16.8', [p[1] for p in bondParams]),
+                    ('ANGLE_FORCE_CONSTANT', '5E16.8', [p[0] for p in angleParams]),
+                    ('ANGLE_EQUIL_VALUE', '5E16.8', [p[1] for p in angleParams]),
+                    ('DIHEDRAL_FORCE_CONSTANT', '5E16.8', [p[0] for p in dihParams]),
+                    ('DIHEDRAL_PERIODICITY', '5E16.8', [p[1] for p in dihParams]),
+                    ('DIHEDRAL_PHASE', '5E16.8', [p[2] for p in dihParams]),
+                    ('SCEE_SCALE_FACTOR', '5E16.8', [0.0 if p[3] else 1.2 for p in dihParams]),
+                    ('SCNB_SCALE_FACTOR', '5E16.8', [0.0 if p[3] else 2.0 for p in dihParams]),
+                    ('SOLTY', '5E16.8', [0.0] * nAmberTypes),
+                    ('LENNARD_JONES_ACOEF', '5E16.8', pairA.tolist()),
+                    ('LENNARD_JONES_BCOEF', '5E16.8', pairB.tolist()),
+                    ('BONDS_INC_HYDROGEN', '10I8', bondsH.ravel().tolist()),
+                    ('BONDS_WITHOUT_HYDROGEN', '10I8', bonds.ravel().tolist()),
+                    ('ANGLES_INC_HYDROGEN', '10I8', anglesH.ravel().tolist()),
+                    ('ANGLES_WITHOUT_HYDROGEN', '10I8', angles.ravel().tolist()),
+                    ('DIHEDRALS_INC_HYDROGEN', '10I8', dihsH.ravel().tolist()),
+                    ('DIHEDRALS_WITHOUT_HYDROGEN', '10I8', dihs.ravel().tolist()),
+                    ('EXCLUDED_ATOMS_LIST', '10I8', exclList),
+                    ('HBOND_ACOEF', '5E16.8', []),
+                    ('HBOND_BCOEF', '5E16.8', []),
+                    ('HBCUT', '5E16.8', []),
+                    ('AMBER_ATOM_TYPE', '20a4', typeNames),
+                    ('TREE_CHAIN_CLASSIFICATION', '20a4', ['BLA'] * nAtoms),
+                    ('JOIN_ARRAY', '10I8', [0] * nAtoms),
+                    ('IROTAT', '10I8', [0] * nAtoms)]
+        for flag, fmt, values in sections:
+            lines += prmtopSection(flag, fmt, values)
+        lines += box
+        lines += prmtopSection('RADIUS_SET', '1a80', ['modified Bondi radii (mbondi)'])
+        lines += prmtopSection('RADII', '5E16.8', radii)
+        lines += prmtopSection('SCREEN', '5E16.8', [e[3] for e in elements])
+        lines += prmtopSection('IPOL', '1I8', [0])
+        with open(self.baseName + '_AMBER.prmtop', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        coords = list(itertools.chain(*[a.coords for a in atoms]))
+        text = ('%12.7f' * len(coords)) % tuple(coords)
+        lines = [self.baseName[:80], '%6i' % nAtoms] + [text[i:i + 72] for i in range(0, len(text), 72)]
+        if self.pbc:
+            lines.append(('%12.7f' * 6) % tuple(list(self.pbc[0]) + list(self.pbc[1])))
+        with open(self.baseName + '_AMBER.inpcrd', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
 
     def writeGroFile(self):
         # print "Writing GROMACS GRO file\n"
         self.printDebug("writing GRO file")
+        self.buildSections('gro')
         gro = self.baseName + '_GMX.gro'
         gmxDir = os.path.abspath('.')
         groFileName = os.path.join(gmxDir, gro)
@@ -2755,6 +4946,7 @@ nsteps                   = 1000
         mdMdpFile.write(mdMdp)
 
     def writeCnsTopolFiles(self):
+        self.buildSections('cns')
         autoAngleFlag = True
         autoDihFlag = True
         cnsDir = os.path.abspath('.')
@@ -2782,13 +4974,19 @@ nsteps                   = 1000
         self.writePdb(pdbFileName)
 
         self.printMess("Writing CNS/XPLOR files\n")
+        if self.getNonbondParams():
+            self.printWarn("pair-specific LJ terms (NBFIX) are not written in CNS files")
 
         # print "Writing CNS PAR file\n"
         parFile.write("Remarks " + head % (par, date))
         parFile.write("\nset echo=false end\n")
 
+        # parameters are keyed by their atom types plus the parameters rounded
+        # as printed, so each unique type is written once (in order of first
+        # appearance) in a single pass over the topology; bond and angle types
+        # are canonicalised since reversed types are the same parameter
         parFile.write("\n{ Bonds: atomType1 atomType2 kb r0 }\n")
-        lineSet = []
+        paramDict = {}
         for bond in self.bonds:
             a1Type = bond.atoms[0].atomType.atomTypeName + '_'
             a2Type = bond.atoms[1].atomType.atomTypeName + '_'
@@ -2796,16 +4994,15 @@ nsteps                   = 1000
             if not self.allhdg:
                 kb = bond.kBond
             r0 = bond.rEq
-            line = "BOND %5s %5s %8.1f %8.4f\n" % (a1Type, a2Type, kb, r0)
-            lineRev = "BOND %5s %5s %8.1f %8.4f\n" % (a2Type, a1Type, kb, r0)
-            if line not in lineSet:
-                if lineRev not in lineSet:
-                    lineSet.append(line)
-        for item in lineSet:
-            parFile.write(item)
+            key = (min((a1Type, a2Type), (a2Type, a1Type)),
+                   "%.1f" % kb, "%.4f" % r0)
+            if key not in paramDict:
+                paramDict[key] = True
+                line = "BOND %5s %5s %8.1f %8.4f\n" % (a1Type, a2Type, kb, r0)
+                parFile.write(line)
 
         parFile.write("\n{ Angles: aType1 aType2 aType3 kt t0 }\n")
-        lineSet = []
+        paramDict = {}
         for angle in self.angles:
             a1 = angle.atoms[0].atomType.atomTypeName + '_'
             a2 = angle.atoms[1].atomType.atomTypeName + '_'
@@ -2814,32 +5011,32 @@ nsteps                   = 1000
             if not self.allhdg:
                 kt = angle.kTheta
             t0 = angle.thetaEq * radPi
-            line = "ANGLe %5s %5s %5s %8.1f %8.2f\n" % (a1, a2, a3, kt, t0)
-            lineRev = "ANGLe %5s %5s %5s %8.1f %8.2f\n" % (a3, a2, a1, kt, t0)
-            if line not in lineSet:
-                if lineRev not in lineSet:
-                    lineSet.append(line)
-        for item in lineSet:
-            parFile.write(item)
+            key = (min((a1, a2, a3), (a3, a2, a1)), "%.1f" % kt, "%.2f" % t0)
+            if key not in paramDict:
+                paramDict[key] = True
+                line = "ANGLe %5s %5s %5s %8.1f %8.2f\n" % (a1, a2, a3, kt, t0)
+                parFile.write(line)
 
         parFile.write("\n{ Proper Dihedrals: aType1 aType2 aType3 aType4 kt per\
 iod phase }\n")
-        lineSet = set()
+        paramDict = {}
         for item in self.condensedProperDihedrals:
-            seq = ''
-            id_ = 0
+            dih = item[0]
+            types = tuple([a.atomType.atomTypeName + '_' for a in dih.atoms])
+            terms = []
             for dih in item:
-                # id_ = item.index(dih)
-                l = len(item)
-                a1 = dih.atoms[0].atomType.atomTypeName + '_'
-                a2 = dih.atoms[1].atomType.atomTypeName + '_'
-                a3 = dih.atoms[2].atomType.atomTypeName + '_'
-                a4 = dih.atoms[3].atomType.atomTypeName + '_'
                 kp = 750.0
                 if not self.allhdg:
                     kp = dih.kPhi
-                p = dih.period
-                ph = dih.phase * radPi
+                terms.append((kp, dih.period, dih.phase * radPi))
+            key = (types, tuple([("%.3f" % kp, int(p), "%.2f" % ph)
+                                 for kp, p, ph in terms]))
+            if key in paramDict:
+                continue
+            paramDict[key] = True
+            l = len(item)
+            a1, a2, a3, a4 = types
+            for id_, (kp, p, ph) in enumerate(terms):
                 if l > 1:
                     if id_ == 0:
                         line = "DIHEdral %5s %5s %5s %5s  MULT %1i %7.3f %4i %8\
@@ -2849,45 +5046,32 @@ iod phase }\n")
                 else:
                     line = "DIHEdral %5s %5s %5s %5s %15.3f %4i %8.2f\n" % (a1,
                                                                             a2, a3, a4, kp, p, ph)
-                seq += line
-                id_ += 1
-            lineSet.add(seq)
-        for item in lineSet:
-            parFile.write(item)
+                parFile.write(line)
 
         parFile.write("\n{ Improper Dihedrals: aType1 aType2 aType3 aType4 kt p\
 eriod phase }\n")
-        lineSet = set()
+        impropers = []
         for idh in self.improperDihedrals:
-            a1 = idh.atoms[0].atomType.atomTypeName + '_'
-            a2 = idh.atoms[1].atomType.atomTypeName + '_'
-            a3 = idh.atoms[2].atomType.atomTypeName + '_'
-            a4 = idh.atoms[3].atomType.atomTypeName + '_'
             kp = 750.0
             if not self.allhdg:
                 kp = idh.kPhi
-            p = idh.period
-            ph = idh.phase * radPi
-            line = "IMPRoper %5s %5s %5s %5s %13.1f %4i %8.2f\n" % (a1, a2, a3,
-                                                                    a4, kp, p, ph)
-            lineSet.add(line)
+            impropers.append((idh.atoms, kp, idh.period, idh.phase * radPi))
 
         if self.chiral:
             for idhc in self.chiralGroups:
                 _atc, neig, angle = idhc
-                a1 = neig[0].atomType.atomTypeName + '_'
-                a2 = neig[1].atomType.atomTypeName + '_'
-                a3 = neig[2].atomType.atomTypeName + '_'
-                a4 = neig[3].atomType.atomTypeName + '_'
-                kp = 11000.0
-                p = 0
-                ph = angle
+                impropers.append((neig, 11000.0, 0, angle))
+
+        paramDict = {}
+        for atoms, kp, p, ph in impropers:
+            types = tuple([a.atomType.atomTypeName + '_' for a in atoms[:4]])
+            key = (types, "%.1f" % kp, int(p), "%.2f" % ph)
+            if key not in paramDict:
+                paramDict[key] = True
+                a1, a2, a3, a4 = types
                 line = "IMPRoper %5s %5s %5s %5s %13.1f %4i %8.2f\n" % (a1, a2, a3,
                                                                         a4, kp, p, ph)
-                lineSet.add(line)
-
-        for item in lineSet:
-            parFile.write(item)
+                parFile.write(line)
 
         parFile.write("\n{ Nonbonded: Type Emin sigma; (1-4): Emin/2 sigma }\n")
         for at in self.atomTypes:
@@ -2927,8 +5111,12 @@ eriod phase }\n")
             atName = at.atomName
             atType = at.atomType.atomTypeName + '_'
             charge = at.charge
-            line = "ATOM %-5s TYPE= %-5s CHARGE= %8.4f END\n" % (atName, atType,
-                                                                 charge)
+            if self.hmrMass:  # atom masses differ from their types ones
+                line = "ATOM %-5s TYPE= %-5s CHARGE= %8.4f MASS= %8.4f END\n" % (atName, atType,
+                                                                                 charge, at.mass)
+            else:
+                line = "ATOM %-5s TYPE= %-5s CHARGE= %8.4f END\n" % (atName, atType,
+                                                                     charge)
             topFile.write(line)
 
         topFile.write("\n{ Bonds: atomName1  atomName2 }\n")
@@ -3060,10 +5248,10 @@ stop
         dictInp['CNS_ran'] = self.baseName + '_rand.pdb'
         line = inpData % dictInp
         inpFile.write(line)
-        if os.path.exists(self.obchiralExe):
-            self.printDebug("chiralGroups %i" % len(self.chiralGroups))
-        else:
+        if not os.path.exists(self.obchiralExe):
             self.printDebug("No 'obchiral' to process chiral atoms. Consider installing http://openbabel.org")
+        elif self.chiral:
+            self.printDebug("chiralGroups %i" % len(self.chiralGroups))
 
 
 class ACTopol(AbstractTopol):
@@ -3076,7 +5264,8 @@ class ACTopol(AbstractTopol):
                  multiplicity='1', atomType='gaff', force=False, basename=None,
                  debug=False, outTopol='all', engine='tleap', allhdg=False,
                  timeTol=36000, qprog='sqm', ekFlag=None, verbose=True,
-                 gmx45=False, disam=False, direct=False, is_sorted=False, chiral=False):
+                 gmx45=False, disam=False, direct=False, is_sorted=False, chiral=False,
+                 fragment=0, maxMem=None, hmr=None):
 
         self.debug = debug
         self.verbose = verbose
@@ -3096,6 +5285,7 @@ class ACTopol(AbstractTopol):
         self.baseName = base  # name of the input file without ext.
         self.timeTol = timeTol
         self.printDebug("Max execution time tolerance is %s" % elapsedTime(self.timeTol))
+        self.maxMem = maxMem
         self.ext = ext
         if ekFlag == '"None"' or ekFlag is None:
             self.ekFlag = ''
@@ -3110,6 +5300,8 @@ class ACTopol(AbstractTopol):
         self.force = force
         self.engine = engine
         self.allhdg = allhdg
+        self.fragment = fragment
+        self.hmr = hmr
         self.acExe = ''
         dirAmber = os.getenv('AMBERHOME', os.getenv('ACHOME'))
         if dirAmber:
@@ -3140,11 +5332,12 @@ class ACTopol(AbstractTopol):
         self.acTopFileName = acBase + '.prmtop'
         self.acFrcmodFileName = acBase + '.frcmod'
         self.tmpDir = os.path.join(self.rootDir, '.acpype_tmp_%s' % os.path.basename(base))
-        self.setResNameCheckCoords()
-        self.guessCharge()
+        with self.stage('setResNameCheckCoords'):
+            self.setResNameCheckCoords()
+        with self.stage('guessCharge'):
+            self.guessCharge()
         acMol2FileName = '%s_%s_%s.mol2' % (base, chargeType, atomType)
         self.acMol2FileName = acMol2FileName
-        self.charmmBase = '%s_CHARMM' % base
         # check for which version of antechamber
         if 'amber10' in self.acExe:
             if qprog == 'sqm':
@@ -3175,6 +5368,8 @@ class ACTopol(AbstractTopol):
         self.outTopols = [outTopol]
         if outTopol == 'all':
             self.outTopols = outTopols
+            if hmr:  # tleap prmtop has no HMR
+                self.outTopols = outTopols + ['amber']
         self.acParDict = {'base': base, 'ext': ext[1:], 'acBase': acBase,
                           'acMol2FileName': acMol2FileName, 'res': self.resName,
                           'leapAmberFile': leapAmberFile, 'baseOrg': self.baseOriginal,
@@ -3192,13 +5387,76 @@ class MolTopol(ACTopol):
 
         INPUTS: acFileXyz and acFileTop
         RETURN: molTopol obj or None
+
+        Topology sections are built lazily, on first access.
     """
 
+    atoms = LazyAttribute('atoms', 'getAtoms')
+    prmtopAtoms = LazyAttribute('prmtopAtoms', 'getAtoms')
+    atomTypes = LazyAttribute('atomTypes', 'getAtoms')
+    atomTypeIds = LazyAttribute('atomTypeIds', 'getAtoms')
+    atomTypeLJIds = LazyAttribute('atomTypeLJIds', 'getAtoms')
+    ljACOEFs = LazyAttribute('ljACOEFs', 'getLJMatrix')
+    ljBCOEFs = LazyAttribute('ljBCOEFs', 'getLJMatrix')
+    ljTypeIds = LazyAttribute('ljTypeIds', 'getLJMatrix')
+    ljHBondPairs = LazyAttribute('ljHBondPairs', 'getLJMatrix')
+    atomTypeSystem = LazyAttribute('atomTypeSystem', 'getAtoms')
+    totalCharge = LazyAttribute('totalCharge', 'getAtoms')
+    pbc = LazyAttribute('pbc', 'getAtoms')
+    atomNumbering = LazyAttribute('atomNumbering', 'getAtoms')
+    bonds = LazyAttribute('bonds', 'getBonds')
+    bondIndex = LazyAttribute('bondIndex', 'getBonds')
+    adjacency = LazyAttribute('adjacency', 'getAdjacency')
+    exclusions = LazyAttribute('exclusions', 'getExclusions')
+    extraExclusions = LazyAttribute('extraExclusions', 'checkExclusions')
+    angles = LazyAttribute('angles', 'getAngles')
+    properDihedrals = LazyAttribute('properDihedrals', 'getDihedrals')
+    improperDihedrals = LazyAttribute('improperDihedrals', 'getDihedrals')
+    condensedProperDihedrals = LazyAttribute('condensedProperDihedrals', 'getDihedrals')
+    atomPairs = LazyAttribute('atomPairs', 'getDihedrals')
+    chiralGroups = LazyAttribute('chiralGroups', 'getChirals')
+    properDihedralsCoefRB = LazyAttribute('properDihedralsCoefRB', 'setProperDihedralsCoef')
+    properDihedralsAlphaGamma = LazyAttribute('properDihedralsAlphaGamma', 'setProperDihedralsCoef')
+    properDihedralsGmx45 = LazyAttribute('properDihedralsGmx45', 'setProperDihedralsCoef')
+    atomTypesGromacs = LazyAttribute('atomTypesGromacs', 'setAtomType4Gromacs')
+    atomTypeIdsGromacs = LazyAttribute('atomTypeIdsGromacs', 'setAtomType4Gromacs')
+
+    # topology sections each writer needs
+    sectionsNeeded = {'gro': ['atoms', 'pbc'],
+                      'pdb': ['atoms'],
+                      'gmx': ['atoms', 'atomTypesGromacs', 'atomTypeIdsGromacs', 'bonds', 'atomPairs',
+                              'extraExclusions', 'angles', 'properDihedralsCoefRB', 'improperDihedrals'],
+                      'cns': ['atoms', 'atomTypes', 'bonds', 'angles',
+                              'condensedProperDihedrals', 'improperDihedrals'],
+                      'charmm': ['atoms', 'atomTypesGromacs', 'atomTypeIdsGromacs', 'bonds', 'angles',
+                                 'condensedProperDihedrals', 'improperDihedrals'],
+                      'amber': ['atoms', 'atomTypes', 'bonds', 'exclusions', 'angles',
+                                'properDihedrals', 'improperDihedrals', 'atomPairs'],
+                      'snapshot': ['atoms', 'atomTypes', 'ljACOEFs', 'bonds', 'extraExclusions', 'angles',
+                                   'condensedProperDihedrals', 'improperDihedrals']}
+
+    def buildSections(self, target):
+        """
+            Builds the topology sections needed by the writer of 'target'
+            (see sectionsNeeded), reporting the time spent on each in debug mode.
+            Sections already built cost nothing.
+        """
+        sections = list(self.sectionsNeeded[target])
+        if target == 'cns' and self.chiral:
+            sections.append('chiralGroups')
+        for section in sections:
+            if section in self.__dict__:
+                continue
+            t0 = time.time()
+            getattr(self, section)
+            self.printDebug("%s built in %.3f s" % (section, time.time() - t0))
+
     def __init__(self, acTopolObj=None, acFileXyz=None, acFileTop=None,
                  debug=False, basename=None, verbose=True, gmx45=False,
-                 disam=False, direct=False, is_sorted=False, chiral=False):
+                 disam=False, direct=False, is_sorted=False, chiral=False, hmr=None):
 
         self.chiral = chiral
+        self.hmrMass = hmr
         self.obchiralExe = _getoutput('which obchiral') or ''
         self.allhdg = False
         self.debug = debug
@@ -3214,6 +5472,7 @@ class MolTopol(ACTopol):
             if not acFileTop:
                 acFileTop = acTopolObj.acTopFileName
             self._parent = acTopolObj
+            self.force = self._parent.force
             self.allhdg = self._parent.allhdg
             self.debug = self._parent.debug
             self.inputFile = self._parent.inputFile
@@ -3241,25 +5500,11 @@ class MolTopol(ACTopol):
             self.baseName = basename or acTopolObj.baseName
         self.printDebug("basename defined = '%s'" % self.baseName)
 
-        self.getAtoms()
-
-        self.getBonds()
-
-        self.getAngles()
-
-        self.getDihedrals()
-
-        self.getChirals()
-        if not os.path.exists(self.obchiralExe) and self.chiral:
-            self.printError("no 'obchiral' executable, it won't work to store non-planar improper dihedrals!")
-            self.printWarn("Consider installing http://openbabel.org")
-        elif self.chiral and not self.chiralGroups:
-            self.printWarn("No chiral atoms found")
+        # atoms, bonds, angles, dihedrals, chiral groups etc. are only parsed
+        # when first needed, see LazyAttribute and sectionsNeeded below
 
         # self.setAtomPairs()
 
-        # self.getExcludedAtoms()
-
         # a list of FLAGS from acTopFile that matter
 #        self.flags = ( 'POINTERS', 'ATOM_NAME', 'CHARGE', 'MASS', 'ATOM_TYPE_INDEX',
 #                  'NUMBER_EXCLUDED_ATOMS', 'NONBONDED_PARM_INDEX',
@@ -3273,6 +5518,9 @@ class MolTopol(ACTopol):
             self.printMess("Sorting atoms for gromacs ordering.\n")
             self.sortAtomsForGromacs()
 
+        if self.hmrMass:
+            self.repartitionHydrogenMass()
+
 
 class Atom(object):
 
@@ -3291,16 +5539,44 @@ class Atom(object):
         Coord is given in Ang. and mass in Atomic Mass Unit.
     """
 
-    def __init__(self, atomName, atomType, id_, resid, mass, charge, coord):
+    def __init__(self, atomName, atomType, id_, resid, mass, charge, coord, numbering=None):
         self.atomName = atomName
         self.atomType = atomType
-        self.id = id_
-        self.cgnr = id_
+        self.index = id_ - 1  # position in prmtop
+        self.numbering = numbering
+        if numbering is None:
+            self._id = id_
+            self._cgnr = id_
         self.resid = resid
         self.mass = mass
         self.charge = charge  # / qConv
         self.coords = coord
 
+    def _getId(self):
+        if self.numbering is None:
+            return self._id
+        return int(self.numbering.id[self.index])
+
+    def _setId(self, id_):
+        if self.numbering is None:
+            self._id = id_
+        else:
+            self.numbering.id[self.index] = id_
+
+    def _getCgnr(self):
+        if self.numbering is None:
+            return self._cgnr
+        return int(self.numbering.cgnr[self.index])
+
+    def _setCgnr(self, cgnr):
+        if self.numbering is None:
+            self._cgnr = cgnr
+        else:
+            self.numbering.cgnr[self.index] = cgnr
+
+    id = property(_getId, _setId)
+    cgnr = property(_getCgnr, _setCgnr)
+
     def __str__(self):
         return '<Atom id=%s, name=%s, %s>' % (self.id, self.atomName, self.atomType)
 
@@ -3308,6 +5584,19 @@ class Atom(object):
         return '<Atom id=%s, name=%s, %s>' % (self.id, self.atomName, self.atomType)
 
 
+class AtomNumbering(object):
+
+    """
+        Atom ids and charge group numbers of a topology, as arrays indexed by
+        the atom position in prmtop, shared by its Atom objects.
+        Re-sorting atoms (e.g. for GMX) only rewrites these arrays.
+    """
+
+    def __init__(self, nAtoms):
+        self.id = np.arange(1, nAtoms + 1)
+        self.cgnr = np.arange(1, nAtoms + 1)
+
+
 class AtomType(object):
 
     """
@@ -3450,11 +5739,12 @@ if __name__ == '__main__':
                       help='for debugging purposes, keep any temporary file created',)
     parser.add_option('-o', '--outtop',
                       type='choice',
-                      choices=['all'] + outTopols,
+                      choices=['all'] + outTopols + ['amber'],
                       action="store",
                       default='all',
                       dest='outtop',
-                      help="output topologies: all (default), gmx, cns or charmm",)
+                      help="output topologies: all (default), gmx, cns, charmm or amber "
+                      "(prmtop written by acpype, in all only with --hmr)",)
     parser.add_option('-r', '--gmx45',
                       action="store_true",
                       dest='gmx45',
@@ -3476,6 +5766,31 @@ if __name__ == '__main__':
                       default=36000,
                       dest='max_time',
                       help="max time (in sec) tolerance for sqm/mopac, default is 10 hours",)
+    parser.add_option('--estimate',
+                      action="store_true",
+                      dest='estimate',
+                      help="only estimate time and memory of each stage for the mol2 input, running nothing",)
+    parser.add_option('--fit_estimate',
+                      action="store_true",
+                      dest='fit_estimate',
+                      help="refit the model used by --estimate to the acpype report files given as arguments,"
+                      " saved in ~/.cache/acpype",)
+    parser.add_option('--max_mem',
+                      action="store",
+                      type='int',
+                      dest='max_mem',
+                      help="max memory (in MB) for each external tool (antechamber, sqm, tleap...), default no limit",)
+    parser.add_option('--hmr',
+                      action="store_true",
+                      dest='hmr',
+                      help="hydrogen mass repartitioning: move mass from heavy atoms to their hydrogens, "
+                      "for 4 fs time steps",)
+    parser.add_option('--hmr_mass',
+                      action="store",
+                      type='float',
+                      default=3.024,
+                      dest='hmr_mass',
+                      help="hydrogen mass (Da) for --hmr, default is 3.024",)
     parser.add_option('-y', '--ipython',
                       action="store_true",
                       dest='ipython',
@@ -3501,11 +5816,71 @@ if __name__ == '__main__':
                       action="store_true",
                       dest='chiral',
                       help="create improper dihedral parameters for chiral atoms in CNS",)
+    parser.add_option('-z', '--fragment',
+                      action="store",
+                      type='int',
+                      default=0,
+                      dest='fragment',
+                      help="run antechamber, parmchk and tleap only on capped fragments with all atom "
+                      "environments up to FRAGMENT bonds deep (e.g. 4), in parallel, map types and "
+                      "averaged charges onto the whole mol2 input and assemble its topology from the "
+                      "fragment parameters, for big repetitive molecules like CNTs",)
 
     options, remainder = parser.parse_args()
 
+    if options.fragment and options.fragment < 2:
+        parser.error("option --fragment needs at least 2 bonds, or no atom would be away from the caps")
+
     amb2gmx = False
 
+    if options.fit_estimate:
+        if not remainder:
+            parser.error("no report files to fit")
+        fitted = fitEstimateModel(remainder)
+        # the user's model, not the one shipped, which may not be writable
+        modelFile = os.path.join(acpypeCacheDir(), 'acpype_estimate.json')
+        model = {}
+        if os.path.exists(modelFile):
+            with open(modelFile) as f:
+                model = json.load(f)
+        model.update(fitted)
+        writeAtomic(modelFile, [json.dumps(model, indent=1, sort_keys=True)])
+        print("Stages refitted: %s\nModel saved in '%s'" % (', '.join(sorted(fitted)) or 'none', modelFile))
+        sys.exit(0)
+
+    if options.estimate:
+        if not options.input or not options.input.endswith('.mol2'):
+            parser.error("--estimate needs a mol2 input file ('-i')")
+        sizes = estimateSizes(options.input, options.fragment)
+        print("%(atoms)i atoms, %(bonds)i bonds, ~%(angles)i angles, ~%(dihedrals)i dihedrals" % sizes)
+        if sizes.get('fragments'):
+            print("fragments of %s atoms" % '+'.join(map(str, sizes['fragments'])))
+        estimates = estimateResources(sizes, options.charge_method, options.fragment)
+        print("%-16s %12s %12s" % ('stage', 'time (s)', 'memory (MB)'))
+        for stage, time_, mem, runTime in estimates:
+            if time_ is None:
+                print("%-16s %12s %12s" % (stage, 'no data', 'no data'))
+            else:
+                print("%-16s %12.1f %12.1f" % (stage, time_, mem))
+        known = [e for e in estimates if e[1] is not None]
+        unknown = [e[0] for e in estimates if e[1] is None]
+        if known:
+            print("Total time: %s%s" % (elapsedTime(int(round(sum([e[1] for e in known]))) or 1),
+                                        unknown and ', without the stages with no data' or ''))
+            # twice the estimates, to be safe; -s limits every tool run,
+            # so it is set by the longest one
+            runTimes = [e[3] for e in known if e[0] in estimateTools]
+            if runTimes:
+                print("Recommended: -s %i" % max(600, int(math.ceil(2 * max(runTimes)))))
+            # --max_mem limits the address space (virtual memory) of tools,
+            # well above their RSS and not measured: not recommended from it
+            peakRss = max([e[2] for e in known])
+            print("Peak RSS: %i MB, twice for the job memory (e.g. sbatch --mem=%iM); --max_mem limits "
+                  "virtual memory, larger than that" % (math.ceil(peakRss), math.ceil(2 * peakRss)))
+        if unknown:
+            print("No data for %s: fit your own acpype reports with --fit_estimate" % ', '.join(unknown))
+        sys.exit(0)
+
 #     if options.chiral:
 #         options.cnstop = True
 
@@ -3530,9 +5905,20 @@ if __name__ == '__main__':
                               debug=options.debug, basename=options.basename,
                               verbose=options.verboseless, gmx45=options.gmx45,
                               disam=options.disambiguate, direct=options.direct,
-                              is_sorted=options.sorted, chiral=options.chiral)
+                              is_sorted=options.sorted, chiral=options.chiral,
+                              hmr=options.hmr and options.hmr_mass)
             system.printDebug("prmtop and inpcrd files parsed")
-            system.writeGromacsTopolFiles(amb2gmx=True)
+            try:
+                with system.stage('MolTopol'):
+                    system.buildSections('gmx')
+                    system.buildSections('gro')
+                with system.stage('GROMACS'):
+                    system.writeGromacsTopolFiles(amb2gmx=True)
+                if options.hmr:
+                    with system.stage('AMBER'):
+                        system.writeAmberTopol()
+            finally:
+                system.writeReport()
         else:
             molecule = ACTopol(options.input, chargeType=options.charge_method,
                                chargeVal=options.net_charge, debug=options.debug,
@@ -3543,7 +5929,9 @@ if __name__ == '__main__':
                                qprog=options.qprog, ekFlag='''"%s"''' % options.keyword,
                                verbose=options.verboseless, gmx45=options.gmx45,
                                disam=options.disambiguate, direct=options.direct,
-                               is_sorted=options.sorted, chiral=options.chiral)
+                               is_sorted=options.sorted, chiral=options.chiral,
+                               fragment=options.fragment, maxMem=options.max_mem,
+                               hmr=options.hmr and options.hmr_mass)
 
             if not molecule.acExe:
                 molecule.printError("no 'antechamber' executable... aborting ! ")
@@ -3553,8 +5941,11 @@ if __name__ == '__main__':
                 molecule.printMess(hint2)
                 sys.exit(1)
 
-            molecule.createACTopol()
-            molecule.createMolTopol()
+            try:
+                molecule.createACTopol()
+                molecule.createMolTopol()
+            finally:
+                molecule.writeReport()
         acpypeFailed = False
     except:
         exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
@@ -0,0 +1,428 @@
+"""
+    Regression checks of acpype helpers, run with: python -m pytest -q
+"""
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+import acpype
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example-carbon-nanotubes',
+                       'CNT_zigzag_cooh-12-40.acpype', 'CNT_zigzag_cooh-12-40_AC')
+
+
+def readTopol(prmtop, xyz=EXAMPLE + '.inpcrd', basename='mol'):
+    return acpype.MolTopol(acFileXyz=xyz, acFileTop=prmtop, basename=basename, verbose=False)
+
+
+def setSection(prmtop, flag, fmt, values, outFile):
+    """ writes prmtop with the %FLAG flag section replaced """
+    lines = open(prmtop).read().splitlines()
+    start = [i for i, line in enumerate(lines) if line.split()[:2] == ['%FLAG', flag]][0]
+    end = start + 1
+    while end < len(lines) and not lines[end].startswith('%FLAG'):
+        end += 1
+    lines[start:end] = acpype.prmtopSection(flag, fmt, values)
+    with open(outFile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def test_runTool_timeout():
+    t0 = time.time()
+    code, out = acpype.runTool(['sh', '-c', 'echo hi; sleep 5'], timeTol=1)
+    assert code is None
+    assert out == 'hi\n'
+    assert time.time() - t0 < 4
+
+
+def test_runTool_exit_code():
+    assert acpype.runTool(['sh', '-c', 'echo hi; exit 3']) == (3, 'hi\n')
+
+
+def test_runTool_orphan_output():
+    # a child out of the process group keeps the output open after the kill
+    t0 = time.time()
+    code, out = acpype.runTool(['sh', '-c', 'setsid sleep 9 & echo hi; sleep 5'], timeTol=1)
+    assert code is None
+    assert out == 'hi\n'
+    assert time.time() - t0 < 8
+
+
+def test_runTool_maxMem(monkeypatch):
+    # the limit is set before exec, so the tool itself starts with it
+    assert acpype.runTool(['sh', '-c', 'ulimit -v'], maxMem=500) == (0, '512000\n')
+    assert acpype.runTool(['no_such_tool'], maxMem=500)[0] == 127
+    # without prlimit
+    monkeypatch.setattr(acpype, '_getoutput', lambda cmd: '')
+    assert acpype.runTool(['sh', '-c', 'ulimit -v'], maxMem=500) == (0, '512000\n')
+
+
+class Writer(acpype.AbstractTopol):
+
+    def __init__(self):
+        self.debug = False
+        self.verbose = False
+
+    def writeBig(self):
+        # larger than a pipe buffer, as execAntechamber's acLog can be
+        self.log = 'x' * 10 ** 6
+
+    def writeFail(self):
+        raise Exception('no space left')
+
+
+def test_runWriters_parallel(monkeypatch):
+    monkeypatch.setattr(acpype.multiprocessing, 'cpu_count', lambda: 2)
+    top, other = Writer(), Writer()
+    top.runWriters([('big', top, 'writeBig'), ('other', other, 'writeBig')])
+    assert top.log == other.log == 'x' * 10 ** 6
+    assert [s['stage'] for s in top.stages] == ['big', 'other']
+    try:
+        top.runWriters([('big', top, 'writeBig'), ('fail', other, 'writeFail')])
+    except Exception as e:
+        assert str(e) == 'fail failed: no space left'
+    else:
+        assert False
+
+
+def test_writeReport_failed_stage(tmpdir, monkeypatch):
+    monkeypatch.setattr(acpype.multiprocessing, 'cpu_count', lambda: 2)
+    top = Writer()
+    top.baseName, top.absHomeDir = 'mol', str(tmpdir)
+    try:
+        top.runWriters([('big', top, 'writeBig'), ('fail', Writer(), 'writeFail')])
+    except Exception:
+        pass
+    finally:
+        top.writeReport()
+    report = json.load(open(str(tmpdir.join('mol_report.json'))))
+    assert report['failedStage'] == 'fail'
+    assert [s['stage'] for s in report['stages']] == ['big', 'fail']
+
+
+def test_nbfix(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    top = readTopol(EXAMPLE + '.prmtop')
+    assert top.getNonbondParams() == []
+    # A of the pair of LJ types 1 and 2 off the combination rule
+    nTypes = top.getFlagData('POINTERS')[1]
+    index = top.getFlagData('NONBONDED_PARM_INDEX')[1] - 1
+    acoefs = top.getFlagData('LENNARD_JONES_ACOEF')
+    acoefs[index] *= 1.5
+    setSection(EXAMPLE + '.prmtop', 'LENNARD_JONES_ACOEF', '5E16.8', acoefs, 'nbfix.prmtop')
+    top = readTopol('nbfix.prmtop')
+    A, B = top.ljACOEFs[0, 1], top.ljBCOEFs[0, 1]
+    assert nTypes == 5 and top.ljACOEFs[1, 0] == A and abs(A / acoefs[index] - 1) < 1e-8
+    # LJ type 1 is ca and c, 2 is o
+    nbfix = top.getNonbondParams()
+    names = [(top.atomTypesGromacs[i].atomTypeName, top.atomTypesGromacs[j].atomTypeName) for i, j, _, _ in nbfix]
+    assert names == [('ca', 'o'), ('c', 'o')]
+    sigma, epsilon = nbfix[0][2:]
+    assert nbfix[1][2:] == (sigma, epsilon)
+    assert abs(sigma - 0.1 * (A / B) ** (1.0 / 6)) < 1e-9
+    assert abs(epsilon - 4.184 * B * B / (4 * A)) < 1e-9
+
+    top.writeGromacsTopolFiles()
+    text = open('mol_GMX.itp').read()
+    lines = ''.join([' %-8s %-8s  1   %13.5e %13.5e\n' % (a, b, sigma, epsilon) for a, b in names])
+    assert '[ nonbond_params ]\n;name1    name2    func  sigma         epsilon\n' + lines in text
+    lines = ''.join([' %-8s %-8s  1   %13.5e %13.5e\n' % (a, b, sigma, 0.5 * epsilon) for a, b in names])
+    assert '[ pairtypes ]\n;name1    name2    func  sigma         epsilon ; fudgeLJ 0.5 applied\n' + lines in text
+    assert 'nonbond_params' not in open('mol_GMX_OPLS.itp').read()
+
+    top.writeCharmmTopolFiles()
+    text = open('mol_CHARMM.prm').read()
+    rMin = 10 * sigma * 2 ** (1.0 / 6)
+    emin = -epsilon / 4.184
+    lines = ''.join(['%-6s %-6s %11.6f %11.6f %11.6f %11.6f\n' % (a, b, emin, rMin, emin / 2, rMin) for a, b in names])
+    assert '\nNBFIX\n' + lines in text
+
+
+def test_hbond_pairs(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(tmpdir)
+    top = readTopol(EXAMPLE + '.prmtop')
+    index = top.getFlagData('NONBONDED_PARM_INDEX')
+    index[1] = index[5] = -1  # LJ types 1 and 2 as a 10-12 pair
+    setSection(EXAMPLE + '.prmtop', 'NONBONDED_PARM_INDEX', '10I8', index, 'hbond.prmtop')
+    top = readTopol('hbond.prmtop')
+    top.verbose = True
+    assert top.ljHBondPairs.sum() == 2 and top.ljACOEFs[0, 1] == top.ljBCOEFs[1, 0] == 0
+    assert top.getNonbondParams() == []  # not as a 6-12 pair with A = B = 0
+    top.writeAmberTopol()
+    assert ("WARNING: 1 10-12 (H-bond) LJ type pairs written as 6-12 ones with A = B = 0:"
+            " their HBOND_ACOEF/HBOND_BCOEF terms are lost" in capsys.readouterr()[0])
+
+
+def gmxFiles(basename):
+    texts = []
+    for ext in ['_GMX.top', '_GMX.itp', '_GMX.gro']:
+        lines = open(basename + ext).read().replace(basename, 'mol').splitlines()
+        texts.append([line for line in lines if 'created by acpype' not in line])
+    return texts
+
+
+def test_writeAmberTopol_round_trip(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    top = readTopol(EXAMPLE + '.prmtop', basename='old')
+    top.writeAmberTopol()
+    new = readTopol('old_AMBER.prmtop', 'old_AMBER.inpcrd', basename='new')
+    for flag in ['POINTERS', 'ATOM_NAME', 'CHARGE', 'MASS', 'ATOM_TYPE_INDEX', 'NUMBER_EXCLUDED_ATOMS',
+                 'NONBONDED_PARM_INDEX', 'EXCLUDED_ATOMS_LIST', 'AMBER_ATOM_TYPE', 'RESIDUE_POINTER']:
+        assert new.getFlagData(flag) == top.getFlagData(flag), flag
+    assert np.array_equal(new.ljACOEFs, top.ljACOEFs) and np.array_equal(new.ljBCOEFs, top.ljBCOEFs)
+    # parameter tables are in order of use, so terms are compared as written for GROMACS
+    top.writeGromacsTopolFiles()
+    new.writeGromacsTopolFiles()
+    assert gmxFiles('new') == gmxFiles('old')
+
+
+def test_writeAmberTopol_atom_0(tmpdir, monkeypatch):
+    # as tleap, quartets the other way round if atom 0 would be 3rd or 4th,
+    # where it could not take the 1-4 and improper flags (negative indices)
+    monkeypatch.chdir(tmpdir)
+    top = readTopol(EXAMPLE + '.prmtop', basename='old')
+    for dihedral in top.properDihedrals:
+        dihedral.atoms = dihedral.atoms[::-1]
+    top.writeAmberTopol()
+    new = readTopol('old_AMBER.prmtop', 'old_AMBER.inpcrd')
+    codes = np.array(new.getFlagData('DIHEDRALS_INC_HYDROGEN') +
+                     new.getFlagData('DIHEDRALS_WITHOUT_HYDROGEN')).reshape(-1, 5)
+    assert (codes[:, 2:4] != 0).all()
+    assert new.getFlagData('POINTERS') == top.getFlagData('POINTERS')
+    assert len(new.improperDihedrals) == len(top.improperDihedrals)
+
+
+def normalised(fileName):
+    """ lines of an output file with no header, [ pairs ] as sorted atom pairs
+        (taken from the bond graph, their order and orientation are free) """
+    lines, pairs, section = [], [], None
+    for line in open(fileName).read().splitlines():
+        if 'created by acpype' in line:
+            continue
+        if line.startswith('['):
+            section = line
+        if section == '[ pairs ]' and line[:1] == ' ':
+            pairs.append(tuple(sorted(map(int, line.split()[:2]))))
+        else:
+            lines.append(line)
+    return lines, sorted(pairs)
+
+
+def test_example_outputs(tmpdir, monkeypatch):
+    # as the GROMACS and CNS files shipped with the examples
+    monkeypatch.chdir(tmpdir)
+    for name in ['CNT_zigzag_cooh-12-40', 'CNT_arm_oh-08-40', 'CNT_arm_coo-08-45']:
+        example = os.path.join(os.path.dirname(EXAMPLE), '..', name + '.acpype', name)
+        top = readTopol(example + '_AC.prmtop', example + '_AC.inpcrd', basename=name)
+        top.writeGromacsTopolFiles()
+        top.writeCnsTopolFiles()
+        for ext in ['_GMX.itp', '_GMX_OPLS.itp', '_GMX.top', '_GMX.gro', '_CNS.top', '_CNS.inp', '_NEW.pdb']:
+            assert normalised(name + ext) == normalised(example + ext), name + ext
+        # parameters in any order
+        assert sorted(normalised(name + '_CNS.par')[0]) == sorted(normalised(example + '_CNS.par')[0])
+
+
+def test_snapshot(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    top = readTopol(EXAMPLE + '.prmtop', basename='old')
+    top.writeSnapshot()
+    new = acpype.snapshotTopol('old.snapshot', basename='new', verbose=False)
+    for writer in [top, new]:
+        writer.writeGromacsTopolFiles()
+        writer.writeCnsTopolFiles()
+        writer.writeCharmmTopolFiles()
+        writer.writeAmberTopol()
+    assert gmxFiles('new') == gmxFiles('old')
+    for ext in ['_CNS.top', '_CNS.par', '_CHARMM.rtf', '_CHARMM.prm', '_AMBER.prmtop', '_AMBER.inpcrd']:
+        new, old = [open(name + ext).read().replace(name, 'mol').splitlines()[1:] for name in ['new', 'old']]
+        assert new == old, ext
+    header = json.load(open(os.path.join('old.snapshot', 'header.json')))
+    header['version'] -= 1
+    json.dump(header, open(os.path.join('old.snapshot', 'header.json'), 'w'))
+    try:
+        acpype.readSnapshot('old.snapshot')
+    except Exception as e:
+        assert 'not an acpype snapshot version' in str(e)
+    else:
+        assert False
+
+
+def test_bondExclusions():
+    # a 5-ring fused to a 6-ring, with a tail: 1-4 pairs are the atoms 3 bonds
+    # away by the shortest path, ring closures included
+    bonds = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 0), (3, 5), (5, 6), (6, 7), (7, 8), (8, 2), (8, 9), (9, 10)]
+    nAtoms = 11
+    indptr, indices, dists = acpype.bondExclusions(acpype.bondAdjacency(bonds, nAtoms))
+    neighbours = [set() for i in range(nAtoms)]
+    for i, j in bonds:
+        neighbours[i].add(j)
+        neighbours[j].add(i)
+    for i in range(nAtoms):
+        expected, shell, seen = [], set([i]), set([i])
+        for dist in [1, 2, 3]:
+            shell = set.union(*[neighbours[k] for k in shell]) - seen
+            seen |= shell
+            expected += [(j, dist) for j in shell if j > i]
+        got = list(zip(indices[indptr[i]:indptr[i + 1]].tolist(), dists[indptr[i]:indptr[i + 1]].tolist()))
+        assert got == sorted(expected), i
+
+
+def test_exclusions_as_tleap():
+    top = readTopol(EXAMPLE + '.prmtop')
+    indptr, indices, dists = top.exclusions
+    counts = top.getFlagData('NUMBER_EXCLUDED_ATOMS')
+    excluded = np.array(top.getFlagData('EXCLUDED_ATOMS_LIST')) - 1
+    starts = np.cumsum([0] + counts)
+    for i in range(len(counts)):
+        # tleap's list, 0 for none
+        assert indices[indptr[i]:indptr[i + 1]].tolist() == [j for j in excluded[starts[i]:starts[i + 1]] if j >= 0]
+    assert top.extraExclusions == []
+    # 1-4 pairs as the prmtop dihedrals that compute them
+    tleapPairs = set()
+    for flag in ['DIHEDRALS_INC_HYDROGEN', 'DIHEDRALS_WITHOUT_HYDROGEN']:
+        quintets = np.array(top.getFlagData(flag)).reshape(-1, 5)
+        for i, j, k, l, p in quintets:
+            if k >= 0 and l >= 0:
+                tleapPairs.add(tuple(sorted((abs(i) // 3, abs(l) // 3))))
+    assert set(tuple(sorted((a.index, b.index))) for a, b in top.atomPairs) == tleapPairs
+
+
+def test_sorted_for_gromacs():
+    bonds = [(0, 3), (2, 0), (1, 2), (3, 4)]
+    indptr, indices = acpype.bondAdjacency(bonds, 6)
+    assert [indices[indptr[i]:indptr[i + 1]].tolist() for i in range(6)] == [[3, 2], [2], [0, 1], [0, 4], [3], []]
+    # hydrogens right after the heavy atom they are bonded to, in its charge group
+    top = acpype.MolTopol(acFileXyz=EXAMPLE + '.inpcrd', acFileTop=EXAMPLE + '.prmtop', basename='mol',
+                          verbose=False, is_sorted=True)
+    indptr, indices = top.adjacency
+    ids, cgnrs = top.atomNumbering.id, top.atomNumbering.cgnr
+    assert sorted(ids[a.index] for a in top.atoms) == list(range(1, len(top.atoms) + 1))
+    heavy = None
+    for atom in top.atoms:
+        i = atom.index
+        if atom.mass < 1.2:
+            assert heavy in indices[indptr[i]:indptr[i + 1]] and cgnrs[i] == cgnrs[heavy]
+            assert ids[i] > ids[heavy]
+        else:
+            heavy = i
+    assert sum(a.mass < 1.2 for a in top.atoms) > 0
+
+
+def test_gromacs_pool(tmpdir, monkeypatch):
+    # formatted by a pool, chunks are written in order
+    monkeypatch.chdir(tmpdir)
+    readTopol(EXAMPLE + '.prmtop', basename='old').writeGromacsTopolFiles()
+    monkeypatch.setattr(acpype.multiprocessing, 'cpu_count', lambda: 2)
+    monkeypatch.setattr(acpype, 'gmxPoolAtoms', 0)
+    monkeypatch.setattr(acpype, 'gmxChunkSize', 100)
+    readTopol(EXAMPLE + '.prmtop', basename='new').writeGromacsTopolFiles()
+    assert gmxFiles('new') == gmxFiles('old')
+
+
+def test_estimate(tmpdir):
+    reports = []
+    for atoms, wallTime, failed in [(100, 1.0, None), (1000, 100.0, None), (1000, 5.0, 'antechamber')]:
+        reports.append(str(tmpdir.join('%i%s_report.json' % (atoms, failed or ''))))
+        json.dump({'chargeType': 'bcc', 'fragment': 0, 'failedStage': failed,
+                   'sizes': {'atoms': atoms, 'terms': 10 * atoms},
+                   'stages': [{'stage': 'antechamber', 'wallTime': wallTime, 'toolsPeakRss': atoms / 10.0,
+                               'acpypePeakRss': 50.0}]}, open(reports[-1], 'w'))
+    model = acpype.fitEstimateModel(reports)
+    entry = model['antechamber:bcc']
+    assert list(model) == ['antechamber:bcc'] and entry['points'] == 2 and entry['size'] == 'atoms'
+    assert np.allclose(entry['time'], [1e-4, 2]) and np.allclose(entry['mem'], [0.1, 1])
+    sizes = {'atoms': 300, 'terms': 3000, 'fragments': [100, 200]}
+    estimates = acpype.estimateResources(sizes, 'bcc', 2, model)
+    assert estimates[0] == ('guessCharge', None, None, None)
+    stage, time_, mem, runTime = estimates[1]
+    # -s is for the longest antechamber run, of the largest fragment
+    assert stage == 'antechamber:bcc' and abs(runTime - 4) < 1e-9 and abs(mem - 20) < 1e-9
+    assert abs(time_ - max(4, 5.0 / acpype.multiprocessing.cpu_count())) < 1e-9
+
+
+def test_fragment_classes():
+    # atoms of a class have the tleap type of their representative, which
+    # has all its atoms up to radius bonds away in its fragment
+    top = readTopol(EXAMPLE + '.prmtop')
+    mol2 = os.path.join(os.path.dirname(EXAMPLE), '..', 'CNT_zigzag_cooh-12-40.mol2')
+    types, bonds = acpype.readMol2Graph(mol2)
+    atoms = list(acpype.readMol2Atoms(mol2))
+    elements = [acpype.mol2Element(t, atom[1]) for t, atom in zip(types, atoms)]
+    classes = acpype.atomClasses(elements, bonds, 3)
+    fragments, reps = acpype.fragmentAtoms(classes, bonds, 3)
+    tleapTypes = [a.atomType.atomTypeName for a in top.prmtopAtoms]
+    assert [tleapTypes[i] for i in reps[classes]] == tleapTypes
+    assert len(reps) == classes.max() + 1 < len(atoms) / 10
+    adjacency = acpype.bondAdjacency(bonds, len(atoms))
+    for rep in reps.tolist():
+        near = np.flatnonzero(acpype.bondDistances(adjacency, [rep], 3) >= 0)
+        assert any(np.isin(near, frag).all() for frag in fragments)
+    assert sum(len(f) for f in fragments) < len(atoms) / 2
+
+
+def test_classCharges():
+    # a chain 0-...-5, fragment 0-3 capped at 3: atoms 2 and 3 are next to the
+    # cap, so their class is only averaged there
+    bonds = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)]
+    classes = acpype.atomClasses(['C'] * 6, bonds, 2)
+    assert classes.tolist() == [classes[0], classes[1], classes[2], classes[2], classes[1], classes[0]]
+    assert len(set(classes.tolist())) == 3
+    charges, near = acpype.classCharges(classes, [np.arange(4)], [[3]], [[0.1, -0.2, 0.3, 0.5]],
+                                        acpype.bondAdjacency(bonds, 6), 0)
+    assert np.allclose(charges, [0.0, -0.3, 0.3, 0.3, -0.3, 0.0]) and abs(charges.sum()) < 1e-12
+    assert near.tolist() == [False, False, True, True, False, False]
+    # and with a second fragment 2-5 capped at 2, the others over both
+    charges, near = acpype.classCharges(classes, [np.arange(4), np.arange(2, 6)], [[3], [2]],
+                                        [[0.1, -0.2, 0.3, 0.5], [0.7, 0.3, -0.4, 0.3]],
+                                        acpype.bondAdjacency(bonds, 6), 1)
+    assert np.allclose(charges, [0.25, -0.25, 0.5, 0.5, -0.25, 0.25]) and abs(charges.sum() - 1) < 1e-12
+    assert near.tolist() == [False, False, True, True, False, False]
+    charges, near = acpype.classCharges(classes, [np.arange(2)], [[]], [[0.1, -0.2]],
+                                        acpype.bondAdjacency(bonds, 6))
+    assert np.isnan(charges).all()
+
+
+def assembled(fragName, name, baseName):
+    """ the topology of example name assembled from the parameters of example fragName """
+    example = os.path.join(os.path.dirname(EXAMPLE), '..', '%s.acpype', '%s_AC')
+    frag = readTopol(example % (fragName, fragName) + '.prmtop', example % (fragName, fragName) + '.inpcrd')
+    top = readTopol(example % (name, name) + '.prmtop', example % (name, name) + '.inpcrd', basename=baseName)
+    atoms = top.prmtopAtoms
+    header, arrays = acpype.assembleTopol([frag], [a.atomName for a in atoms],
+                                          [a.atomType.atomTypeName for a in atoms], [a.charge for a in atoms],
+                                          [a.coords for a in atoms], top.bondIndex, top.residueLabel[0], baseName)
+    return top, acpype.arraysTopol(header, arrays, verbose=False)
+
+
+def test_assembleTopol(tmpdir, monkeypatch):
+    # a longer tube from the parameters of a shorter one, as tleap makes it
+    monkeypatch.chdir(tmpdir)
+    top, new = assembled('CNT_zigzag_cooh-12-40', 'CNT_zigzag_cooh-12-45', 'new')
+
+    def terms(topol, section, fields):
+        return sorted([(min(ids, ids[::-1]),) + tuple([round(getattr(t, f), 6) for f in fields])
+                       for t in getattr(topol, section) for ids in [tuple([a.index for a in t.atoms])]])
+
+    for section, fields in [('bonds', ['kBond', 'rEq']), ('angles', ['kTheta', 'thetaEq']),
+                            ('properDihedrals', ['kPhi', 'period', 'phase'])]:
+        assert terms(new, section, fields) == terms(top, section, fields), section
+    # impropers in tleap's atom order
+    assert ([[a.index for a in d.atoms] for d in new.improperDihedrals] ==
+            [[a.index for a in d.atoms] for d in top.improperDihedrals])
+    assert np.array_equal(new.ljTypeIds, top.ljTypeIds) and np.allclose(new.ljACOEFs, top.ljACOEFs, rtol=1e-8)
+    new.writeAmberTopol()
+    new = readTopol('new_AMBER.prmtop', 'new_AMBER.inpcrd')
+    for flag in ['POINTERS', 'ATOM_NAME', 'MASS', 'ATOM_TYPE_INDEX', 'NUMBER_EXCLUDED_ATOMS',
+                 'EXCLUDED_ATOMS_LIST', 'AMBER_ATOM_TYPE']:
+        assert new.getFlagData(flag) == top.getFlagData(flag), flag
+    assert np.allclose(new.getFlagData('CHARGE'), top.getFlagData('CHARGE'), atol=1e-6)
+    # no carboxyl parameters in a bare tube
+    try:
+        assembled('CNT_zigzag_none-12-40', 'CNT_zigzag_cooh-12-45', 'new')
+    except Exception as e:
+        assert 'no parameters in the fragments' in str(e) and 'o' in str(e).split(': ')[1].split()
+    else:
+        assert False